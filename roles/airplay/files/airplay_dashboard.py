@@ -9,19 +9,170 @@ because iOS 17.4+/macOS 14.4+ ignore those commands from a receiver.
 """
 from __future__ import annotations
 
+import asyncio
+import gzip
+import hashlib
 import json
 import os
+import queue
+import re
+import socket
+import struct
 import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+try:  # optional: without Pillow, /cover?size=N serves the original
+    from PIL import Image
+except ImportError:  # pragma: no cover - depends on the host
+    Image = None
 
 NAME = os.environ.get("AIRPLAY_NAME", os.uname().nodename)
 BIND = os.environ.get("AIRPLAY_DASHBOARD_BIND", "0.0.0.0")
 PORT = int(os.environ.get("AIRPLAY_DASHBOARD_PORT", "8080"))
 STATE_DIR = os.environ.get("AIRPLAY_STATE_DIR", "/run/airplay")
 STATE_FILE = os.path.join(STATE_DIR, "nowplaying.json")
+COVER_DIR = os.path.join(STATE_DIR, "covers")
+STATE_SOCKET = os.path.join(STATE_DIR, "nowplaying.sock")
+# Live updates (/api/events): health refresh / keep-alive period and a cap on
+# concurrent streams (each holds one server thread).
+EVENTS_INTERVAL = 5.0
+MAX_EVENT_CLIENTS = int(os.environ.get("AIRPLAY_DASHBOARD_MAX_STREAMS", "32"))
+# "threaded" (ThreadingHTTPServer, a thread per connection) or "async"
+# (AsyncServer: one event loop, keep-alive, bounded concurrency).
+SERVER_MODE = os.environ.get("AIRPLAY_DASHBOARD_SERVER", "threaded")
+MAX_CONNECTIONS = int(os.environ.get("AIRPLAY_DASHBOARD_MAX_CONNS", "256"))
+MAX_INFLIGHT = 16
+EXECUTOR_WORKERS = 4
+KEEPALIVE_TIMEOUT = 15.0
+MAX_HEADER_BYTES = 16 * 1024
+MAX_BODY_BYTES = 64 * 1024
+SERVICES = ("shairport-sync", "nqptp", "avahi-daemon")
+# Service health older than this is re-probed in the background: after a read
+# finds it stale, or on a timer while /api/events streams are open. Requests
+# only ever read the cached result; an idle box never forks systemctl.
+HEALTH_TTL = 2.0
+# Minimum spacing between volume changes sent to shairport-sync; slider
+# requests arriving faster than this collapse into the latest target.
+VOLUME_INTERVAL = float(os.environ.get("AIRPLAY_VOLUME_INTERVAL_MS", "150")) / 1000
+# airplay-nowplaying names cached covers by content hash, so a /cover/<name>
+# URL can never change meaning and is served as immutable.
+_COVER_NAME = re.compile(r"[0-9a-f]{64}\.(?:jpg|png|bin)")
+# Cover bytes kept in memory by the response cache (revalidated by stat).
+RESPONSE_CACHE_BYTES = int(os.environ.get("AIRPLAY_DASHBOARD_CACHE_BYTES", str(16 * 1024 * 1024)))
+_GZIP_MIN = 256
+# Widths (px) of the cover derivatives; /cover?size=N gets the smallest
+# bucket >= N. The card is at most 420 CSS px, so 640/1024 cover hi-dpi.
+THUMB_SIZES = (160, 320, 640, 1024)
+# Where the derivatives are written: a directory the dashboard owns (its
+# RuntimeDirectory under systemd), since covers/ belongs to airplay-nowplaying.
+# Empty = next to the originals.
+THUMB_DIR = os.environ.get("AIRPLAY_THUMB_DIR", "")
+_THUMB_NAME = re.compile(r"([0-9a-f]{64})\.w\d+\.jpg")
+_COMPRESSIBLE = ("text/", "application/json")
 
 _BUS = ["busctl", "--system", "call", "org.gnome.ShairportSync", "/org/gnome/ShairportSync"]
 SVC_IFACE = "org.gnome.ShairportSync"
+SVC_PATH = "/org/gnome/ShairportSync"
+SYSTEM_BUS = os.environ.get("DBUS_SYSTEM_BUS_ADDRESS", "unix:path=/run/dbus/system_bus_socket")
+# airplay-nowplaying's counters, appended to /metrics.
+NOWPLAYING_METRICS = os.path.join(STATE_DIR, "metrics.prom")
+
+
+# --- metrics -----------------------------------------------------------------
+# Request threads, the executor and the monitors all record into it.
+# _labels, _num and Metrics are copied from airplay_nowplaying.py (each script
+# is deployed standalone, so they cannot share a module): keep them in sync,
+# except for Metrics.dump, which only airplay-nowplaying needs.
+
+_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    esc = (lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in sorted(labels.items())) + "}"
+
+
+def _num(value) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metrics:
+    """Counters, gauges and histograms keyed by name and labels, rendered in
+    the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}    # name -> (type, help)
+        self._values = {}   # (name, labels) -> float
+        self._hists = {}    # (name, labels) -> [bucket counts..., sum, count]
+        self._buckets = {}  # name -> bucket bounds
+
+    def describe(self, name: str, kind: str, text: str, buckets=_LATENCY_BUCKETS) -> None:
+        self._types[name] = (kind, text)
+        if kind == "histogram":
+            self._buckets[name] = tuple(buckets)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._values[(name, _labels(labels))] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, _labels(labels))
+        bounds = self._buckets[name]
+        with self._lock:
+            hist = self._hists.get(key)
+            if hist is None:
+                hist = self._hists[key] = [0] * (len(bounds) + 2)
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, text) in self._types.items():
+                lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+                if kind != "histogram":
+                    lines += [f"{n}{lab} {_num(v)}" for (n, lab), v in self._values.items() if n == name]
+                    continue
+                bounds = self._buckets[name]
+                for (n, lab), hist in self._hists.items():
+                    if n != name:
+                        continue
+                    inner = lab[1:-1] + "," if lab else ""
+                    for bound, count in zip(bounds, hist):
+                        lines.append(f'{name}_bucket{{{inner}le="{bound:g}"}} {count}')
+                    lines += [f'{name}_bucket{{{inner}le="+Inf"}} {hist[-1]}',
+                              f"{name}_sum{lab} {_num(hist[-2])}", f"{name}_count{lab} {hist[-1]}"]
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+METRICS.describe("airplay_dashboard_request_seconds", "histogram", "Time to build a response, by route.")
+METRICS.describe("airplay_dashboard_requests_total", "counter", "Responses, by route and status.")
+METRICS.describe("airplay_dashboard_bus_call_seconds", "histogram",
+                 "shairport-sync control calls, by member and transport (dbus or busctl).")
+METRICS.describe("airplay_dashboard_subprocess_seconds", "histogram", "Child process run time, by command.")
+METRICS.describe("airplay_dashboard_event_streams", "gauge", "Open /api/events streams.")
+METRICS.describe("airplay_dashboard_connections", "gauge", "Open connections (async server).")
+METRICS.describe("airplay_dashboard_volume_errors_total", "counter",
+                 "Volume applies that raised (the actuator thread carries on).")
 
 
 def percent_to_db(percent: int) -> float:
@@ -48,46 +199,603 @@ def disconnect_cmd() -> list:
 
 
 def _run(cmd) -> bool:
+    t0 = time.perf_counter()
     try:
         return subprocess.run(cmd, capture_output=True, timeout=5).returncode == 0
     except (OSError, subprocess.SubprocessError):
         return False
+    finally:
+        METRICS.observe("airplay_dashboard_subprocess_seconds", time.perf_counter() - t0,
+                        command=os.path.basename(cmd[0]))
+
+
+# --- minimal D-Bus wire client ------------------------------------------------
+# Enough of the protocol to make method calls on the system bus over one
+# long-lived AF_UNIX connection: SASL EXTERNAL auth, Hello, little-endian
+# marshalling of the few argument types the controls need, and matching the
+# reply by serial (signals and stray replies are skipped).
+
+DBUS_CALL, DBUS_RETURN, DBUS_ERROR, DBUS_SIGNAL = 1, 2, 3, 4
+# header field codes
+F_PATH, F_INTERFACE, F_MEMBER, F_ERROR_NAME, F_REPLY_SERIAL, F_DESTINATION, F_SENDER, F_SIGNATURE = range(1, 9)
+
+
+class DBusError(Exception):
+    """The peer answered with an error reply (e.g. ServiceUnknown while
+    shairport is restarting). The connection itself is still good."""
+
+    def __init__(self, name: str, message: str = ""):
+        super().__init__(f"{name}: {message}" if message else name)
+        self.name = name
+
+
+def _pad(buf: bytearray, n: int) -> None:
+    buf += b"\0" * (-len(buf) % n)
+
+
+def _marshal(msg_type: int, serial: int, fields, signature: str = "", args=()) -> bytes:
+    """Encode one message. fields: (code, 's'|'o'|'g'|'u', value) tuples."""
+    body = bytearray()
+    for code, value in zip(signature, args):
+        if code == "d":
+            _pad(body, 8)
+            body += struct.pack("<d", value)
+        elif code in "ub":
+            _pad(body, 4)
+            body += struct.pack("<I", int(value))
+        elif code in "so":
+            _pad(body, 4)
+            raw = value.encode()
+            body += struct.pack("<I", len(raw)) + raw + b"\0"
+        else:
+            raise ValueError(f"unsupported D-Bus type {code!r}")
+    fields = list(fields)
+    if signature:
+        fields.append((F_SIGNATURE, "g", signature))
+    # the field array starts at offset 16, so 8-alignment within it matches
+    # alignment within the message
+    arr = bytearray()
+    for code, sig, value in fields:
+        _pad(arr, 8)
+        arr += bytes((code, 1)) + sig.encode() + b"\0"
+        if sig == "u":
+            _pad(arr, 4)
+            arr += struct.pack("<I", value)
+        elif sig == "g":
+            arr += bytes((len(value),)) + value.encode() + b"\0"
+        else:
+            raw = value.encode()
+            _pad(arr, 4)
+            arr += struct.pack("<I", len(raw)) + raw + b"\0"
+    msg = bytearray(struct.pack("<cBBBIII", b"l", msg_type, 0, 1, len(body), serial, len(arr)))
+    msg += arr
+    _pad(msg, 8)
+    return bytes(msg + body)
+
+
+def _message_length(head: bytes) -> int:
+    """Total message size from its first 16 bytes."""
+    endian = "<" if head[:1] == b"l" else ">"
+    body_len, _serial, fields_len = struct.unpack_from(endian + "III", head, 4)
+    return 16 + fields_len + (-(16 + fields_len) % 8) + body_len
+
+
+def _parse(data: bytes):
+    """-> (type, serial, {field code: value}, body offset, endian)."""
+    endian = "<" if data[:1] == b"l" else ">"
+    msg_type = data[1]
+    _body_len, serial, fields_len = struct.unpack_from(endian + "III", data, 4)
+    fields, pos, end = {}, 16, 16 + fields_len
+    while pos < end:
+        pos += -pos % 8
+        code, siglen = data[pos], data[pos + 1]
+        sig = data[pos + 2:pos + 2 + siglen].decode()
+        pos += 3 + siglen
+        if sig in ("s", "o"):
+            pos += -pos % 4
+            (n,) = struct.unpack_from(endian + "I", data, pos)
+            fields[code] = data[pos + 4:pos + 4 + n].decode("utf-8", "replace")
+            pos += 5 + n
+        elif sig == "g":
+            n = data[pos]
+            fields[code] = data[pos + 1:pos + 1 + n].decode()
+            pos += 2 + n
+        elif sig == "u":
+            pos += -pos % 4
+            (fields[code],) = struct.unpack_from(endian + "I", data, pos)
+            pos += 4
+        else:
+            break  # a field type we never need; the ones before it are enough
+    return msg_type, serial, fields, end + (-end % 8), endian
+
+
+def _bus_address(address: str) -> str:
+    """Socket path from a D-Bus address ('unix:path=...' or 'unix:abstract=...')."""
+    for part in address.split(";"):
+        if part.startswith("unix:"):
+            kv = dict(p.split("=", 1) for p in part[5:].split(",") if "=" in p)
+            if "path" in kv:
+                return kv["path"]
+            if "abstract" in kv:
+                return "\0" + kv["abstract"]
+    raise ValueError(f"no unix socket in D-Bus address {address!r}")
+
+
+class DBusClient:
+    """One persistent, lazily-opened system-bus connection for method calls.
+
+    Calls are serialised by a lock (the HTTP server is threaded). A broken
+    connection (bus restarted, socket error, timeout) is reopened and the
+    call retried once; error replies raise DBusError without reconnecting.
+    """
+
+    def __init__(self, address: str = SYSTEM_BUS, timeout: float = 5.0):
+        self.address = address
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._sock = None
+        self._rbuf = b""
+        self._serial = 0
+        self.connects = 0
+
+    def call(self, dest: str, path: str, iface: str, member: str,
+             signature: str = "", args=()):
+        with self._lock:
+            for attempt in (0, 1):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    return self._call(dest, path, iface, member, signature, args)
+                except OSError:
+                    self.close()
+                    if attempt:
+                        raise
+
+    def close(self) -> None:
+        if self._sock is not None:
+            self._sock.close()
+        self._sock, self._rbuf = None, b""
+
+    def _connect(self) -> None:
+        path = _bus_address(self.address)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        self._sock, self._rbuf = sock, b""
+        sock.connect(path)
+        uid = str(os.getuid()).encode().hex().encode()
+        sock.sendall(b"\0AUTH EXTERNAL " + uid + b"\r\n")
+        if not self._readline().startswith(b"OK "):
+            raise ConnectionRefusedError("D-Bus authentication rejected")
+        sock.sendall(b"BEGIN\r\n")
+        self._call("org.freedesktop.DBus", "/org/freedesktop/DBus",
+                   "org.freedesktop.DBus", "Hello")
+        self.connects += 1
+
+    def _call(self, dest, path, iface, member, signature="", args=()):
+        self._serial += 1
+        serial = self._serial
+        self._sock.sendall(_marshal(DBUS_CALL, serial, [
+            (F_PATH, "o", path), (F_DESTINATION, "s", dest),
+            (F_INTERFACE, "s", iface), (F_MEMBER, "s", member)], signature, args))
+        while True:
+            data = self._recv_message()
+            msg_type, _serial, fields, body, endian = _parse(data)
+            if msg_type not in (DBUS_RETURN, DBUS_ERROR) or fields.get(F_REPLY_SERIAL) != serial:
+                continue  # NameAcquired and other signals
+            if msg_type == DBUS_ERROR:
+                message = ""
+                if fields.get(F_SIGNATURE, "").startswith("s"):
+                    (n,) = struct.unpack_from(endian + "I", data, body)
+                    message = data[body + 4:body + 4 + n].decode("utf-8", "replace")
+                raise DBusError(fields.get(F_ERROR_NAME, "unknown"), message)
+            return data[body:]
+
+    def _recv(self, n: int) -> bytes:
+        while len(self._rbuf) < n:
+            chunk = self._sock.recv(65536)
+            if not chunk:
+                raise ConnectionResetError("D-Bus connection closed")
+            self._rbuf += chunk
+        data, self._rbuf = self._rbuf[:n], self._rbuf[n:]
+        return data
+
+    def _readline(self) -> bytes:
+        while b"\r\n" not in self._rbuf:
+            chunk = self._sock.recv(512)
+            if not chunk:
+                raise ConnectionResetError("D-Bus connection closed")
+            self._rbuf += chunk
+        line, self._rbuf = self._rbuf.split(b"\r\n", 1)
+        return line
+
+    def _recv_message(self) -> bytes:
+        head = self._recv(16)
+        return head + self._recv(_message_length(head) - 16)
+
+
+BUS = DBusClient()
+
+
+def _bus_call(iface: str, member: str, signature: str, args, fallback) -> bool:
+    """Call shairport over the shared bus connection; if the bus itself is
+    unreachable, fall back to one busctl run."""
+    t0 = time.perf_counter()
+    transport = "dbus"
+    try:
+        BUS.call(SVC_IFACE, SVC_PATH, iface, member, signature, args)
+        ok = True
+    except DBusError:
+        ok = False
+    except (OSError, ValueError):
+        t0, transport = time.perf_counter(), "busctl"  # time the fallback alone
+        ok = _run(fallback)
+    METRICS.observe("airplay_dashboard_bus_call_seconds", time.perf_counter() - t0,
+                    member=member, transport=transport)
+    return ok
 
 
 def set_volume(percent: int) -> bool:
-    return _run(volume_cmd(percent))
+    return _bus_call(SVC_IFACE + ".RemoteControl", "SetAirplayVolume", "d",
+                     (percent_to_db(percent),), volume_cmd(percent))
 
 
 def disconnect() -> bool:
-    return _run(disconnect_cmd())
+    return _bus_call(SVC_IFACE, "DropSession", "", (), disconnect_cmd())
 
 
-def service_active(name: str) -> bool:
+def units_active(units) -> dict:
+    """Active state of several units from one `systemctl is-active` call
+    (it prints one state per unit, in order)."""
+    t0 = time.perf_counter()
     try:
-        out = subprocess.run(["systemctl", "is-active", name],
+        out = subprocess.run(["systemctl", "is-active", *units],
                              capture_output=True, text=True, timeout=5).stdout
-        return out.strip() == "active"
     except (OSError, subprocess.SubprocessError):
-        return False
+        out = ""
+    METRICS.observe("airplay_dashboard_subprocess_seconds", time.perf_counter() - t0,
+                    command="systemctl")
+    states = out.split()
+    return {u: i < len(states) and states[i] == "active" for i, u in enumerate(units)}
+
+
+def service_active(name: str) -> bool:
+    return units_active([name])[name]
+
+
+class HealthMonitor:
+    """Keeps the SERVICES' active states in memory.
+
+    get() is a plain in-memory read, so request handlers never fork; one that
+    finds the states older than `ttl` wakes the background thread to re-probe
+    (a single batched systemctl call). While `watched()` is true (open event
+    streams, which are only told about changes) the thread also re-probes
+    every `ttl` on its own. Subscribers are notified when anything changed.
+    """
+
+    def __init__(self, units=SERVICES, ttl: float = HEALTH_TTL, probe=None, watched=None):
+        self.units = tuple(units)
+        self.ttl = ttl
+        self._probe = probe or units_active
+        self._watched = watched or (lambda: False)
+        self._lock = threading.Lock()
+        self._stale = threading.Event()
+        self._states = {u: False for u in self.units}
+        self._subscribers = []
+        self.refreshed = 0.0  # monotonic time of the last probe
+
+    def get(self) -> dict:
+        """The cached states; schedules a re-probe when they are stale."""
+        with self._lock:
+            states = dict(self._states)
+            stale = time.monotonic() - self.refreshed >= self.ttl
+        if stale:
+            self._stale.set()
+        return states
+
+    def subscribe(self, callback) -> None:
+        """callback(states) runs on the monitor thread after every change."""
+        self._subscribers.append(callback)
+
+    def refresh(self) -> bool:
+        states = self._probe(self.units)
+        with self._lock:
+            changed = states != self._states
+            self._states = states
+            self.refreshed = time.monotonic()
+        if changed:
+            for callback in self._subscribers:
+                callback(dict(states))
+        return changed
+
+    def start(self) -> "HealthMonitor":
+        self.refresh()  # first answer before the server accepts requests
+        threading.Thread(target=self._run, name="health", daemon=True).start()
+        return self
+
+    def _run(self):  # pragma: no cover - background loop
+        while True:
+            self.step(self.ttl)
+
+    def step(self, timeout: float) -> bool:
+        """Wait up to `timeout` for a stale read; re-probe if there was one or
+        if someone is watching. True when a probe ran."""
+        if not self._stale.wait(timeout) and not self._watched():
+            return False
+        self._stale.clear()
+        self.refresh()
+        return True
+
+
+def _idle_state() -> dict:
+    return {"active": False, "title": "", "artist": "", "album": "",
+            "volume_percent": 0, "muted": False, "cover": None,
+            "duration": None, "position": None, "position_at": None, "paused": False}
+
+
+class StateCache:
+    """nowplaying.json, parsed once per version of the file.
+
+    airplay-nowplaying replaces the file with os.replace, so every write is a
+    new inode: (st_ino, st_mtime_ns, st_size) identifies a version and a hit
+    costs one stat. get() returns the same dict until the file changes;
+    callers must not modify it.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._key = None
+        self._state = None
+        self.loads = 0
+
+    def get(self) -> dict:
+        path = self.path or STATE_FILE
+        try:
+            st = os.stat(path)
+            key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            key = None
+        with self._lock:
+            if self._state is not None and key == self._key:
+                return self._state
+        state = key = None
+        try:
+            with open(path, "rb") as fh:
+                st = os.fstat(fh.fileno())  # the version actually read
+                key = (st.st_ino, st.st_mtime_ns, st.st_size)
+                state = json.loads(fh.read())
+        except (OSError, ValueError):
+            pass
+        if not isinstance(state, dict):
+            state = _idle_state()
+        with self._lock:
+            self._key, self._state = key, state
+            self.loads += 1
+        return state
+
+
+STATE = StateCache()
 
 
 def read_state() -> dict:
-    try:
-        with open(STATE_FILE, encoding="utf-8") as fh:
-            return json.load(fh)
-    except (OSError, ValueError):
-        return {"active": False, "title": "", "artist": "", "album": "",
-                "volume_percent": 0, "muted": False, "cover": None}
+    return STATE.get()
+
+
+class VolumeActuator:
+    """Single writer for the AirPlay volume.
+
+    request() only records the target and returns; one worker thread applies
+    the latest target at most once per `interval`, so a dragged slider costs
+    a handful of D-Bus calls instead of one per event, and the calls can never
+    land out of order. A target that matches what airplay-nowplaying reports
+    is skipped -- except right after an apply: the reported volume lags until
+    shairport echoes pvol back, so until it changes the target is compared
+    with the value last applied instead. A failed call records nothing, so
+    the same target is tried again on the next request.
+    """
+
+    def __init__(self, apply=None, current=None, interval: float = VOLUME_INTERVAL):
+        self.interval = interval
+        self._apply = apply or set_volume
+        self._current = current or read_state
+        self._cond = threading.Condition()
+        self._target = None
+        self._last = float("-inf")  # monotonic time of the last apply
+        self._sent = None  # percent of the last successful apply...
+        self._seen = None  # ...and the reported (volume, muted) at the time
+        self.applied = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def request(self, percent: int) -> int:
+        """Queue `percent` (clamped to 0..100) as the new target."""
+        percent = max(0, min(100, int(percent)))
+        with self._cond:
+            self._target = percent
+            self._cond.notify()
+        return percent
+
+    def step(self) -> bool:
+        """Apply the pending target, if any; True when a call was made."""
+        with self._cond:
+            percent, self._target = self._target, None
+        if percent is None:
+            return False
+        state = self._current()
+        reported = (state.get("volume_percent"), bool(state.get("muted")))
+        if self._sent is not None and reported == self._seen:
+            noop = percent == self._sent  # echo still pending
+        else:
+            self._sent = None  # the report moved on: it is current again
+            noop = reported == (percent, percent == 0)
+        if noop:
+            self.skipped += 1
+            return False
+        self._last = time.monotonic()
+        if not self._apply(percent):
+            self.failed += 1
+            self._sent = None
+            return True
+        self._sent, self._seen = percent, reported
+        self.applied += 1
+        return True
+
+    def start(self) -> "VolumeActuator":
+        threading.Thread(target=self._run, name="volume", daemon=True).start()
+        return self
+
+    def _run(self):  # pragma: no cover - background loop
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._target is not None)
+            delay = self._last + self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)  # later requests replace the target meanwhile
+            self.safe_step()
 
+    def safe_step(self) -> bool:
+        """step() for the worker thread: an error is counted and logged, and
+        volume control carries on with the next request."""
+        try:
+            return self.step()
+        except Exception as exc:  # noqa: BLE001 - the only volume writer must survive
+            self.failed += 1
+            METRICS.inc("airplay_dashboard_volume_errors_total")
+            print(f"airplay-dashboard: volume change failed: {exc!r}", file=sys.stderr)
+            return False
 
-def build_status() -> dict:
+
+def cover_path(name: str):
+    """File for a /cover/<name> request, or None (bad name / evicted)."""
+    if not _COVER_NAME.fullmatch(name):
+        return None
+    fp = os.path.join(COVER_DIR, name)
+    return fp if os.path.isfile(fp) else None
+
+
+def cover_type(name: str) -> str:
+    return "image/png" if name.endswith(".png") else "image/jpeg"
+
+
+def build_status(health: HealthMonitor | None = None) -> dict:
     return {
         "name": NAME,
         "nowplaying": read_state(),
-        "services": {s: service_active(s) for s in ("shairport-sync", "nqptp", "avahi-daemon")},
+        "services": health.get() if health else {s: service_active(s) for s in SERVICES},
     }
 
 
+class StatusHub:
+    """One shared change source for every /api/events stream.
+
+    A single background thread follows airplay-nowplaying's push socket
+    (falling back to re-reading nowplaying.json every `interval` while the
+    socket is down); service health is pushed in with update(services=...),
+    normally by a HealthMonitor subscription. Each change bumps `version` and
+    pre-encodes one SSE event that all waiting streams send as-is, so open
+    pages cost nothing per client beyond the write.
+    """
+
+    def __init__(self, sock_path: str | None = None, interval: float = EVENTS_INTERVAL,
+                 max_clients: int | None = None):
+        self.sock_path = sock_path or STATE_SOCKET
+        self.interval = interval
+        self.max_clients = MAX_EVENT_CLIENTS if max_clients is None else max_clients
+        self.clients = 0
+        self._cond = threading.Condition()
+        self.version = 0
+        self._nowplaying = read_state()
+        self._services = {}
+        self._event = b""
+        self._watchers = []
+        self._encode()
+
+    def start(self) -> "StatusHub":
+        threading.Thread(target=self._run, name="status-hub", daemon=True).start()
+        return self
+
+    def wait(self, version, timeout: float):
+        """Block until the status differs from `version` (or timeout);
+        returns (version, encoded event)."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version, timeout)
+            return self.version, self._event
+
+    def watch(self, callback) -> None:
+        """callback() runs (on the updating thread) after every change; for
+        waiters that cannot block on the condition, like the async server."""
+        self._watchers.append(callback)
+
+    def join(self) -> bool:
+        with self._cond:
+            if self.clients >= self.max_clients:
+                return False
+            self.clients += 1
+            return True
+
+    def leave(self) -> None:
+        with self._cond:
+            self.clients -= 1
+
+    def update(self, nowplaying: dict | None = None, services: dict | None = None) -> bool:
+        cover = (nowplaying or {}).get("cover")
+        if cover:  # have the derivatives ready before the pages ask for them
+            THUMBS.schedule(os.path.basename(cover))
+        with self._cond:
+            np_new = self._nowplaying if nowplaying is None else nowplaying
+            svc_new = self._services if services is None else services
+            if (np_new, svc_new) == (self._nowplaying, self._services):
+                return False
+            self._nowplaying, self._services = np_new, svc_new
+            self._encode()
+            self.version += 1
+            self._cond.notify_all()
+        for callback in self._watchers:
+            callback()
+        return True
+
+    def _encode(self) -> None:
+        status = {"name": NAME, "nowplaying": self._nowplaying, "services": self._services}
+        self._event = b"data: " + json.dumps(status).encode() + b"\n\n"
+
+    def apply(self, line: bytes) -> None:
+        """Apply one snapshot/delta line from the nowplaying socket."""
+        try:
+            msg = json.loads(line)
+        except ValueError:
+            return
+        if msg.get("type") == "snapshot":
+            self.update(nowplaying=msg.get("state") or {})
+        elif msg.get("type") == "delta":
+            self.update(nowplaying={**self._nowplaying, **msg.get("changes", {})})
+
+    def _run(self):  # pragma: no cover - background loop
+        while True:
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.settimeout(self.interval)
+                    sock.connect(self.sock_path)
+                    self._follow(sock)
+            except OSError:
+                pass
+            # no push channel (reader restarting): poll the snapshot until it is back
+            self.update(nowplaying=read_state())
+            time.sleep(self.interval)
+
+    def _follow(self, sock) -> None:
+        buf = b""
+        while True:
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                continue
+            if not data:
+                return
+            *lines, buf = (buf + data).split(b"\n")
+            for line in lines:
+                self.apply(line)
+
+
 PAGE = """<!doctype html><html lang=en><head><meta charset=utf-8>
 <meta name=viewport content="width=device-width,initial-scale=1">
 <title>__NAME__ · AirPlay</title><style>
@@ -105,6 +813,10 @@ display:flex;align-items:center;justify-content:center;color:#555;font-size:40px
 .title{font-size:20px;font-weight:700;margin:16px 0 2px}
 .meta{color:#a6a8ad;font-size:14px;min-height:20px}
 .idle{color:#6a6c72;text-align:center;padding:30px 0;font-size:15px}
+.prog{margin-top:12px}.bar{height:4px;border-radius:2px;background:#2a2d36;overflow:hidden}
+.bar div{height:100%;width:0;background:#e8e8ea}
+.times{display:flex;justify-content:space-between;font-size:12px;color:#a6a8ad;
+font-variant-numeric:tabular-nums;margin-top:4px}
 .vol{display:flex;align-items:center;gap:10px;margin-top:18px}
 .vol input{flex:1}.vbadge{font-variant-numeric:tabular-nums;width:42px;text-align:right;color:#a6a8ad}
 button{width:100%;margin-top:14px;padding:11px;border:0;border-radius:10px;
@@ -114,83 +826,681 @@ background:#2a2d36;color:#e8e8ea;font-size:14px;cursor:pointer}button:active{bac
 <div class=hdr><h1 id=name>__NAME__</h1><span id=state class=meta></span></div>
 <div class=art id=art>♪</div>
 <div id=np><div class=title id=title></div><div class=meta id=artist></div>
-<div class=meta id=album></div></div>
+<div class=meta id=album></div>
+<div class=prog id=prog style=display:none><div class=bar><div id=fill></div></div>
+<div class=times><span id=pos></span><span id=dur></span></div></div></div>
 <div class=vol><span>🔈</span><input type=range min=0 max=100 id=vol>
 <span class=vbadge id=vbadge>–</span></div>
 <button id=disc>Disconnect session</button>
 <div class=svc id=svc></div></div><script>
 let dragging=false;const $=id=>document.getElementById(id);
-const vol=$('vol');vol.oninput=()=>{dragging=true;$('vbadge').textContent=vol.value+'%'};
-vol.onchange=async()=>{await fetch('/api/volume',{method:'POST',
+const vol=$('vol');const setVol=()=>fetch('/api/volume',{method:'POST',
  headers:{'content-type':'application/json'},body:JSON.stringify({percent:+vol.value})});
- setTimeout(()=>dragging=false,800)};
+vol.oninput=()=>{dragging=true;$('vbadge').textContent=vol.value+'%';setVol()};
+vol.onchange=async()=>{await setVol();setTimeout(()=>dragging=false,800)};
 $('disc').onclick=()=>fetch('/api/disconnect',{method:'POST'});
-async function tick(){let s;try{s=await(await fetch('/api/status')).json()}catch(e){return}
- $('name').textContent=s.name;const n=s.nowplaying;
+// progress comes once per track/resume; the bar advances locally from it
+let prog=null;const mmss=t=>`${Math.floor(t/60)}:${String(Math.floor(t%60)).padStart(2,'0')}`;
+function drawProg(){if(!prog||!(prog.duration>0)){$('prog').style.display='none';return}
+ let t=prog.position??0;if(!prog.paused&&prog.position_at)t+=Date.now()/1000-prog.position_at;
+ t=Math.min(Math.max(t,0),prog.duration);$('prog').style.display='';
+ $('fill').style.width=(100*t/prog.duration)+'%';$('pos').textContent=mmss(t);
+ $('dur').textContent=mmss(prog.duration)}
+setInterval(drawProg,500);
+function render(s){$('name').textContent=s.name;const n=s.nowplaying;
  if(n.active&&(n.title||n.artist)){$('np').style.display='';$('idle')&&$('idle').remove();
   $('title').textContent=n.title||'—';$('artist').textContent=n.artist||'';
   $('album').textContent=n.album||'';$('state').textContent='● playing';
-  $('art').style.backgroundImage=n.cover?`url(/cover?${n.updated})`:'';
-  $('art').textContent=n.cover?'':'♪';}
- else{$('title').textContent='';$('artist').textContent='';$('album').textContent='';
+  const px=Math.round(($('art').clientWidth||420)*(devicePixelRatio||1));
+  $('art').style.backgroundImage=n.cover?`url(/cover/${n.cover.split('/').pop()}?size=${px})`:'';
+  $('art').textContent=n.cover?'':'♪';prog=n;}
+ else{prog=null;$('title').textContent='';$('artist').textContent='';$('album').textContent='';
   $('art').style.backgroundImage='';$('art').textContent='♪';$('state').textContent='idle';}
  if(!dragging){vol.value=n.volume_percent;$('vbadge').textContent=(n.muted?'muted':n.volume_percent+'%')}
  $('svc').innerHTML=Object.entries(s.services).map(([k,v])=>
-  `${k.replace('-sync','').replace('-daemon','')} <span class="dot ${v?'ok':'bad'}"></span>`).join('');}
-tick();setInterval(tick,2000);
+  `${k.replace('-sync','').replace('-daemon','')} <span class="dot ${v?'ok':'bad'}"></span>`).join('');
+ drawProg()}
+async function tick(){let s;try{s=await(await fetch('/api/status')).json()}catch(e){return}render(s)}
+function poll(){tick();setInterval(tick,2000)}
+if(window.EventSource){const es=new EventSource('/api/events');
+ es.onmessage=e=>render(JSON.parse(e.data));
+ es.onerror=()=>{if(es.readyState===EventSource.CLOSED)poll()}}
+else poll();
 </script></body></html>"""
 
 
+def thumb_bucket(size: int) -> int:
+    for bucket in THUMB_SIZES:
+        if size <= bucket:
+            return bucket
+    return THUMB_SIZES[-1]
+
+
+def thumb_name(name: str, bucket: int) -> str:
+    return "%s.w%d.jpg" % (name.split(".", 1)[0], bucket)
+
+
+def pil_resize(src: str, dest: str, width: int) -> bool:
+    """Write a `width`-px-wide JPEG of src to dest; False (nothing written)
+    when the original is no wider than that already."""
+    with Image.open(src) as im:
+        if im.width <= width:
+            return False
+        im.draft("RGB", (width, width))  # JPEG: decode at a reduced scale
+        im = im.convert("RGB")
+        im.thumbnail((width, width * 4), Image.LANCZOS)
+        im.save(dest, "JPEG", quality=82, optimize=True, progressive=True)
+    return True
+
+
+class Thumbnailer:
+    """Size-bucketed cover derivatives, made once per cover off the request
+    path and written to THUMB_DIR as <hash>.w<width>.jpg.
+
+    path() never blocks: it returns the derivative when it exists and
+    otherwise queues the cover for the worker thread, so the caller serves
+    the original this once. Buckets at least as wide as the original (or
+    every bucket, if the image cannot be decoded) get no derivative: for those
+    path() returns the original itself. Without an imaging library nothing is
+    queued.
+    Derivatives of covers airplay-nowplaying has evicted are pruned whenever
+    new ones are made, so the directory stays bounded by the cover cache.
+    """
+
+    def __init__(self, sizes=THUMB_SIZES, resize=None, directory: str | None = None,
+                 covers: str | None = None):
+        self.sizes = tuple(sizes)
+        self._resize = resize or (pil_resize if Image is not None else None)
+        self._directory = directory
+        self._covers = covers
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._seen = set()  # covers queued or already processed
+        self._original = {}  # cover -> smallest bucket the original serves as-is
+        self.made = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._resize is not None
+
+    @property
+    def covers(self) -> str:
+        return self._covers or COVER_DIR
+
+    @property
+    def directory(self) -> str:
+        return self._directory or THUMB_DIR or self.covers
+
+    def path(self, name: str, size: int):
+        """File for cover `name` at `size` px: its derivative, the original
+        when that already fits the bucket, or None while one is pending."""
+        bucket = thumb_bucket(size)
+        with self._lock:
+            fits = self._original.get(name)
+        if fits is not None and bucket >= fits:
+            return os.path.join(self.covers, name)
+        fp = os.path.join(self.directory, thumb_name(name, bucket))
+        if os.path.isfile(fp):
+            return fp
+        self.schedule(name)
+        return None
+
+    def schedule(self, name: str) -> bool:
+        if not self.enabled:
+            return False
+        with self._lock:
+            if name in self._seen:
+                return False
+            self._seen.add(name)
+        self._queue.put(name)
+        return True
+
+    def make(self, name: str) -> int:
+        """Write every missing derivative of cover `name`; returns how many."""
+        src = os.path.join(self.covers, name)
+        made = 0
+        fits = None
+        for width in self.sizes:
+            dest = os.path.join(self.directory, thumb_name(name, width))
+            if os.path.exists(dest):
+                continue
+            tmp = dest + ".tmp"
+            try:
+                if not self._resize(src, tmp, width):
+                    fits = width  # original is smaller: it serves every larger bucket
+                    break
+                os.replace(tmp, dest)
+                made += 1
+            except Exception:  # noqa: BLE001 - a bad image must not kill the worker
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+                if os.path.exists(src):
+                    fits = width  # undecodable: never any derivative from here up
+                break
+        if fits is not None:
+            with self._lock:
+                self._original[name] = fits
+        self.made += made
+        if made:
+            self.prune()
+        return made
+
+    def prune(self) -> int:
+        """Delete derivatives whose original is gone; returns how many."""
+        try:
+            with os.scandir(self.covers) as it:
+                live = {entry.name.split(".", 1)[0] for entry in it}
+            with os.scandir(self.directory) as it:
+                names = [entry.name for entry in it]
+        except OSError:
+            return 0
+        removed = 0
+        for name in names:
+            m = _THUMB_NAME.fullmatch(name)
+            if m is None or m.group(1) in live:
+                continue
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            removed += 1
+        with self._lock:  # an evicted cover may come back
+            self._seen = {n for n in self._seen if n.split(".", 1)[0] in live}
+            self._original = {n: w for n, w in self._original.items() if n.split(".", 1)[0] in live}
+        return removed
+
+    def start(self) -> "Thumbnailer":
+        if self.enabled:
+            threading.Thread(target=self._run, name="thumbs", daemon=True).start()
+        return self
+
+    def _run(self):  # pragma: no cover - background loop
+        while True:
+            self.make(self._queue.get())
+
+
+def accepts_gzip(header: str) -> bool:
+    """True when an Accept-Encoding value allows gzip (q=0 refuses it)."""
+    for part in header.split(","):
+        coding, _, params = part.partition(";")
+        if coding.strip().lower() in ("gzip", "*"):
+            q = params.replace(" ", "").lower()
+            if not q.startswith("q="):
+                return True
+            try:
+                return float(q[2:]) > 0
+            except ValueError:
+                return False
+    return False
+
+
+class Entity:
+    """A response body ready to send: validators plus a gzip variant for text,
+    computed once and reused by every request that gets the same bytes."""
+
+    __slots__ = ("body", "gz", "ctype", "etag", "mtime")
+
+    def __init__(self, body: bytes, ctype: str, etag: str | None = None, mtime=None):
+        self.body = body
+        self.ctype = ctype
+        self.etag = etag or '"%s"' % hashlib.sha1(body).hexdigest()[:20]
+        self.mtime = int(time.time() if mtime is None else mtime)
+        self.gz = None
+        if ctype.startswith(_COMPRESSIBLE) and len(body) >= _GZIP_MIN:
+            gz = gzip.compress(body, mtime=0)
+            if len(gz) < len(body):
+                self.gz = gz
+
+    @property
+    def last_modified(self) -> str:
+        return formatdate(self.mtime, usegmt=True)
+
+    def not_modified(self, headers) -> bool:
+        """Conditional GET: If-None-Match wins; If-Modified-Since otherwise."""
+        inm = headers.get("If-None-Match")
+        if inm is not None:
+            tags = {t.strip().removeprefix("W/") for t in inm.split(",")}
+            return "*" in tags or self.etag in tags
+        ims = headers.get("If-Modified-Since")
+        if ims:
+            try:
+                return self.mtime <= parsedate_to_datetime(ims).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+class FileCache:
+    """Entities for files on disk, keyed on path and revalidated by
+    (st_mtime_ns, st_size): a hit costs one stat, not a read. LRU-bounded by
+    total body bytes."""
+
+    def __init__(self, budget: int = RESPONSE_CACHE_BYTES):
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # path -> ((mtime_ns, size), Entity)
+        self._bytes = 0
+        self.reads = 0
+
+    def get(self, fp: str, ctype: str, etag: str | None = None):
+        try:
+            st = os.stat(fp)
+        except OSError:
+            return None
+        key = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            hit = self._items.get(fp)
+            if hit and hit[0] == key:
+                self._items.move_to_end(fp)
+                return hit[1]
+        try:
+            with open(fp, "rb") as fh:
+                body = fh.read()
+        except OSError:
+            return None
+        self.reads += 1
+        entity = Entity(body, ctype, etag, st.st_mtime)
+        with self._lock:
+            old = self._items.pop(fp, None)
+            if old:
+                self._bytes -= len(old[1].body)
+            if len(body) <= self.budget:
+                self._items[fp] = (key, entity)
+                self._bytes += len(body)
+                while self._bytes > self.budget:
+                    _, (_, evicted) = self._items.popitem(last=False)
+                    self._bytes -= len(evicted.body)
+        return entity
+
+
+FILES = FileCache()
+THUMBS = Thumbnailer()
+_page = None
+_status = None  # (snapshot, services, entity) of the last /api/status
+
+
+def page_entity() -> Entity:
+    global _page
+    if _page is None:
+        _page = Entity(PAGE.replace("__NAME__", NAME).encode(), "text/html; charset=utf-8")
+    return _page
+
+
+def status_entity(health: HealthMonitor | None = None) -> Entity:
+    """The /api/status response, serialized only when the snapshot (a new
+    object from STATE whenever the file changed) or the services differ."""
+    global _status
+    status = build_status(health)
+    last = _status
+    if last is not None and last[0] is status["nowplaying"] and last[1] == status["services"]:
+        return last[2]
+    body = json.dumps(status).encode()
+    entity = last[2] if last is not None and last[2].body == body else Entity(body, "application/json")
+    _status = (status["nowplaying"], status["services"], entity)
+    return entity
+
+
+def cover_etag(name: str) -> str:
+    """Covers are content-addressed: the name is the strongest validator (and,
+    unlike mtime, survives the cache touching the file on reuse)."""
+    stem, _, rest = name.partition(".")
+    width = rest.split(".", 1)[0] if rest.startswith("w") else ""
+    return '"%s"' % "-".join(filter(None, (stem[:40], width)))
+
+
+def reply(code: int, body, ctype: str = "application/json", headers=()) -> tuple:
+    """A finished response: (status, content type, body bytes, headers)."""
+    if isinstance(body, str):
+        body = body.encode()
+    return code, ctype, body, list(headers)
+
+
+def entity_reply(entity: Entity, request_headers, headers=()) -> tuple:
+    headers = [("ETag", entity.etag), ("Last-Modified", entity.last_modified), *headers]
+    if entity.gz is not None:
+        headers.append(("Vary", "Accept-Encoding"))
+    if entity.not_modified(request_headers):
+        return 304, None, b"", headers
+    body = entity.body
+    if entity.gz is not None and accepts_gzip(request_headers.get("Accept-Encoding", "")):
+        body = entity.gz
+        headers.append(("Content-Encoding", "gzip"))
+    return 200, entity.ctype, body, headers
+
+
+def cover_reply(name: str, fp: str, query: str, request_headers, cache_control: str) -> tuple:
+    """A cover, or with ?size=N its nearest derivative. While that is still
+    being made the original goes out marked no-cache, so the browser asks
+    again; where none will be (the original fits) the original is final."""
+    try:
+        size = int(parse_qs(query).get("size", ["0"])[0])
+    except ValueError:
+        size = 0
+    if size > 0:
+        thumb = THUMBS.path(name, size)
+        if thumb is None:
+            if THUMBS.enabled:
+                cache_control = "no-cache"
+        elif os.path.basename(thumb) != name:
+            entity = FILES.get(thumb, "image/jpeg", cover_etag(os.path.basename(thumb)))
+            if entity:
+                return entity_reply(entity, request_headers, [("Cache-Control", cache_control)])
+    entity = FILES.get(fp, cover_type(name), cover_etag(name))
+    if entity:
+        return entity_reply(entity, request_headers, [("Cache-Control", cache_control)])
+    return reply(404, b"")
+
+
+def blocking(method: str, path: str) -> bool:
+    """Routes that may fork, talk D-Bus or read a cover from disk; the async
+    server runs these on its executor instead of the event loop."""
+    return method == "POST" or path == "/cover" or path.startswith("/cover/")
+
+
+_ROUTES = frozenset(("/", "/api/status", "/cover", "/metrics", "/api/volume", "/api/disconnect"))
+
+
+def route_label(path: str) -> str:
+    """Bounded metric label for a request path."""
+    if path in _ROUTES:
+        return path
+    return "/cover/*" if path.startswith("/cover/") else "other"
+
+
+def metrics_text(app) -> str:
+    """/metrics: the dashboard's registry plus airplay-nowplaying's file."""
+    hub = getattr(app, "hub", None)
+    METRICS.set("airplay_dashboard_event_streams", hub.clients if hub else 0)
+    METRICS.set("airplay_dashboard_connections", getattr(app, "connections", 0))
+    text = METRICS.render()
+    try:
+        with open(NOWPLAYING_METRICS, encoding="utf-8") as fh:
+            text += fh.read()
+    except OSError:
+        pass  # reader not running (or not yet exported)
+    return text
+
+
+def handle(app, method: str, target: str, headers, body: bytes = b"") -> tuple:
+    """Route one request for either server. `app` carries the shared
+    hub/health/volume objects (any may be missing); /api/events is streamed
+    by the servers themselves."""
+    t0 = time.perf_counter()
+    path, _, query = target.partition("?")
+    response = _route(app, method, path, query, headers, body)
+    label = route_label(path)
+    METRICS.observe("airplay_dashboard_request_seconds", time.perf_counter() - t0, route=label)
+    METRICS.inc("airplay_dashboard_requests_total", route=label, code=response[0])
+    return response
+
+
+def _route(app, method: str, path: str, query: str, headers, body: bytes) -> tuple:
+    if method == "GET":
+        if path == "/metrics":
+            return reply(200, metrics_text(app), "text/plain; version=0.0.4; charset=utf-8")
+        if path == "/":
+            return entity_reply(page_entity(), headers, [("Cache-Control", "no-cache")])
+        if path == "/api/status":
+            return entity_reply(status_entity(getattr(app, "health", None)), headers,
+                                [("Cache-Control", "no-cache")])
+        if path == "/cover":
+            # current cover, whatever it is: must be revalidated every time
+            cover = read_state().get("cover")
+            if not cover:
+                return reply(404, b"")
+            return cover_reply(os.path.basename(cover), os.path.join(STATE_DIR, cover), query,
+                               headers, "no-cache")
+        if path.startswith("/cover/"):
+            name = path[len("/cover/"):]
+            fp = cover_path(name)
+            if not fp:
+                return reply(404, b"")
+            return cover_reply(name, fp, query, headers, "public, max-age=31536000, immutable")
+    elif method == "POST":
+        if path == "/api/volume":
+            try:
+                pct = int(json.loads(body or b"{}").get("percent", 0))
+            except (ValueError, TypeError, AttributeError):
+                return reply(400, json.dumps({"ok": False}))
+            volume = getattr(app, "volume", None)
+            if volume is None:
+                return reply(200, json.dumps({"ok": set_volume(pct)}))
+            return reply(200, json.dumps({"ok": True, "target": volume.request(pct)}))
+        if path == "/api/disconnect":
+            return reply(200, json.dumps({"ok": disconnect()}))
+    return reply(404, b"not found", "text/plain")
+
+
 class Handler(BaseHTTPRequestHandler):
     def log_message(self, *a):  # quiet
         pass
 
-    def _send(self, code, body, ctype="application/json"):
-        if isinstance(body, str):
-            body = body.encode()
+    def _reply(self, code, ctype, body, headers):
         self.send_response(code)
-        self.send_header("Content-Type", ctype)
-        self.send_header("Content-Length", str(len(body)))
+        if code != 304:
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+        for k, v in headers:
+            self.send_header(k, v)
         self.end_headers()
         self.wfile.write(body)
 
     def do_GET(self):
-        path = self.path.split("?", 1)[0]
-        if path == "/":
-            self._send(200, PAGE.replace("__NAME__", NAME), "text/html; charset=utf-8")
-        elif path == "/api/status":
-            self._send(200, json.dumps(build_status()))
-        elif path == "/cover":
-            cover = read_state().get("cover")
-            fp = os.path.join(STATE_DIR, cover) if cover else None
-            if fp and os.path.isfile(fp):
-                with open(fp, "rb") as fh:
-                    data = fh.read()
-                ctype = "image/png" if cover.endswith(".png") else "image/jpeg"
-                self._send(200, data, ctype)
-            else:
-                self._send(404, b"")
+        if self.path.split("?", 1)[0] == "/api/events":
+            self._events()
         else:
-            self._send(404, b"not found", "text/plain")
+            self._reply(*handle(self.server, "GET", self.path, self.headers))
+
+    def _events(self):
+        """Server-Sent Events: the full status on connect and on every change,
+        a comment line as keep-alive in between."""
+        hub = getattr(self.server, "hub", None)
+        if hub is None or not hub.join():
+            self._reply(*reply(503, b"busy", "text/plain"))
+            return
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            version = None
+            while True:
+                seen, event = hub.wait(version, hub.interval * 3)
+                self.wfile.write(event if seen != version else b": keep-alive\n\n")
+                self.wfile.flush()
+                version = seen
+        except OSError:
+            pass  # client went away
+        finally:
+            hub.leave()
 
     def do_POST(self):
         length = int(self.headers.get("Content-Length", 0))
         raw = self.rfile.read(length) if length else b"{}"
-        if self.path == "/api/volume":
-            try:
-                pct = int(json.loads(raw).get("percent", 0))
-            except (ValueError, TypeError):
-                self._send(400, json.dumps({"ok": False}))
-                return
-            self._send(200, json.dumps({"ok": set_volume(pct)}))
-        elif self.path == "/api/disconnect":
-            self._send(200, json.dumps({"ok": disconnect()}))
-        else:
-            self._send(404, b"not found", "text/plain")
+        self._reply(*handle(self.server, "POST", self.path, self.headers, raw))
+
+
+class RequestHeaders(dict):
+    """Header map for the async server; get() is case-insensitive like the
+    http.server message object handle() normally receives."""
+
+    def get(self, key, default=None):
+        return super().get(key.lower(), default)
+
+
+class AsyncServer:
+    """asyncio server mode: every connection is a coroutine on one event loop,
+    with HTTP/1.1 keep-alive, at most `max_connections` open sockets and
+    `max_inflight` requests being handled at once. Routes are handle()'s;
+    the blocking ones run on a small thread pool, and /api/events streams
+    wake on StatusHub changes instead of holding a thread each.
+    """
+
+    def __init__(self, host: str = BIND, port: int = PORT, max_connections: int = MAX_CONNECTIONS,
+                 max_inflight: int = MAX_INFLIGHT, workers: int = EXECUTOR_WORKERS):
+        self.host, self.port = host, port
+        self.max_connections = max_connections
+        self.max_inflight = max_inflight
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="dashboard")
+        self.hub = self.health = self.volume = None
+        self.connections = 0
+        self.server_port = None
+        self._server = None
+        self._loop = None
+        self._inflight = None
+        self._changed = None
+
+    async def start(self) -> "AsyncServer":
+        self._loop = asyncio.get_running_loop()
+        self._inflight = asyncio.Semaphore(self.max_inflight)
+        self._changed = asyncio.Event()
+        if self.hub is not None:
+            self.hub.watch(lambda: self._loop.call_soon_threadsafe(self._wake))
+        self._server = await asyncio.start_server(self._client, self.host, self.port,
+                                                  limit=MAX_HEADER_BYTES)
+        self.server_port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+        self.executor.shutdown(wait=False)
+
+    def _wake(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _client(self, reader, writer):
+        if self.connections >= self.max_connections:
+            writer.write(self._encode(reply(503, b"busy", "text/plain"), False))
+            writer.close()
+            return
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(_read_request(reader), KEEPALIVE_TIMEOUT)
+                except ValueError:
+                    writer.write(self._encode(reply(400, b"bad request", "text/plain"), False))
+                    break
+                if request is None:
+                    break
+                method, target, keep_alive, headers, body = request
+                path = target.split("?", 1)[0]
+                if method == "GET" and path == "/api/events":
+                    await self._events(writer)
+                    break
+                async with self._inflight:
+                    if blocking(method, path):
+                        response = await self._loop.run_in_executor(
+                            self.executor, handle, self, method, target, headers, body)
+                    else:
+                        response = handle(self, method, target, headers, body)
+                writer.write(self._encode(response, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            pass  # idle, truncated or gone
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    @staticmethod
+    def _encode(response: tuple, keep_alive: bool) -> bytes:
+        code, ctype, body, headers = response
+        lines = ["HTTP/1.1 %d %s" % (code, _REASONS.get(code, "OK"))]
+        if code != 304:
+            lines += ["Content-Type: " + ctype, "Content-Length: %d" % len(body)]
+        lines += ["%s: %s" % kv for kv in headers]
+        lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+    async def _events(self, writer):
+        hub = self.hub
+        if hub is None or not hub.join():
+            writer.write(self._encode(reply(503, b"busy", "text/plain"), False))
+            return
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                         b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n")
+            version = None
+            while True:
+                changed = self._changed  # before looking, so no wake-up is missed
+                seen, event = hub.wait(version, 0)
+                if seen != version:
+                    writer.write(event)
+                    version = seen
+                else:
+                    try:
+                        await asyncio.wait_for(changed.wait(), hub.interval * 3)
+                        continue
+                    except asyncio.TimeoutError:
+                        writer.write(b": keep-alive\n\n")
+                await writer.drain()
+        finally:
+            hub.leave()
+
+
+_REASONS = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found",
+            503: "Service Unavailable"}
+
+
+async def _read_request(reader):
+    """One request off a keep-alive connection: (method, target, keep_alive,
+    headers, body), None on a clean close, ValueError when malformed."""
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise ValueError("bad request line") from None
+    headers = RequestHeaders()
+    for _ in range(100):
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, sep, value = line.decode("latin-1").partition(":")
+        if not sep:
+            raise ValueError("bad header")
+        headers[name.strip().lower()] = value.strip()
+    else:
+        raise ValueError("too many headers")
+    length = int(headers.get("Content-Length", "0") or 0)
+    if length < 0 or length > MAX_BODY_BYTES:
+        raise ValueError("bad length")
+    body = await reader.readexactly(length) if length else b""
+    connection = headers.get("Connection", "").lower()
+    keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+    return method, target, keep_alive, headers, body
+
+
+def _attach(server):
+    """Wire the shared background pieces onto either server."""
+    server.hub = StatusHub()
+    server.health = HealthMonitor(watched=lambda: server.hub.clients > 0)
+    server.volume = VolumeActuator().start()
+    THUMBS.start()
+    server.health.subscribe(lambda states: server.hub.update(services=states))
+    server.hub.update(services=server.health.start().get())
+    server.hub.start()
+    return server
 
 
 def main():  # pragma: no cover - server loop
-    ThreadingHTTPServer((BIND, PORT), Handler).serve_forever()
+    if SERVER_MODE == "async":
+        asyncio.run(_attach(AsyncServer()).serve_forever())
+    else:
+        _attach(ThreadingHTTPServer((BIND, PORT), Handler)).serve_forever()
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -21,15 +21,35 @@ def parse_shairport_version(text: str) -> dict:
     }
 
 
+# The line boundaries str.splitlines() uses.
+_LINE_BREAKS = "\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029"
+_LINE_END = re.compile(f"[{_LINE_BREAKS}]")
+
+
+def _line_end(text: str, pos: int) -> int:
+    """Offset of the end of the line containing pos (identifies the line)."""
+    m = _LINE_END.search(text, pos)
+    return m.start() if m else len(text)
+
+
 def parse_listening_ports(ss_output: str, ports=(319, 320)) -> dict:
-    """From `ss -ulnp`, report which target UDP ports are bound and by nqptp."""
+    """From `ss -ulnp`, report which target UDP ports are bound and by nqptp.
+    One regex scan for all ports over the whole output; lines are only
+    located for the (few) hits."""
     result = {p: {"bound": False, "nqptp": False} for p in ports}
-    for line in ss_output.splitlines():
-        for p in ports:
-            if re.search(rf"[:.]{p}\b", line):
-                result[p]["bound"] = True
-                if "nqptp" in line:
-                    result[p]["nqptp"] = True
+    wanted = {str(p): p for p in ports}
+    if not wanted:
+        return result
+    nqptp, i = set(), ss_output.find("nqptp")
+    while i != -1:
+        i = _line_end(ss_output, i)
+        nqptp.add(i)
+        i = ss_output.find("nqptp", i)
+    for m in re.finditer(r"[:.](%s)\b" % "|".join(wanted), ss_output):
+        p = wanted[m.group(1)]
+        result[p]["bound"] = True
+        if _line_end(ss_output, m.end()) in nqptp:
+            result[p]["nqptp"] = True
     return result
 
 
@@ -49,15 +69,56 @@ def parse_alsa_cards(aplay_l_output: str) -> set:
     return cards
 
 
+# Journal error classes and their keywords (matched on the lowercased text).
+JOURNAL_KEYWORDS = {
+    "xruns": ("underrun", "overrun", "xrun"),
+    "sync": ("lost sync", "resync", "out of sync", "sync error"),
+}
+# Rare substrings to search for instead of every keyword: each keyword
+# contains one of its class's anchors, so four C-level scans cover seven
+# keywords, and a class's keywords are only checked after an anchor hit.
+# ("sync" alone would hit every "shairport-sync" line.)
+_JOURNAL_ANCHORS = (("xruns", "run"), ("sync", " sync"), ("sync", "resync"), ("sync", "sync error"))
+_JOURNAL_TABLE = tuple(
+    (list(JOURNAL_KEYWORDS).index(cls), anchor, tuple(word for word in JOURNAL_KEYWORDS[cls] if anchor in word))
+    for cls, anchor in _JOURNAL_ANCHORS
+)
+
+
+def _classify_lowered(low: str) -> tuple:
+    """One bool per JOURNAL_KEYWORDS class for one lowercased line."""
+    hit = [False] * len(JOURNAL_KEYWORDS)
+    for k, anchor, words in _JOURNAL_TABLE:
+        if not hit[k] and anchor in low:
+            hit[k] = any(word in low for word in words)
+    return tuple(hit)
+
+
+def classify_journal_line(line: str) -> tuple:
+    """(is an xrun, is a sync error) for one journal message."""
+    return _classify_lowered(line.lower())
+
+
 def parse_journal_errors(journal_text: str) -> dict:
-    counts = {"xruns": 0, "sync": 0}
-    for line in journal_text.splitlines():
-        low = line.lower()
-        if "underrun" in low or "overrun" in low or "xrun" in low:
-            counts["xruns"] += 1
-        if "lost sync" in low or "resync" in low or "out of sync" in low or "sync error" in low:
-            counts["sync"] += 1
-    return counts
+    """Lines with an xrun / a sync error, each line counted once per class.
+    The text is lowercased once and searched for the anchors; only the lines
+    they hit are cut out and classified."""
+    low = journal_text.lower()
+    ends = set()
+    for _, anchor, _ in _JOURNAL_TABLE:
+        i = low.find(anchor)
+        while i != -1:
+            i = _line_end(low, i)
+            ends.add(i)  # keyed by line end; the rest of the line is skipped
+            i = low.find(anchor, i)
+    counts, prev = [0] * len(JOURNAL_KEYWORDS), -1
+    for end in sorted(ends):
+        # the line starts after the last break since the previous hit line
+        start = max(prev, *(low.rfind(c, prev + 1, end) for c in _LINE_BREAKS)) + 1
+        for k, hit in enumerate(_classify_lowered(low[start:end])):
+            counts[k] += hit
+        prev = end
+    return dict(zip(JOURNAL_KEYWORDS, counts))
 
 
 def parse_device_id(conf_text: str) -> str:
@@ -72,77 +133,280 @@ def is_zero_device_id(dev_id: str) -> bool:
 
 import argparse
 import json
+import os
 import socket
+import socketserver
 import subprocess
 import sys
-
-
-def _system_runner(name: str) -> str:
+import threading
+import time
+import heapq
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Probes run concurrently; each gets PROBE_TIMEOUT seconds and the whole run
+# RUN_TIMEOUT, so a hung avahi-browse costs one failed check, not the timer.
+PROBE_TIMEOUT = 10.0
+RUN_TIMEOUT = 30.0
+SERVICES = ("shairport-sync", "nqptp", "avahi-daemon")
+# Journal cursor and rolling error counts (see JournalScanner).
+DOCTOR_STATE_DIR = os.environ.get("AIRPLAY_DOCTOR_STATE_DIR", "/var/lib/airplay-doctor")
+JOURNAL_UNIT = "shairport-sync"
+JOURNAL_BOOTSTRAP = 200  # entries read when there is no cursor yet
+RATE_WINDOWS = (("5m", 300), ("1h", 3600), ("24h", 86400))
+PROBES = tuple(f"is_active:{svc}" for svc in SERVICES) + (
+    "shairport_version", "ss", "mdns", "config", "aplay", "journal")
+
+
+def _system_runner(name: str, timeout: float | None = None) -> str:
     """Default runner: maps a probe name to real captured command output."""
     if name.startswith("is_active:"):
         svc = name.split(":", 1)[1]
-        return _capture(["systemctl", "is-active", svc])
+        return _capture(["systemctl", "is-active", svc], timeout)
     cmds = {
         "shairport_version": ["shairport-sync", "-V"],
         "ss": ["ss", "-ulnp"],
         "mdns": ["avahi-browse", "-atp", "--no-db-lookup", "-r", "-l"],
         "aplay": ["aplay", "-L"],
-        "journal": ["journalctl", "-u", "shairport-sync", "-n", "200", "--no-pager"],
     }
+    if name == "journal":
+        return json.dumps(JOURNAL.scan(timeout))
     if name == "config":
         try:
             with open("/etc/shairport-sync.conf", encoding="utf-8") as fh:
                 return fh.read()
         except OSError:
             return ""
-    return _capture(cmds.get(name, ["true"]))
+    return _capture(cmds.get(name, ["true"]), timeout)
 
 
-def _capture(cmd) -> str:
+def _capture(cmd, timeout: float | None = None) -> str:
+    """Command stdout ("" if it is not installed); raises TimeoutError when it
+    outlives `timeout` (default PROBE_TIMEOUT), after killing it."""
     try:
-        return subprocess.run(cmd, capture_output=True, text=True, check=False).stdout
+        return subprocess.run(cmd, capture_output=True, text=True, check=False,
+                              timeout=PROBE_TIMEOUT if timeout is None else timeout).stdout
     except FileNotFoundError:
         return ""
+    except subprocess.TimeoutExpired as exc:
+        raise TimeoutError(f"{cmd[0]} timed out") from exc
+
+
+class JournalScanner:
+    """Incremental reader for the shairport-sync journal.
+
+    Only entries after the saved cursor are read (journalctl -o json
+    --after-cursor), so every run counts exactly the errors that are new
+    since the last one, however many lines arrived in between. Per-minute
+    xrun/sync counts are kept for the longest of RATE_WINDOWS, giving
+    rolling rates. Cursor and counts live in DOCTOR_STATE_DIR/journal.json;
+    if that is not writable every run reads the last JOURNAL_BOOTSTRAP
+    entries, as before.
+    """
+
+    def __init__(self, state_dir: str | None = None, clock=time.time):
+        self.path = os.path.join(state_dir or DOCTOR_STATE_DIR, "journal.json")
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def load(self) -> dict:
+        try:
+            with open(self.path, encoding="utf-8") as fh:
+                state = json.load(fh)
+            if isinstance(state, dict):
+                return state
+        except (OSError, ValueError):
+            pass
+        return {"cursor": None, "minutes": {}}
+
+    def save(self, state: dict) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as fh:
+                json.dump(state, fh)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def command(cursor: str | None) -> list:
+        cmd = ["journalctl", "-u", JOURNAL_UNIT, "-o", "json", "--no-pager"]
+        return cmd + ([f"--after-cursor={cursor}"] if cursor else ["-n", str(JOURNAL_BOOTSTRAP)])
+
+    def scan(self, timeout: float | None = None) -> dict:
+        """Read the new entries, update the saved state, return the summary."""
+        with self._lock:
+            state = self.load()
+            summary = self.ingest(state, self._read(state, timeout))
+            self.save(state)
+        return summary
+
+    def _read(self, state: dict, timeout: float | None) -> str:
+        try:
+            proc = subprocess.run(self.command(state.get("cursor")), capture_output=True, text=True,
+                                  timeout=PROBE_TIMEOUT if timeout is None else timeout)
+        except FileNotFoundError:
+            return ""
+        except subprocess.TimeoutExpired as exc:
+            raise TimeoutError("journalctl timed out") from exc
+        if proc.returncode != 0 and state.get("cursor"):
+            state["cursor"] = None  # cursor rotated/vacuumed away: start over
+            return self._read(state, timeout)
+        return proc.stdout
+
+    def ingest(self, state: dict, text: str) -> dict:
+        """Count `journalctl -o json` lines into state; returns
+        {"new": counts, "windows": {label: counts and per-hour rates}}."""
+        now = self._clock()
+        minutes = state.setdefault("minutes", {})
+        new = {"xruns": 0, "sync": 0}
+        for line in text.splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            state["cursor"] = entry.get("__CURSOR", state.get("cursor"))
+            message = entry.get("MESSAGE")
+            if isinstance(message, list):  # non-UTF-8 messages come as byte arrays
+                message = bytes(message).decode("utf-8", "replace")
+            if not isinstance(message, str):
+                continue
+            xrun, sync = classify_journal_line(message)
+            if not (xrun or sync):
+                continue
+            ts = int(entry.get("__REALTIME_TIMESTAMP", now * 1e6)) / 1e6
+            slot = minutes.setdefault(str(int(ts // 60)), [0, 0])
+            slot[0] += xrun
+            slot[1] += sync
+            new["xruns"] += xrun
+            new["sync"] += sync
+        oldest = int((now - RATE_WINDOWS[-1][1]) // 60)
+        for key in [k for k in minutes if int(k) < oldest]:
+            del minutes[key]
+        windows = {}
+        for label, seconds in RATE_WINDOWS:
+            since = int((now - seconds) // 60)
+            xruns = sum(v[0] for k, v in minutes.items() if int(k) >= since)
+            sync = sum(v[1] for k, v in minutes.items() if int(k) >= since)
+            windows[label] = {"xruns": xruns, "sync": sync,
+                              "xruns_per_hour": round(xruns * 3600 / seconds, 2),
+                              "sync_per_hour": round(sync * 3600 / seconds, 2)}
+        return {"new": new, "windows": windows}
+
+
+def journal_summary(text: str) -> dict:
+    """The journal probe's output: a JournalScanner summary, or (from a
+    plain-text runner) raw journal lines counted over the whole text."""
+    if text.lstrip().startswith("{"):
+        try:
+            summary = json.loads(text)
+            if isinstance(summary, dict) and "new" in summary:
+                return summary
+        except ValueError:
+            pass
+    return {"new": parse_journal_errors(text), "windows": {}}
 
 
 def _check(name, ok, detail=""):
     return {"name": name, "ok": bool(ok), "detail": detail}
 
 
-def build_report(runner, deep: bool = False) -> dict:
+JOURNAL = JournalScanner()
+
+
+def _probe(runner, name: str):
+    t0 = time.monotonic()
+    try:
+        out = runner(name)
+    except TimeoutError:
+        out = None
+    except Exception:  # noqa: BLE001 - a broken probe reads as empty output
+        out = ""
+    return out, time.monotonic() - t0
+
+
+def run_probes(runner, names=PROBES, timeout: float = PROBE_TIMEOUT,
+               total: float = RUN_TIMEOUT) -> dict:
+    """Run every probe concurrently. Returns {name: (output, seconds)};
+    output is None for a probe that timed out (its own limit or the run's)."""
+    start = time.monotonic()
+    deadline = start + total
+    pool = ThreadPoolExecutor(max_workers=len(names), thread_name_prefix="probe")
+    futures = {name: pool.submit(_probe, runner, name) for name in names}
+    results = {}
+    try:
+        for name, fut in futures.items():
+            remaining = min(start + timeout, deadline) - time.monotonic()
+            try:
+                results[name] = fut.result(timeout=max(0.0, remaining))
+            except TimeoutError:
+                results[name] = (None, time.monotonic() - start)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)  # hung probes are abandoned
+    return results
+
+
+def build_report(runner, deep: bool = False, timeout: float = PROBE_TIMEOUT,
+                 total: float = RUN_TIMEOUT) -> dict:
+    started = time.monotonic()
+    report = evaluate(run_probes(runner, PROBES, timeout, total), deep)
+    report["seconds"] = round(time.monotonic() - started, 4)
+    return report
+
+
+def evaluate(results: dict, deep: bool = False) -> dict:
+    """Turn {probe: (output, seconds)} into the report's checks."""
+    out = {name: text for name, (text, _) in results.items()}
+    timed_out = {name for name, text in out.items() if text is None}
     checks = []
-    for svc in ("shairport-sync", "nqptp", "avahi-daemon"):
-        active = runner(f"is_active:{svc}").strip() == "active"
-        checks.append(_check(f"service:{svc}", active, "active" if active else "not active"))
 
-    feats = parse_shairport_version(runner("shairport_version"))
-    checks.append(_check("feature:airplay2", feats["airplay2"], feats["version"]))
-    checks.append(_check("feature:soxr", feats["soxr"]))
+    def check(name, ok, detail="", probes=()):
+        if timed_out.intersection(probes):
+            checks.append(_check(name, False, "timeout"))
+        else:
+            checks.append(_check(name, ok, detail))
+
+    def text(name):
+        return out[name] or ""
+
+    for svc in SERVICES:
+        active = text(f"is_active:{svc}").strip() == "active"
+        check(f"service:{svc}", active, "active" if active else "not active", [f"is_active:{svc}"])
 
-    ports = parse_listening_ports(runner("ss"))
+    feats = parse_shairport_version(text("shairport_version"))
+    check("feature:airplay2", feats["airplay2"], feats["version"], ["shairport_version"])
+    check("feature:soxr", feats["soxr"], probes=["shairport_version"])
+
+    ports = parse_listening_ports(text("ss"))
     nqptp_ports = all(ports[p]["bound"] and ports[p]["nqptp"] for p in (319, 320))
-    checks.append(_check("ports:319/320", nqptp_ports, "owned by nqptp" if nqptp_ports else "not owned"))
+    check("ports:319/320", nqptp_ports, "owned by nqptp" if nqptp_ports else "not owned", ["ss"])
 
-    mdns = parse_mdns(runner("mdns"))
-    checks.append(_check("mdns:airplay", mdns["airplay"]))
-    checks.append(_check("mdns:raop", mdns["raop"]))
+    mdns = parse_mdns(text("mdns"))
+    check("mdns:airplay", mdns["airplay"], probes=["mdns"])
+    check("mdns:raop", mdns["raop"], probes=["mdns"])
 
-    conf = runner("config")
+    conf = text("config")
     dev_id = parse_device_id(conf)
     # device-id is optional in the config: when it is not pinned, shairport-sync
     # derives it from the NIC MAC at runtime (the normal case). Only an
     # explicitly-pinned all-zero id is a real misconfiguration.
     id_ok = (dev_id == "") or (not is_zero_device_id(dev_id))
-    checks.append(_check("identity:device-id", id_ok, dev_id or "derived from MAC (not pinned)"))
+    check("identity:device-id", id_ok, dev_id or "derived from MAC (not pinned)", ["config"])
 
-    cards = parse_alsa_cards(runner("aplay"))
+    cards = parse_alsa_cards(text("aplay"))
     m = re.search(r'output_device\s*=\s*"hw:CARD=([^,"]+)', conf)
     want_card = m.group(1) if m else None
     card_ok = (want_card in cards) if want_card else bool(cards)
-    checks.append(_check("alsa:card", card_ok, want_card or "any"))
+    check("alsa:card", card_ok, want_card or "any", ["aplay", "config"])
 
-    errs = parse_journal_errors(runner("journal"))
-    checks.append(_check("journal:errors", errs["xruns"] == 0 and errs["sync"] == 0, str(errs)))
+    journal = journal_summary(text("journal"))
+    new = journal["new"]
+    detail = f"{new['xruns']} new xruns, {new['sync']} new sync errors"
+    hour = journal["windows"].get("1h")
+    if hour:
+        detail += f" (last hour: {hour['xruns']} xruns, {hour['sync']} sync)"
+    check("journal:errors", new["xruns"] == 0 and new["sync"] == 0, detail, ["journal"])
 
     if deep:
         # opt-in only; opening hw: can disrupt shairport's exclusive access
@@ -154,17 +418,273 @@ def build_report(runner, deep: bool = False) -> dict:
         "device_id": dev_id,
         "mdns": mdns,
         "checks": checks,
+        "journal": journal,
+        "probes": {name: {"seconds": round(secs, 4), "timeout": name in timed_out}
+                   for name, (_, secs) in results.items()},
+    }
+
+
+# --- daemon mode (--serve) -------------------------------------------------
+# Each probe re-runs on its own schedule and the latest report is served from
+# memory over a Unix socket: one request line ("report" or "history"), one
+# JSON reply line. --check asks the daemon first and runs probes itself only
+# when nothing answers.
+
+DOCTOR_SOCKET = os.environ.get("AIRPLAY_DOCTOR_SOCKET", "/run/airplay-doctor/doctor.sock")
+SERVICE_INTERVAL = 30
+PROBE_INTERVALS = {
+    "shairport_version": 3600,
+    "ss": 60,
+    "config": 300,
+    "aplay": 900,
+    "mdns": 900,
+    "journal": 900,
+}
+HISTORY = 256  # status transitions kept
+
+
+def probe_interval(name: str) -> float:
+    if name.startswith("is_active:"):
+        return SERVICE_INTERVAL
+    return PROBE_INTERVALS.get(name, 300)
+
+
+class Doctor:
+    """Probe results with per-probe schedules, the report built from them,
+    and a history of status transitions (when the set of failing checks
+    changed). tick() runs whatever is due, concurrently."""
+
+    def __init__(self, runner, timeout: float = PROBE_TIMEOUT, clock=time.monotonic):
+        self.runner = runner
+        self.timeout = timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._due = {name: 0.0 for name in PROBES}
+        self._ran = {}      # probe -> time.time() of its last run
+        self._results = {}  # probe -> (output, seconds)
+        self._report = None
+        self.history = deque(maxlen=HISTORY)
+
+    def tick(self) -> float:
+        """Run the due probes; returns seconds until the next one is due."""
+        now = self._clock()
+        names = [name for name in PROBES if self._due[name] <= now]
+        if names:
+            fresh = run_probes(self.runner, names, self.timeout, self.timeout)
+            report = None
+            with self._lock:
+                self._results.update(fresh)
+                for name in names:
+                    self._due[name] = now + probe_interval(name)
+                    self._ran[name] = time.time()
+                report = evaluate(self._results)
+                failed = sorted(c["name"] for c in report["checks"] if not c["ok"])
+                if not self.history or self.history[-1]["failed"] != failed:
+                    self.history.append({"at": time.time(), "ok": report["ok"], "failed": failed})
+                self._report = report
+        return max(0.0, min(self._due.values()) - self._clock())
+
+    def report(self):
+        """The latest report with each probe's age, or None before the first tick."""
+        with self._lock:
+            if self._report is None:
+                return None
+            report = json.loads(json.dumps(self._report))
+            now = time.time()
+        for name, probe in report["probes"].items():
+            probe["age"] = round(now - self._ran[name], 1)
+        report["source"] = "daemon"
+        return report
+
+    def run_forever(self):  # pragma: no cover - scheduler loop
+        while True:
+            time.sleep(self.tick())
+
+
+class _DoctorRequest(socketserver.StreamRequestHandler):
+    def handle(self):
+        command = self.rfile.readline(64).strip().decode("ascii", "replace") or "report"
+        doctor = self.server.doctor
+        if command == "history":
+            reply = list(doctor.history)
+        elif command == "report":
+            reply = doctor.report()
+        else:
+            reply = {"error": f"unknown command {command!r}"}
+        self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+
+def serve(doctor: Doctor, path: str | None = None):
+    """Bind the doctor's Unix socket; call serve_forever() on the result."""
+    path = path or DOCTOR_SOCKET
+    try:
+        os.unlink(path)  # stale socket from a previous run
+    except FileNotFoundError:
+        pass
+    server = socketserver.ThreadingUnixStreamServer(path, _DoctorRequest)
+    server.daemon_threads = True
+    server.doctor = doctor
+    return server
+
+
+def query_daemon(command: str = "report", path: str | None = None, timeout: float = 2.0):
+    """Ask a running --serve daemon; None when there is none (or it has no
+    report yet)."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path or DOCTOR_SOCKET)
+            sock.sendall(command.encode() + b"\n")
+            data = b""
+            while not data.endswith(b"\n"):
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        return json.loads(data)
+    except (OSError, ValueError):
+        return None
+
+
+# --- fleet aggregation (--aggregate) --------------------------------------
+# doctor.yml collects every host's --json report and hands them all to one
+# local `airplay-doctor --aggregate`, which prints a single fleet summary.
+
+SLOWEST_PROBES = 10
+_SPACE = re.compile(r"\s*")
+
+
+def read_reports(source) -> tuple:
+    """Reports from a directory of *.json files, one file, or a text stream
+    of concatenated/one-per-line JSON reports. Returns (reports, unreadable)."""
+    if isinstance(source, str) and os.path.isdir(source):
+        names = sorted(n for n in os.listdir(source) if n.endswith(".json"))
+        texts = []
+        for name in names:
+            with open(os.path.join(source, name), encoding="utf-8", errors="replace") as f:
+                texts.append(f.read())
+        text = "\n".join(texts)
+    elif isinstance(source, str):
+        with open(source, encoding="utf-8", errors="replace") as f:
+            text = f.read()
+    else:
+        text = source.read()
+    decoder, reports, unreadable, pos = json.JSONDecoder(), [], 0, 0
+    while True:
+        pos = _SPACE.match(text, pos).end()
+        if pos >= len(text):
+            break
+        try:
+            value, pos = decoder.raw_decode(text, pos)
+        except ValueError:
+            # skip to the next line (a host whose doctor printed no JSON)
+            unreadable += 1
+            nl = text.find("\n", pos)
+            pos = len(text) if nl == -1 else nl + 1
+            continue
+        for report in value if isinstance(value, list) else [value]:
+            if isinstance(report, dict) and isinstance(report.get("checks"), list):
+                reports.append(report)
+            else:
+                unreadable += 1
+    return reports, unreadable
+
+
+def aggregate(reports, unreadable: int = 0, slowest: int = SLOWEST_PROBES) -> dict:
+    """One fleet summary from many host reports: per-check failure counts,
+    hosts grouped by their set of failing checks, device IDs pinned by more
+    than one host, and the slowest probes anywhere in the fleet."""
+    failures, signatures, ids = Counter(), {}, {}
+    for r in reports:
+        host = r.get("host") or "?"
+        failed = tuple(sorted(c["name"] for c in r["checks"] if not c.get("ok")))
+        failures.update(failed)
+        if failed:
+            signatures.setdefault(failed, []).append(host)
+        dev_id = (r.get("device_id") or "").strip().lower()
+        if dev_id:  # an unpinned id is derived from the NIC MAC
+            ids.setdefault(dev_id, []).append(host)
+    duplicates = {i: sorted(hosts) for i, hosts in ids.items() if len(hosts) > 1}
+    probes = heapq.nlargest(slowest, (
+        (p.get("seconds", 0.0), r.get("host") or "?", name, bool(p.get("timeout")))
+        for r in reports for name, p in (r.get("probes") or {}).items()))
+    failing = sum(len(hosts) for hosts in signatures.values())
+    return {
+        "ok": failing == 0 and not duplicates and unreadable == 0,
+        "hosts": len(reports),
+        "failing": failing,
+        "unreadable": unreadable,
+        "check_failures": dict(failures.most_common()),
+        "signatures": [{"failed": list(sig), "hosts": sorted(hosts)} for sig, hosts in
+                       sorted(signatures.items(), key=lambda kv: (-len(kv[1]), kv[0]))],
+        "duplicate_device_ids": duplicates,
+        "slowest_probes": [{"host": host, "probe": name, "seconds": secs, "timeout": timeout}
+                           for secs, host, name, timeout in probes],
     }
 
 
+def print_fleet(summary: dict) -> None:
+    status = "OK" if summary["ok"] else "FAIL"
+    print(f"airplay-doctor fleet: {status} — {summary['hosts']} hosts,"
+          f" {summary['failing']} failing, {summary['unreadable']} unreadable reports")
+    for name, count in summary["check_failures"].items():
+        print(f"  [XX ] {name}: {count} hosts")
+    for sig in summary["signatures"]:
+        print(f"  {' + '.join(sig['failed'])}: {', '.join(sig['hosts'])}")
+    for dev_id, hosts in summary["duplicate_device_ids"].items():
+        print(f"  duplicate device-id {dev_id}: {', '.join(hosts)}")
+    if summary["slowest_probes"]:
+        print("  slowest probes:")
+        for p in summary["slowest_probes"]:
+            note = " (timeout)" if p["timeout"] else ""
+            print(f"    {p['seconds']:6.2f}s  {p['host']} {p['probe']}{note}")
+
+
 def main(argv=None, runner=None) -> int:
     parser = argparse.ArgumentParser(prog="airplay-doctor")
     parser.add_argument("--check", action="store_true", help="non-invasive checks (default)")
     parser.add_argument("--deep", action="store_true", help="add device-open/playback probe")
     parser.add_argument("--json", action="store_true", help="machine-readable output")
+    parser.add_argument("--probe-timeout", type=float, default=PROBE_TIMEOUT,
+                        help="seconds before one probe counts as failed (default %(default)s)")
+    parser.add_argument("--timeout", type=float, default=RUN_TIMEOUT,
+                        help="seconds for the whole run (default %(default)s)")
+    parser.add_argument("--serve", action="store_true",
+                        help="run as a daemon: probe on schedules, serve reports on --socket")
+    parser.add_argument("--socket", default=DOCTOR_SOCKET, help="daemon socket (default %(default)s)")
+    parser.add_argument("--no-daemon", action="store_true",
+                        help="always run the probes here, even if a daemon is serving")
+    parser.add_argument("--history", action="store_true", help="print the daemon's status history")
+    parser.add_argument("--aggregate", nargs="?", const="-", metavar="PATH",
+                        help="summarise many hosts' --json reports from a directory, file or stdin (-)")
     args = parser.parse_args(argv)
-    run = runner or _system_runner
-    report = build_report(run, deep=args.deep)
+    if args.aggregate:
+        source = sys.stdin if args.aggregate == "-" else args.aggregate
+        summary = aggregate(*read_reports(source))
+        if args.json:
+            print(json.dumps(summary))
+        else:
+            print_fleet(summary)
+        return 0 if summary["ok"] else 1
+    run = runner or (lambda name: _system_runner(name, args.probe_timeout))
+    if args.serve:
+        doctor = Doctor(run, timeout=args.probe_timeout)
+        doctor.tick()
+        threading.Thread(target=doctor.run_forever, name="scheduler", daemon=True).start()
+        serve(doctor, args.socket).serve_forever()
+        return 0
+    if args.history:
+        history = query_daemon("history", args.socket)
+        if history is None:
+            print("airplay-doctor: no daemon on " + args.socket, file=sys.stderr)
+            return 2
+        print(json.dumps(history))
+        return 0
+    report = None
+    if not (args.deep or args.no_daemon or runner):
+        report = query_daemon("report", args.socket)
+    if report is None:
+        report = build_report(run, deep=args.deep, timeout=args.probe_timeout, total=args.timeout)
     if args.json:
         print(json.dumps(report))
     else:
@@ -173,6 +693,14 @@ def main(argv=None, runner=None) -> int:
         for c in report["checks"]:
             mark = "ok " if c["ok"] else "XX "
             print(f"  [{mark}] {c['name']}: {c['detail']}")
+        probes = report["probes"]
+        slowest = max(probes, key=lambda n: probes[n]["seconds"])
+        if report.get("source") == "daemon":
+            oldest = max(p["age"] for p in probes.values())
+            print(f"  from the daemon; oldest probe result {oldest:.0f}s old")
+        else:
+            print(f"  probes took {report['seconds']:.2f}s"
+                  f" (slowest {slowest}: {probes[slowest]['seconds']:.2f}s)")
     return 0 if report["ok"] else 1
 
 
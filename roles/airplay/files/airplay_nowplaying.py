@@ -3,42 +3,110 @@
 small JSON snapshot of what is currently playing, for the dashboard to read.
 
 Stdlib only. Reads the pipe forever (reopening across shairport restarts) and
-writes /run/airplay/nowplaying.json (+ a cover-art file) whenever state changes.
+writes /run/airplay/nowplaying.json whenever state changes; cover art goes to
+/run/airplay/covers/<sha256>.<ext>, a small LRU cache the JSON points into.
+With AIRPLAY_METADATA_UDP it takes shairport's UDP datagrams instead (see
+DatagramParser).
 
 Metadata wire format (one item):
   <item><type>HHHHHHHH</type><code>HHHHHHHH</code><length>N</length>
   <data encoding="base64">BASE64</data></item>
 type/code are 4-char tags as 8 hex digits. 'core' items are DMAP track fields
-(minm=title, asar=artist, asal=album); 'ssnc' items are shairport events
-(pbeg/pend session, pvol volume, PICT cover art).
+(minm=title, asar=artist, asal=album, astm=length); 'ssnc' items are shairport
+events (pbeg/pend session, pvol volume, PICT cover art, prgr play progress,
+pfls/prsm pause/resume).
 """
 from __future__ import annotations
 
-import base64
+import argparse
+import binascii
+import fcntl
+import hashlib
 import json
 import os
+import queue
 import re
+import selectors
+import socket
+import sys
+import tempfile
+import threading
 import time
+import tracemalloc
+from collections import deque
+from functools import partial
 
 PIPE = os.environ.get("AIRPLAY_METADATA_PIPE", "/run/shairport-sync/metadata-pipe")
+# "127.0.0.1:5555": read shairport's metadata datagrams there instead of PIPE.
+UDP = os.environ.get("AIRPLAY_METADATA_UDP", "")
 STATE_DIR = os.environ.get("AIRPLAY_STATE_DIR", "/run/airplay")
 STATE_FILE = os.path.join(STATE_DIR, "nowplaying.json")
-COVER_FILE = os.path.join(STATE_DIR, "cover")
+# Content-addressed cover cache: covers/<sha256>.<ext>, LRU-evicted by bytes.
+COVER_DIR = os.path.join(STATE_DIR, "covers")
+COVER_CACHE_BYTES = int(os.environ.get("AIRPLAY_COVER_CACHE_BYTES", str(32 * 1024 * 1024)))
 
 CORE = 0x636F7265
 SSNC = 0x73736E63
+PICT = 0x50494354
+# Clock rate of the RTP frame numbers in ssnc/prgr.
+RTP_RATE = 44100
 
 # Upper bound on the read buffer. Cover-art PICT items carry a full JPEG/PNG
 # base64-encoded inside a single <item>, which is routinely several MB, so the
 # cap must sit well above any real cover (a 1 MB guard would drop them mid-stream).
+# The reader streams PICT bodies to disk (CoverSpool), so in practice this only
+# bounds ordinary items and the buffered fallback.
 MAX_BUF = 16 * 1024 * 1024
+# Receive buffer: preallocated once; grows only while a large item is pending.
+READ_BUF = 256 * 1024
+READ_SIZE = 64 * 1024
+# A readable FIFO is drained (read until EAGAIN) up to this much per wakeup,
+# so a burst never sits in the kernel pipe while other zones get a turn.
+DRAIN_MAX = 4 * 1024 * 1024
+# A streamed cover stays in memory up to this size and spills to a temp file
+# beyond it, so typical art that is already cached never touches the disk.
+SPOOL_MEM = 1024 * 1024
+# FIFO capacity requested with F_SETPIPE_SZ, so shairport can write a burst
+# (a cover) while the reader is busy instead of blocking on the default
+# 64 KiB. 0 = the system maximum (/proc/sys/fs/pipe-max-size).
+PIPE_SIZE = int(os.environ.get("AIRPLAY_PIPE_SIZE", "0"))
+# Receive buffer requested for the UDP socket (the kernel caps it at
+# net.core.rmem_max); datagrams that arrive while it is full are lost.
+UDP_RCVBUF = int(os.environ.get("AIRPLAY_UDP_RCVBUF", str(4 * 1024 * 1024)))
+# nowplaying.json write coalescing: quiet window / cap on how long a change waits.
+COALESCE_S = int(os.environ.get("AIRPLAY_STATE_COALESCE_MS", "75")) / 1000
+MAX_DELAY_S = int(os.environ.get("AIRPLAY_STATE_MAX_DELAY_MS", "250")) / 1000
+# Push channel: subscribers get a snapshot, then newline-delimited JSON deltas.
+STATE_SOCKET = os.path.join(STATE_DIR, "nowplaying.sock")
+# A subscriber that falls this far behind is disconnected (it can reconnect
+# and start over from a fresh snapshot).
+MAX_BACKLOG = 256 * 1024
+# Counters/histograms for airplay-dashboard's /metrics, rewritten this often.
+METRICS_FILE = os.path.join(STATE_DIR, "metrics.prom")
+METRICS_INTERVAL = float(os.environ.get("AIRPLAY_METRICS_INTERVAL_S", "10"))
 
-_ITEM_RE = re.compile(
+_ITEM_START = b"<item>"
+_ITEM_END = b"</item>"
+_HEADER_RE = re.compile(
     rb"<item><type>([0-9a-fA-F]{8})</type><code>([0-9a-fA-F]{8})</code>"
     rb"<length>(\d+)</length>"
-    rb"(?:\s*<data encoding=\"base64\">\s*([A-Za-z0-9+/=\s]*?)</data>)?\s*</item>",
-    re.S,
 )
+# Longest header we will wait for before declaring it corrupt (20 length digits).
+_HEADER_MAX = len(b"<item><type></type><code></code><length></length>") + 16 + 20
+_BODY_RE = re.compile(
+    rb"\s*(?:<data encoding=\"base64\">\s*([A-Za-z0-9+/=\s]*?)</data>)?\s*", re.S
+)
+_DATA_OPEN = b'<data encoding="base64">'
+_DATA_OPEN_RE = re.compile(rb"\s*" + re.escape(_DATA_OPEN))
+_DATA_CLOSE_RE = re.compile(rb"</data>\s*")
+_WS_RE = re.compile(rb"\s*")
+_B64_WS = b" \t\r\n\v\f"
+
+
+def _garbage(buf, start: int, end: int) -> int:
+    """Bytes in buf[start:end] other than whitespace (shairport ends every
+    item with a newline; that is not lost data)."""
+    return len(buf[start:end].translate(None, _B64_WS))
 
 
 def code_to_str(code: int) -> str:
@@ -60,22 +128,471 @@ def trim_buffer(buf: bytes, max_bytes: int = MAX_BUF) -> bytes:
     return buf[cut:] if cut != -1 else b""
 
 
+def _encoded_size(length: int) -> int:
+    """Expected bytes of a <data> body carrying length payload bytes: base64,
+    room for MIME-style line breaks, and the closing tags."""
+    b64 = 4 * ((length + 2) // 3)
+    return b64 + b64 // 64 + 64 if length else 16
+
+
+# --- metrics -----------------------------------------------------------------
+# Prometheus text format, written to METRICS_FILE for the dashboard to serve.
+# _labels, _num and Metrics are copied into airplay_dashboard.py (each script
+# is deployed standalone, so they cannot share a module): keep them in sync.
+
+_LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    esc = (lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in sorted(labels.items())) + "}"
+
+
+def _num(value) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metrics:
+    """A tiny registry: counters, gauges and histograms keyed by name and
+    labels, rendered in the Prometheus text exposition format. Updated from
+    the read loop and the DiskWorker thread, hence the lock."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}    # name -> (type, help)
+        self._values = {}   # (name, labels) -> float
+        self._hists = {}    # (name, labels) -> [bucket counts..., sum, count]
+        self._buckets = {}  # name -> bucket bounds
+
+    def describe(self, name: str, kind: str, text: str, buckets=_LATENCY_BUCKETS) -> None:
+        self._types[name] = (kind, text)
+        if kind == "histogram":
+            self._buckets[name] = tuple(buckets)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._values[(name, _labels(labels))] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, _labels(labels))
+        bounds = self._buckets[name]
+        with self._lock:
+            hist = self._hists.get(key)
+            if hist is None:
+                hist = self._hists[key] = [0] * (len(bounds) + 2)
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, text) in self._types.items():
+                lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+                if kind != "histogram":
+                    lines += [f"{n}{lab} {_num(v)}" for (n, lab), v in self._values.items() if n == name]
+                    continue
+                bounds = self._buckets[name]
+                for (n, lab), hist in self._hists.items():
+                    if n != name:
+                        continue
+                    inner = lab[1:-1] + "," if lab else ""
+                    for bound, count in zip(bounds, hist):
+                        lines.append(f'{name}_bucket{{{inner}le="{bound:g}"}} {count}')
+                    lines += [f'{name}_bucket{{{inner}le="+Inf"}} {hist[-1]}',
+                              f"{name}_sum{lab} {_num(hist[-2])}", f"{name}_count{lab} {hist[-1]}"]
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str | None = None) -> None:
+        """Atomically replace the metrics file (the dashboard reads it whole)."""
+        path = path or METRICS_FILE
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            fh.write(self.render())
+        os.replace(tmp, path)
+
+
+METRICS = Metrics()
+METRICS.describe("airplay_nowplaying_items_total", "counter", "Metadata items parsed, by type/code tag.")
+METRICS.describe("airplay_nowplaying_read_bytes_total", "counter", "Bytes read from the metadata pipe.")
+METRICS.describe("airplay_nowplaying_dropped_bytes_total", "counter",
+                 "Bytes discarded as garbage or by the runaway-item guard.")
+METRICS.describe("airplay_nowplaying_buffer_high_water_bytes", "gauge",
+                 "Largest receive buffer allocated so far.")
+METRICS.describe("airplay_nowplaying_parse_seconds", "histogram", "Parse and apply time per pipe read.")
+METRICS.describe("airplay_nowplaying_state_writes_total", "counter", "nowplaying.json writes.")
+METRICS.describe("airplay_nowplaying_cover_writes_total", "counter", "Covers written to the cache.")
+METRICS.describe("airplay_nowplaying_cover_hits_total", "counter", "Covers already in the cache.")
+METRICS.describe("airplay_nowplaying_pipe_opens_total", "counter", "Metadata pipe (re)opens.")
+METRICS.describe("airplay_nowplaying_subscribers", "gauge", "Connected push-socket subscribers.")
+METRICS.describe("airplay_nowplaying_pipe_capacity_bytes", "gauge",
+                 "Kernel buffer size of the metadata FIFO or UDP socket.")
+METRICS.describe("airplay_nowplaying_pipe_full_total", "counter",
+                 "Wakeups that drained a full FIFO's worth: shairport may have had to wait (late items).")
+METRICS.describe("airplay_nowplaying_disk_queue", "gauge", "Cover/state file jobs waiting for the disk thread.")
+METRICS.describe("airplay_nowplaying_disk_seconds", "histogram", "Time per cover/state file job.")
+METRICS.describe("airplay_nowplaying_datagrams_total", "counter", "UDP metadata datagrams received.")
+METRICS.describe("airplay_nowplaying_incomplete_items_total", "counter",
+                 "Chunked UDP items abandoned with chunks missing (lost or reordered datagrams).")
+
+
+class CoverSpool:
+    """Decodes one PICT item's base64 text as it arrives, hashing the decoded
+    bytes for the cover cache. Up to SPOOL_MEM is kept in memory; past that it
+    spills to a temp file in STATE_DIR, so a cover is never held whole in
+    memory. commit() puts it in place. Write errors and bad base64 are latched
+    and reported by close() rather than raised into the read loop.
+    """
+
+    def __init__(self, directory: str | None = None):
+        self._dir = directory or STATE_DIR
+        self._mem = bytearray()
+        self._fh = None
+        self.path = None   # temp file, once spilled
+        self._hash = hashlib.sha256()
+        self._carry = b""  # base64 chars past the last 4-char boundary
+        self.encoded = 0   # base64 text bytes seen, whitespace included
+        self.size = 0      # decoded bytes
+        self.head = b""    # first decoded bytes, for cover_ext()
+        self.ok = True
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def digest(self) -> str:
+        return self._hash.hexdigest()
+
+    def write(self, b64) -> None:
+        self.encoded += len(b64)
+        if not self.ok:
+            return
+        text = self._carry + bytes(b64).translate(None, _B64_WS)
+        cut = len(text) & ~3
+        self._carry = text[cut:]
+        if cut:
+            self._emit(text[:cut])
+
+    def _emit(self, text: bytes) -> None:
+        try:
+            data = binascii.a2b_base64(text)
+            if self._fh is None and len(self._mem) + len(data) <= SPOOL_MEM:
+                self._mem += data
+            else:
+                if self._fh is None:
+                    fd, self.path = tempfile.mkstemp(prefix=".cover.", suffix=".part",
+                                                     dir=self._dir)
+                    self._fh = os.fdopen(fd, "wb")
+                    self._fh.write(self._mem)
+                    self._mem = bytearray()
+                self._fh.write(data)
+        except (OSError, binascii.Error):
+            self.ok = False
+            return
+        self._hash.update(data)
+        if len(self.head) < 8:
+            self.head = (self.head + data[:8])[:8]
+        self.size += len(data)
+
+    def close(self) -> bool:
+        """Flush the final quantum; True if the whole cover decoded and landed."""
+        if self._carry and self.ok:
+            self._emit(self._carry)
+        self._carry = b""
+        if self._fh is not None:
+            try:
+                self._fh.close()
+            except OSError:
+                self.ok = False
+        return self.ok
+
+    def commit(self, dest: str) -> None:
+        if self.path is None:
+            tmp = f"{dest}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as fh:
+                fh.write(self._mem)
+            os.replace(tmp, dest)
+            self._mem = bytearray()
+        else:
+            os.replace(self.path, dest)
+            self.path = None
+
+    def discard(self) -> None:
+        self._mem = bytearray()
+        if self._fh is not None:
+            self._fh.close()
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+
+def cover_spool(typ: int, code: int, length: int):
+    """ItemParser spool hook: stream PICT items to disk, buffer everything else."""
+    if typ != SSNC or code != PICT:
+        return None
+    return CoverSpool()
+
+
+class ItemParser:
+    """Incremental <item> parser for the metadata stream.
+
+    Running the item regex over the whole buffer after every read rescans a
+    multi-MB cover hundreds of times. This keeps the scan position and the
+    parsed header (type, code, declared <length>) between reads, so every byte
+    is looked at a bounded number of times no matter how the stream is split.
+
+    Bytes live in one preallocated bytearray between the _start and _end
+    indices: readinto() fills the free tail straight from the pipe, consumed
+    items only advance _start, and the pending tail is moved down (or the
+    buffer grown) only when the free space runs out. Base64 payloads are
+    decoded from a view of the buffer, never from a copied slice.
+
+    Garbage outside an <item> is discarded as soon as it is seen; a partial
+    item only gets resynchronised (the trim_buffer() rule) once it exceeds
+    max_bytes and a newer <item> start has arrived behind it.
+
+    spool, if given, is called with (type, code, length) for every header; when
+    it returns a sink (see CoverSpool) the item's base64 text is handed to the
+    sink as it arrives and released from the buffer, and the finished sink is
+    the item's payload. Memory then stays bounded by the read size however
+    large the item is, and max_bytes does not apply to it.
+    """
+
+    def __init__(self, max_bytes: int = MAX_BUF, capacity: int = READ_BUF, spool=None):
+        self.max_bytes = max_bytes
+        self._spool = spool
+        self.dropped = 0  # bytes discarded as garbage / by the runaway guard
+        self.high_water = capacity  # largest buffer allocated
+        self._capacity = capacity
+        self._buf = bytearray(capacity)
+        self._start = 0  # first unconsumed byte
+        self._end = 0    # end of valid data
+        self._reset()
+
+    def _reset(self) -> None:
+        # While an item is open _start points at its "<item>".
+        self._header = None  # (type, code, length) once parsed
+        self._body = 0       # offset just past the parsed header
+        self._scan = 0       # next offset to search for </item>
+        self._guard = 0      # runaway-guard search position
+        self._sink = None    # spool sink while an item is being streamed
+        self._data = False   # streaming: <data> opened, _scan is in the base64 text
+
+    def pending(self) -> bytes:
+        """Unparsed tail: the start of an item still arriving."""
+        return bytes(self._buf[self._start:self._end])
+
+    def feed(self, data) -> list:
+        """Append data and return the (type, code, payload) items it completes."""
+        n = len(data)
+        self._reserve(n)
+        self._buf[self._end:self._end + n] = data
+        self._end += n
+        return self.parse()
+
+    def readinto(self, reader, size: int = READ_SIZE):
+        """Read up to size bytes from reader straight into the free tail.
+
+        Returns the byte count (0 at EOF, None if a non-blocking reader has
+        nothing yet); call parse() to collect items.
+        """
+        self._reserve(size)
+        with memoryview(self._buf) as view, view[self._end:] as tail:
+            n = reader.readinto(tail)
+        if n:
+            self._end += n
+        return n
+
+    def parse(self) -> list:
+        """Return the (type, code, payload) items completed so far."""
+        items = []
+        while True:
+            if self._header is None:
+                more = self._parse_header()
+            else:
+                more = self._parse_body(items)
+            if not more:
+                break
+        if self._start == self._end:
+            self._shift(self._start)  # empty: rewind to the front for free
+            self._end = 0
+            if len(self._buf) > self._capacity:
+                self._buf = bytearray(self._capacity)  # give a cover's worth back
+        return items
+
+    def _reserve(self, n: int, exact: bool = False) -> None:
+        """Make room for n more bytes after _end, moving down before growing."""
+        if len(self._buf) - self._end >= n:
+            return
+        pending = self._end - self._start
+        size = len(self._buf)
+        if pending + n > size // 2:
+            size = pending + n if exact else max(size * 2, pending + n)
+            buf = bytearray(size)
+            buf[:pending] = memoryview(self._buf)[self._start:self._end]
+            self._buf = buf
+            self.high_water = max(self.high_water, size)
+        else:
+            with memoryview(self._buf) as view:
+                view[:pending] = view[self._start:self._end]
+        self._shift(self._start)
+        self._end = pending
+
+    def _shift(self, n: int) -> None:
+        self._start -= n
+        self._body -= n
+        self._scan -= n
+        self._guard = max(0, self._guard - n)
+
+    def _parse_header(self) -> bool:
+        buf, pos, end = self._buf, self._start, self._end
+        start = buf.find(_ITEM_START, pos, end)
+        if start == -1:
+            # nothing item-shaped here; keep only a possible partial "<item"
+            keep = max(pos, end - len(_ITEM_START) + 1)
+            self.dropped += _garbage(buf, pos, keep)
+            self._start = keep
+            return False
+        if start > pos:
+            self.dropped += _garbage(buf, pos, start)
+        self._start = start
+        m = _HEADER_RE.match(buf, start, end)
+        if m is None:
+            if buf.find(b"</length>", start, min(end, start + _HEADER_MAX)) == -1 \
+                    and end - start < _HEADER_MAX:
+                return False  # header still arriving
+            self.dropped += 1
+            self._start += 1  # corrupt header; look for the next <item>
+            return True
+        self._header = (int(m.group(1), 16), int(m.group(2), 16), int(m.group(3)))
+        self._body = self._scan = m.end()
+        if self._spool is not None:
+            self._sink = self._spool(*self._header)
+            if self._sink is not None:
+                return True
+        # The declared length fixes the encoded size: size the buffer for the
+        # whole item once instead of doubling through a multi-MB cover.
+        want = self._body - start + _encoded_size(self._header[2])
+        if want > len(self._buf) and want <= self.max_bytes:
+            self._reserve(want - (end - start), exact=True)
+        return True
+
+    def _parse_body(self, items: list) -> bool:
+        if self._sink is not None:
+            return self._stream_body(items)
+        buf = self._buf
+        close = buf.find(_ITEM_END, self._scan, self._end)
+        if close == -1:
+            self._scan = max(self._scan, self._end - len(_ITEM_END) + 1)
+            return self._guard_runaway()
+        typ, code, _length = self._header
+        m = _BODY_RE.fullmatch(buf, self._body, close)
+        if m is None:
+            self._reset()
+            self.dropped += 1
+            self._start += 1  # malformed body; resync on the next <item> after this one
+            return True
+        payload = b""
+        if m.start(1) != m.end(1):
+            with memoryview(buf) as view, view[m.start(1):m.end(1)] as b64:
+                try:
+                    payload = binascii.a2b_base64(b64)  # skips the line-break whitespace
+                except binascii.Error:
+                    payload = None  # bad padding: drop the item, keep the stream
+        self._reset()
+        if payload is None:
+            self.dropped += close + len(_ITEM_END) - self._start
+        else:
+            items.append((typ, code, payload))
+        self._start = close + len(_ITEM_END)
+        return True
+
+    def _stream_body(self, items: list) -> bool:
+        buf, end = self._buf, self._end
+        if not self._data:
+            m = _DATA_OPEN_RE.match(buf, self._body, end)
+            if m is None:
+                ws = _WS_RE.match(buf, self._body, end).end()
+                if end - ws < len(_DATA_OPEN) and _DATA_OPEN.startswith(buf[ws:end]):
+                    return False  # <data> tag still arriving
+                self._sink.discard()  # no data element: parse it the buffered way
+                self._sink = None
+                return True
+            self._data = True
+            self._scan = m.end()
+        lt = buf.find(b"<", self._scan, end)  # base64 never contains '<'
+        stop = end if lt == -1 else lt
+        if stop > self._scan:
+            with memoryview(buf) as view, view[self._scan:stop] as chunk:
+                self._sink.write(chunk)
+            self._scan = stop
+        sink, (typ, code, length) = self._sink, self._header
+        if lt == -1:
+            self._start = stop  # on disk now; release it from the buffer
+            if sink.encoded <= 2 * _encoded_size(length) + READ_SIZE:
+                return False
+            return self._abort_stream(stop)  # far past the declared length
+        close = buf.find(_ITEM_END, lt, end)
+        if close == -1:
+            if end - lt < 64:
+                return False  # closing tags still arriving
+            return self._abort_stream(lt)
+        if _DATA_CLOSE_RE.fullmatch(buf, lt, close) is None or not sink.close():
+            return self._abort_stream(lt)
+        self._reset()
+        self._start = close + len(_ITEM_END)
+        if sink.size:
+            items.append((typ, code, sink))
+        else:
+            sink.discard()
+            items.append((typ, code, b""))
+        return True
+
+    def _abort_stream(self, pos: int) -> bool:
+        """Corrupt streamed item: drop what was spooled and resync at pos."""
+        self._sink.discard()
+        self.dropped += self._sink.encoded
+        self._reset()
+        self._start = pos
+        return True
+
+    def _guard_runaway(self) -> bool:
+        """A partial item larger than max_bytes with a newer <item> start behind
+        it is a truncated item that will never close: drop it and resync."""
+        if self._end - self._start <= self.max_bytes:
+            return False
+        cut = self._buf.rfind(_ITEM_START, max(self._start + 1, self._guard), self._end)
+        self._guard = self._end - len(_ITEM_START) + 1
+        if cut == -1:
+            return False
+        self._reset()
+        self.dropped += cut - self._start
+        self._start = cut
+        return True
+
+
 def parse_items(buf: bytes):
     """Parse complete <item>..</item> records from buf.
 
     Returns (items, leftover) where items is a list of (type, code, payload)
     and leftover is the unparsed tail (a partial item still arriving).
+    One-shot convenience over ItemParser; the reader loop keeps a parser.
     """
-    items = []
-    last = 0
-    for m in _ITEM_RE.finditer(buf):
-        typ = int(m.group(1), 16)
-        code = int(m.group(2), 16)
-        b64 = m.group(4)
-        payload = base64.b64decode(re.sub(rb"\s", b"", b64)) if b64 else b""
-        items.append((typ, code, payload))
-        last = m.end()
-    return items, buf[last:]
+    parser = ItemParser(max_bytes=max(MAX_BUF, len(buf)))
+    items = parser.feed(buf)
+    return items, parser.pending()
 
 
 def parse_pvol(payload: bytes) -> dict:
@@ -101,6 +618,72 @@ def cover_ext(data: bytes) -> str:
     return "bin"
 
 
+def store_cover(payload) -> str:
+    """Put a cover (bytes or a closed CoverSpool) into the content-addressed
+    cache and return its path relative to STATE_DIR. Art that is already
+    cached (sources resend it every track) only gets its LRU time bumped.
+    """
+    if isinstance(payload, CoverSpool):
+        digest, ext = payload.digest, cover_ext(payload.head)
+    else:
+        digest, ext = hashlib.sha256(payload).hexdigest(), cover_ext(payload)
+    name = f"{digest}.{ext}"
+    path = os.path.join(COVER_DIR, name)
+    try:
+        os.utime(path)
+        METRICS.inc("airplay_nowplaying_cover_hits_total")
+    except FileNotFoundError:
+        METRICS.inc("airplay_nowplaying_cover_writes_total")
+        os.makedirs(COVER_DIR, exist_ok=True)
+        try:
+            if isinstance(payload, CoverSpool):
+                payload.commit(path)
+            else:
+                tmp = f"{path}.{os.getpid()}.tmp"
+                with open(tmp, "wb") as fh:
+                    fh.write(payload)
+                os.replace(tmp, path)
+        finally:
+            if isinstance(payload, CoverSpool):
+                payload.discard()
+        evict_covers(keep=name)
+    else:
+        if isinstance(payload, CoverSpool):
+            payload.discard()
+    return os.path.join(os.path.basename(COVER_DIR), name)
+
+
+def evict_covers(budget: int | None = None, keep: str | None = None) -> int:
+    """Delete least-recently-used cached covers until the cache fits in budget
+    bytes (default COVER_CACHE_BYTES); keep is never evicted. Returns the
+    number of files removed.
+    """
+    budget = COVER_CACHE_BYTES if budget is None else budget
+    entries = []
+    try:
+        with os.scandir(COVER_DIR) as it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False) and not entry.name.endswith(".tmp"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime_ns, st.st_size, entry.name))
+    except OSError:
+        return 0
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, name in sorted(entries):
+        if total <= budget:
+            break
+        if name == keep:
+            continue
+        try:
+            os.unlink(os.path.join(COVER_DIR, name))
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+
 def empty_state() -> dict:
     return {
         "active": False,
@@ -110,84 +693,938 @@ def empty_state() -> dict:
         "volume_percent": 0,
         "muted": False,
         "cover": None,
+        # Play progress: `position` seconds into the track as of wall-clock
+        # `position_at`; clients extrapolate while not `paused`.
+        "duration": None,
+        "position": None,
+        "position_at": None,
+        "paused": False,
         "updated": 0.0,
     }
 
 
+def _tag(name: str) -> int:
+    return int.from_bytes(name.encode("ascii"), "big")
+
+
+def _set_field(field: str):
+    def handler(state: dict, payload) -> bool:
+        value = payload.decode("utf-8", "replace")
+        if state.get(field) == value:
+            return False
+        state[field] = value
+        return True
+    return handler
+
+
+def _play_begin(state: dict, payload) -> bool:
+    if state["active"]:
+        return False
+    state["active"] = True
+    return True
+
+
+def _play_end(state: dict, payload) -> bool:
+    state.update(empty_state())
+    return True
+
+
+def _volume(state: dict, payload) -> bool:
+    vol = parse_pvol(payload)
+    if (vol["percent"], vol["muted"]) == (state["volume_percent"], state["muted"]):
+        return False
+    state["volume_percent"] = vol["percent"]
+    state["muted"] = vol["muted"]
+    return True
+
+
+def _cover(state: dict, payload) -> bool:
+    if not payload:
+        return False
+    try:
+        cover = store_cover(payload)
+    except OSError:
+        cover = state["cover"]
+    if state["cover"] == cover:
+        return False
+    state["cover"] = cover
+    return True
+
+
+def _progress(state: dict, payload) -> bool:
+    """ssnc/prgr: "start/current/end" RTP frame numbers of the play sequence
+    (32-bit, may wrap). Sent when a track starts playing and on resume."""
+    try:
+        start, current, end = (int(v) for v in payload.split(b"/"))
+    except ValueError:
+        return False
+    state["position"] = round(((current - start) & 0xFFFFFFFF) / RTP_RATE, 3)
+    state["duration"] = round(((end - start) & 0xFFFFFFFF) / RTP_RATE, 3)
+    state["position_at"] = round(time.time(), 3)
+    state["paused"] = False
+    return True
+
+
+def _track_time(state: dict, payload) -> bool:
+    """core/astm: track length in ms (DMAP uint32); prgr refines it."""
+    if len(payload) != 4:
+        return False
+    duration = int.from_bytes(payload, "big") / 1000
+    if state["duration"] == duration:
+        return False
+    state["duration"] = duration
+    return True
+
+
+def _pause(state: dict, payload) -> bool:
+    """ssnc/pfls (flush: pause or seek): freeze the extrapolated position."""
+    if state["paused"]:
+        return False
+    now = time.time()
+    if state["position"] is not None:
+        state["position"] = round(state["position"] + now - state["position_at"], 3)
+        state["position_at"] = round(now, 3)
+    state["paused"] = True
+    return True
+
+
+def _resume(state: dict, payload) -> bool:
+    """ssnc/prsm: playing again from the frozen position (a prgr follows)."""
+    if not state["paused"]:
+        return False
+    state["paused"] = False
+    if state["position"] is not None:
+        state["position_at"] = round(time.time(), 3)
+    return True
+
+
+# (type, code) -> handler(state, payload) -> changed. Everything else is ignored.
+HANDLERS = {
+    (CORE, _tag("minm")): _set_field("title"),
+    (CORE, _tag("asar")): _set_field("artist"),
+    (CORE, _tag("asal")): _set_field("album"),
+    (CORE, _tag("astm")): _track_time,
+    (SSNC, _tag("pbeg")): _play_begin,
+    (SSNC, _tag("pend")): _play_end,
+    (SSNC, _tag("pvol")): _volume,
+    (SSNC, PICT): _cover,
+    (SSNC, _tag("prgr")): _progress,
+    (SSNC, _tag("pfls")): _pause,
+    (SSNC, _tag("prsm")): _resume,
+}
+
+
 def apply_item(state: dict, typ: int, code: int, payload: bytes) -> bool:
     """Update state in place for one item. Returns True if state changed.
 
-    Side effect: writes the cover-art file when a PICT item arrives.
+    Side effect: stores the cover art in the cover cache when a PICT item
+    arrives (payload is then either the decoded bytes or the CoverSpool that
+    streamed them); state["cover"] names the cached file.
     """
-    changed = False
-    if typ == CORE:
-        tag = code_to_str(code)
-        field = {"minm": "title", "asar": "artist", "asal": "album"}.get(tag)
-        if field is not None:
-            value = payload.decode("utf-8", "replace")
-            if state.get(field) != value:
-                state[field] = value
-                changed = True
-    elif typ == SSNC:
-        tag = code_to_str(code)
-        if tag == "pbeg":
-            if not state["active"]:
-                state["active"] = True
-                changed = True
-        elif tag == "pend":
-            state.update(empty_state())
-            changed = True
-        elif tag == "pvol":
-            vol = parse_pvol(payload)
-            if (vol["percent"], vol["muted"]) != (state["volume_percent"], state["muted"]):
-                state["volume_percent"] = vol["percent"]
-                state["muted"] = vol["muted"]
-                changed = True
-        elif tag == "PICT" and payload:
-            path = f"{COVER_FILE}.{cover_ext(payload)}"
-            try:
-                with open(path, "wb") as fh:
-                    fh.write(payload)
-                state["cover"] = os.path.basename(path)
-                changed = True
-            except OSError:
-                pass
-    return changed
+    handler = HANDLERS.get((typ, code))
+    return handler(state, payload) if handler is not None else False
 
 
-def write_state(state: dict) -> None:
+def write_state(state: dict, path: str | None = None) -> None:
     state["updated"] = time.time()
-    tmp = f"{STATE_FILE}.{os.getpid()}.tmp"
+    replace_file(path or STATE_FILE, json.dumps(state))
+
+
+def replace_file(path: str, text: str) -> None:
+    tmp = f"{path}.{os.getpid()}.tmp"
     with open(tmp, "w", encoding="utf-8") as fh:
-        json.dump(state, fh)
-    os.replace(tmp, STATE_FILE)
+        fh.write(text)
+    os.replace(tmp, path)
 
 
-def run(pipe_path: str = PIPE) -> None:  # pragma: no cover - I/O loop
-    os.makedirs(STATE_DIR, exist_ok=True)
-    state = empty_state()
-    write_state(state)
-    buf = b""
-    while True:
+class StateWriter:
+    """Coalesces bursts of state changes into one nowplaying.json write.
+
+    A track change arrives as a burst of items (core fields, pvol, pbeg,
+    PICT) spread over several reads. mark() each change; the write becomes due
+    once the state has been quiet for `window` seconds, or `max_delay` after
+    the first unwritten change if it keeps changing, so a burst costs one
+    write while a lone volume change still lands within `window`. A flush whose
+    content matches the last write is skipped.
+    """
+
+    def __init__(self, window: float = COALESCE_S, max_delay: float = MAX_DELAY_S,
+                 clock=time.monotonic, path: str | None = None, disk=None):
+        self.path = path  # default: STATE_FILE
+        self.disk = disk  # a DiskWorker: serialize here, write on its thread
+        self.window = window
+        self.max_delay = max_delay
+        self._clock = clock
+        self._first = None  # first unwritten change
+        self._last = None   # most recent unwritten change
+        self._written = None
+        self.writes = 0
+
+    def mark(self) -> None:
+        now = self._clock()
+        if self._first is None:
+            self._first = now
+        self._last = now
+
+    def timeout(self):
+        """Seconds until a write is due (0 = now), or None when nothing is pending."""
+        if self._last is None:
+            return None
+        due = min(self._last + self.window, self._first + self.max_delay)
+        return max(0.0, due - self._clock())
+
+    def flush(self, state: dict) -> bool:
+        """Write state now unless it is unchanged since the last write."""
+        self._first = self._last = None
+        key = json.dumps({k: v for k, v in state.items() if k != "updated"})
+        if key == self._written:
+            return False
+        if self.disk is None:
+            write_state(state, self.path)
+        else:
+            state["updated"] = time.time()
+            self.disk.submit(partial(replace_file, self.path or STATE_FILE, json.dumps(state)))
+        self._written = key
+        self.writes += 1
+        METRICS.inc("airplay_nowplaying_state_writes_total")
+        return True
+
+
+class StatePublisher:
+    """Pushes state changes to local consumers over an AF_UNIX stream socket.
+
+    On connect a subscriber gets {"type": "snapshot", "state": {...}}, then one
+    {"type": "delta", "changes": {...}} line per publish() that changed
+    anything ("updated" is a file-write timestamp and is not streamed). All
+    sockets are non-blocking and serviced from the reader's selector; a
+    subscriber whose unsent backlog passes MAX_BACKLOG is dropped.
+    """
+
+    def __init__(self, sel, state: dict, path: str | None = None):
+        self.path = path or STATE_SOCKET
+        self._sel = sel
+        self._state = state
+        self._clients = {}  # socket -> unsent bytes
         try:
-            with open(pipe_path, "rb") as pipe:
-                while True:
-                    chunk = pipe.read(4096)
-                    if not chunk:
-                        break  # writer (shairport) closed; reopen
-                    buf += chunk
-                    items, buf = parse_items(buf)
-                    buf = trim_buffer(buf)  # runaway guard, cover-art safe
-                    dirty = False
-                    for typ, code, payload in items:
-                        dirty |= apply_item(state, typ, code, payload)
-                    if dirty:
-                        write_state(state)
+            os.unlink(self.path)  # stale socket from a previous run
         except FileNotFoundError:
-            time.sleep(2)  # pipe not created yet (shairport starting)
+            pass
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.bind(self.path)
+            self._sock.listen(16)
         except OSError:
-            time.sleep(2)
+            self._sock.close()
+            raise
+        self._sock.setblocking(False)
+        sel.register(self._sock, selectors.EVENT_READ, self._accept)
+        self._sent = self._public(state)
+
+    @staticmethod
+    def _public(state: dict) -> dict:
+        return {k: v for k, v in state.items() if k != "updated"}
+
+    @staticmethod
+    def _line(msg: dict) -> bytes:
+        return json.dumps(msg, separators=(",", ":")).encode() + b"\n"
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._clients)
+
+    def publish(self) -> None:
+        """Send subscribers whatever changed since the last publish()."""
+        now = self._public(self._state)
+        changes = {k: v for k, v in now.items() if self._sent.get(k) != v}
+        self._sent = now
+        if changes and self._clients:
+            line = self._line({"type": "delta", "changes": changes})
+            for conn in list(self._clients):
+                self._send(conn, line)
+
+    def close(self) -> None:
+        for conn in list(self._clients):
+            self._drop(conn)
+        self._sel.unregister(self._sock)
+        self._sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _accept(self, _events) -> None:
+        try:
+            conn, _ = self._sock.accept()
+        except OSError:
+            return
+        conn.setblocking(False)
+        self._clients[conn] = bytearray()
+        self._sel.register(conn, selectors.EVENT_READ,
+                           lambda events, conn=conn: self._service(conn, events))
+        self._send(conn, self._line({"type": "snapshot", "state": self._state}))
+
+    def _service(self, conn, events) -> None:
+        if events & selectors.EVENT_READ:
+            try:
+                if not conn.recv(4096):  # subscribers have nothing to say
+                    raise ConnectionResetError
+            except BlockingIOError:
+                pass
+            except OSError:
+                self._drop(conn)
+                return
+        if events & selectors.EVENT_WRITE:
+            self._send(conn, b"")
+
+    def _send(self, conn, data: bytes) -> None:
+        backlog = self._clients[conn]
+        backlog += data
+        try:
+            del backlog[:conn.send(backlog)]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._drop(conn)
+            return
+        if len(backlog) > MAX_BACKLOG:
+            self._drop(conn)
+            return
+        mask = selectors.EVENT_READ | (selectors.EVENT_WRITE if backlog else 0)
+        if self._sel.get_key(conn).events != mask:
+            self._sel.modify(conn, mask, self._sel.get_key(conn).data)
+
+    def _drop(self, conn) -> None:
+        self._clients.pop(conn, None)
+        try:
+            self._sel.unregister(conn)
+        except (KeyError, ValueError):
+            pass
+        conn.close()
+
+
+def open_fifo(path: str):
+    """Open the metadata FIFO for non-blocking reads without waiting for a
+    writer. Linux only reports hang-up on such a descriptor after a writer
+    has come and gone, so it can sit in a selector while shairport is idle.
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    return open(fd, "rb", buffering=0)
+
+
+def pipe_max_size() -> int:
+    try:
+        with open("/proc/sys/fs/pipe-max-size", encoding="ascii") as fh:
+            return int(fh.read())
+    except (OSError, ValueError):
+        return 1024 * 1024  # the kernel's default limit
+
+
+def set_pipe_size(fd: int, size: int | None = None) -> int:
+    """Grow the pipe behind fd to `size` bytes (default PIPE_SIZE, else the
+    system maximum), halving on refusal (per-user pipe quota). Returns the
+    capacity in effect, or 0 where pipes cannot be sized (non-Linux)."""
+    setsz = getattr(fcntl, "F_SETPIPE_SZ", None)
+    getsz = getattr(fcntl, "F_GETPIPE_SZ", None)
+    if setsz is None or getsz is None:
+        return 0
+    size = size or PIPE_SIZE or pipe_max_size()
+    while size >= 65536:
+        try:
+            return fcntl.fcntl(fd, setsz, size)
+        except OSError:
+            size //= 2
+    try:
+        return fcntl.fcntl(fd, getsz)
+    except OSError:
+        return 0
+
+
+class DiskWorker:
+    """Runs slow file work -- cover commits and cache eviction, state-file
+    writes -- on one background thread, in submission order, so the read loop
+    keeps draining the FIFOs while the disk is busy. A job's `done(result)`
+    runs back on the loop thread: the worker wakes the selector through a
+    pipe. A job's OSError is its result.
+    """
+
+    def __init__(self, sel):
+        self._jobs = queue.SimpleQueue()
+        self._done = deque()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        sel.register(self._wake_r, selectors.EVENT_READ, self._finish)
+        self._sel = sel
+        self.pending = 0
+        self._thread = threading.Thread(target=self._run, name="disk", daemon=True)
+        self._thread.start()
+
+    def submit(self, job, done=None) -> None:
+        self.pending += 1
+        METRICS.set("airplay_nowplaying_disk_queue", self.pending)
+        self._jobs.put((job, done))
+
+    def _run(self) -> None:
+        while True:
+            job, done = self._jobs.get()
+            if job is None:
+                return
+            t0 = time.perf_counter()
+            try:
+                result = job()
+            except OSError as exc:
+                result = exc
+            METRICS.observe("airplay_nowplaying_disk_seconds", time.perf_counter() - t0)
+            self._done.append((done, result))
+            try:
+                os.write(self._wake_w, b"\0")
+            except BlockingIOError:
+                pass  # already woken; _finish drains every completion
+
+    def _finish(self, _events=None) -> None:
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._done:
+            done, result = self._done.popleft()
+            self.pending -= 1
+            if done is not None:
+                done(result)
+        METRICS.set("airplay_nowplaying_disk_queue", self.pending)
+
+    def close(self) -> None:
+        """Finish the queued jobs (their done callbacks are dropped) and stop."""
+        self._jobs.put((None, None))
+        self._thread.join()
+        self._sel.unregister(self._wake_r)
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+
+def export_metrics(parser: ItemParser, publisher=None, zone: str = "", dump: bool = True) -> None:
+    """Copy the parser/publisher totals into METRICS and rewrite the file."""
+    labels = {"zone": zone} if zone else {}
+    METRICS.set("airplay_nowplaying_dropped_bytes_total", parser.dropped, **labels)
+    METRICS.set("airplay_nowplaying_buffer_high_water_bytes", parser.high_water, **labels)
+    METRICS.set("airplay_nowplaying_subscribers", publisher.subscribers if publisher else 0, **labels)
+    if not dump:
+        return
+    try:
+        METRICS.dump()
+    except OSError:
+        pass  # metrics are best-effort; never stop reading the pipe for them
+
+
+# --- zones -----------------------------------------------------------------
+# A box with several DACs runs one shairport-sync per DAC, each with its own
+# metadata pipe. One reader process serves them all: every zone's FIFO sits in
+# the same selector, with its own parser buffer, state and push socket. The
+# main instance (PIPE) is the unnamed zone "" and keeps the single-instance
+# paths (nowplaying.json/.sock) that the dashboard reads.
+
+ZONES = os.environ.get("AIRPLAY_ZONES", "")  # "living=/run/a/pipe,office=udp://127.0.0.1:5556"
+_ZONE_RE = re.compile(r"[A-Za-z0-9_-]+")
+_TAG_LABELS = {}  # (type, code) -> "ssnc/pvol" metric label
+
+
+def parse_zones(spec: str) -> list:
+    """'living=/run/a/pipe,office=udp://127.0.0.1:5556' -> [(zone, source), ...]."""
+    zones = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        zone, sep, pipe = part.partition("=")
+        if not sep or not pipe or not _ZONE_RE.fullmatch(zone):
+            raise ValueError(f"bad zone {part!r} (want name=/path/to/metadata-pipe or name=udp://HOST:PORT)")
+        if zone in dict(zones):
+            raise ValueError(f"zone {zone!r} given twice")
+        if pipe.startswith("udp://"):
+            parse_udp(pipe)
+        zones.append((zone, pipe))
+    return zones
+
+
+def zone_paths(zone: str) -> tuple:
+    """(state file, push socket) of a zone."""
+    if not zone:
+        return STATE_FILE, STATE_SOCKET
+    return (os.path.join(STATE_DIR, f"nowplaying-{zone}.json"),
+            os.path.join(STATE_DIR, f"nowplaying-{zone}.sock"))
+
+
+def tag_label(typ: int, code: int) -> str:
+    label = _TAG_LABELS.get((typ, code))
+    if label is None:
+        label = _TAG_LABELS[typ, code] = f"{code_to_str(typ)}/{code_to_str(code)}"
+    return label
+
+
+class ZoneReader:
+    """One shairport-sync instance: its FIFO, parser, state, StateWriter and
+    StatePublisher. The FIFO is registered in the shared selector with
+    on_readable as its data, like the publisher sockets, so the loop just
+    calls key.data(events) for everything that is ready.
+    """
+
+    def __init__(self, sel, pipe_path: str, zone: str = "", disk: DiskWorker | None = None):
+        self.zone = zone
+        self.pipe_path = pipe_path
+        self._sel = sel
+        self._labels = {"zone": zone} if zone else {}
+        self.disk = disk
+        state_file, sock_path = zone_paths(zone)
+        self.state = empty_state()
+        self.writer = StateWriter(path=state_file, disk=disk)
+        self.writer.flush(self.state)
+        # survives reopen: an item may straddle a restart
+        self.parser = ItemParser(spool=cover_spool)
+        try:
+            self.publisher = StatePublisher(sel, self.state, sock_path)
+        except OSError:
+            self.publisher = None  # no push channel; the state file still works
+        self.pipe = None
+        self.capacity = 0  # FIFO buffer size once open
+        self._retry = 0.0
+
+    def poll(self):
+        """Open the FIFO and write the state when due. Returns the seconds
+        until this zone next needs a poll(), or None (only pipe input)."""
+        now = time.monotonic()
+        if self.pipe is None and now >= self._retry:
+            try:
+                self.pipe = self._open()
+                self._sel.register(self.pipe, selectors.EVENT_READ, self.on_readable)
+                METRICS.inc("airplay_nowplaying_pipe_opens_total", **self._labels)
+                METRICS.set("airplay_nowplaying_pipe_capacity_bytes", self.capacity, **self._labels)
+            except OSError:
+                self._retry = now + 2  # pipe not created yet (shairport starting)
+        if self.writer.timeout() == 0:
+            self.writer.flush(self.state)
+        wait = self.writer.timeout()
+        if self.pipe is None:
+            reopen = max(0.0, self._retry - now)
+            wait = reopen if wait is None else min(wait, reopen)
+        return wait
+
+    def _open(self):
+        pipe = open_fifo(self.pipe_path)
+        self.capacity = set_pipe_size(pipe.fileno())
+        return pipe
+
+    def on_readable(self, _events) -> None:
+        """Drain the FIFO: read (as much as the buffer's free tail takes) and
+        parse until the pipe is empty or DRAIN_MAX has been taken."""
+        drained = 0
+        while drained < DRAIN_MAX:
+            try:
+                n = self.parser.readinto(self.pipe)
+            except OSError:
+                n, self._retry = 0, time.monotonic() + 2
+            if n is None:
+                break  # empty for now
+            if n == 0:  # writer (shairport) closed; reopen
+                self.close_pipe()
+                break
+            drained += n
+            self._consume(n)
+        if self.capacity and drained >= self.capacity:
+            METRICS.inc("airplay_nowplaying_pipe_full_total", **self._labels)
+
+    def _consume(self, n: int) -> None:
+        METRICS.inc("airplay_nowplaying_read_bytes_total", n, **self._labels)
+        self._apply_items(self.parser.parse())
+
+    def _apply_items(self, items) -> None:
+        t0 = time.perf_counter()
+        changed = False
+        for typ, code, payload in items:
+            METRICS.inc("airplay_nowplaying_items_total", tag=tag_label(typ, code), **self._labels)
+            if typ == SSNC and code == PICT and self.disk is not None:
+                if payload:  # the cover's name is set once it is on disk
+                    self.disk.submit(partial(store_cover, payload), self._cover_stored)
+                continue
+            changed |= apply_item(self.state, typ, code, payload)
+        METRICS.observe("airplay_nowplaying_parse_seconds", time.perf_counter() - t0)
+        if changed:
+            self._changed()
+
+    def _cover_stored(self, cover) -> None:
+        # a store that failed keeps the old cover; one that lands after the
+        # session ended belongs to nothing that is playing
+        if isinstance(cover, str) and self.state["active"] and self.state["cover"] != cover:
+            self.state["cover"] = cover
+            self._changed()
+
+    def _changed(self) -> None:
+        self.writer.mark()
+        if self.publisher is not None:
+            self.publisher.publish()
+
+    def close_pipe(self) -> None:
+        if self.pipe is not None:
+            self._sel.unregister(self.pipe)
+            self.pipe.close()
+            self.pipe = None
+
+    def export_metrics(self) -> None:
+        export_metrics(self.parser, self.publisher, self.zone, dump=False)
+
+
+# --- UDP ingest ------------------------------------------------------------
+# shairport-sync can send metadata as datagrams (metadata.socket_address/
+# socket_port) instead of, or as well as, writing the pipe. A sender never
+# blocks on a slow reader: what the socket buffer cannot hold is lost.
+#
+# Each datagram is one item, raw (no XML, no base64):
+#   type(4) code(4) payload
+# An item that does not fit in socket_msglength (a cover) is split into
+# ssnc/chnk datagrams, each carrying socket_msglength - 24 payload bytes:
+#   "ssnc" "chnk" index(u32 BE) count(u32 BE) type(4) code(4) chunk
+
+CHNK = 0x63686E6B
+_CHNK_HEADER = 24
+UDP_MSGLENGTH = 65000  # shairport's largest socket_msglength
+_DATAGRAM_MAX = 65536
+
+
+def parse_udp(source: str) -> tuple:
+    """'udp://127.0.0.1:5555' or 'udp://[::1]:5555' -> (host, port)."""
+    host, sep, port = source[len("udp://"):].rpartition(":")
+    if not source.startswith("udp://") or not sep or not host or not port.isdigit():
+        raise ValueError(f"bad UDP source {source!r} (want udp://HOST:PORT)")
+    return host.strip("[]"), int(port)
+
+
+def encode_datagrams(typ: int, code: int, payload: bytes, msglength: int = UDP_MSGLENGTH) -> list:
+    """The datagrams shairport-sync sends for one item."""
+    head = typ.to_bytes(4, "big") + code.to_bytes(4, "big")
+    if 8 + len(payload) <= msglength:
+        return [head + payload]
+    size = msglength - _CHNK_HEADER
+    count = (len(payload) + size - 1) // size
+    return [b"ssncchnk" + i.to_bytes(4, "big") + count.to_bytes(4, "big") + head
+            + payload[i * size:(i + 1) * size] for i in range(count)]
+
+
+class DatagramParser:
+    """Turns metadata datagrams back into (type, code, payload) items,
+    reassembling ssnc/chnk runs. Chunks of one item are kept until the run is
+    complete; a run that is superseded (its item restarts at index 0 or a
+    different item begins) or overruns MAX_BUF is abandoned and its bytes
+    counted as dropped, like garbage in the pipe stream.
+    """
+
+    def __init__(self, max_item: int = MAX_BUF):
+        self.max_item = max_item
+        self.dropped = 0     # bytes of short datagrams and abandoned runs
+        self.incomplete = 0  # abandoned chunked items
+        self.high_water = 0  # largest item reassembled
+        self._run = None     # (type, code, count)
+        self._parts = {}     # chunk index -> bytes
+        self._size = 0
+
+    def feed(self, datagram) -> tuple | None:
+        """One datagram (bytes-like; copied as needed) -> an item, or None
+        while a chunked item is still incomplete."""
+        if len(datagram) < 8:
+            self.dropped += len(datagram)
+            return None
+        typ = int.from_bytes(datagram[0:4], "big")
+        code = int.from_bytes(datagram[4:8], "big")
+        if typ != SSNC or code != CHNK:
+            return typ, code, bytes(datagram[8:])
+        if len(datagram) < _CHNK_HEADER:
+            self.dropped += len(datagram)
+            return None
+        index = int.from_bytes(datagram[8:12], "big")
+        count = int.from_bytes(datagram[12:16], "big")
+        run = (int.from_bytes(datagram[16:20], "big"), int.from_bytes(datagram[20:24], "big"), count)
+        if run != self._run or index == 0 or index in self._parts:
+            self._abandon()
+            self._run = run
+        if index >= count or self._size + len(datagram) > self.max_item:
+            self.dropped += len(datagram)
+            self._abandon()
+            return None
+        self._parts[index] = bytes(datagram[_CHNK_HEADER:])
+        self._size += len(datagram) - _CHNK_HEADER
+        if len(self._parts) < count:
+            return None
+        payload = b"".join(self._parts[i] for i in range(count))
+        self._run, self._parts, self._size = None, {}, 0
+        self.high_water = max(self.high_water, len(payload))
+        return run[0], run[1], payload
+
+    def _abandon(self) -> None:
+        if self._parts:
+            self.incomplete += 1
+            self.dropped += self._size
+        self._run, self._parts, self._size = None, {}, 0
+
+
+class UdpReader(ZoneReader):
+    """A zone fed by shairport's metadata datagrams instead of a FIFO. Same
+    state, writer, publisher and metrics; the socket sits in the shared
+    selector where the FIFO would."""
+
+    def __init__(self, sel, source: str, zone: str = "", disk: DiskWorker | None = None):
+        super().__init__(sel, source, zone, disk)
+        self.address = parse_udp(source)
+        self.parser = DatagramParser()
+        self._buf = bytearray(_DATAGRAM_MAX)
+        self._warned = False
+
+    def _open(self):
+        host, port = self.address
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
+            sock.bind((host, port))
+        except OSError:
+            sock.close()
+            raise
+        sock.setblocking(False)
+        # Linux reports double the size asked for (bookkeeping overhead)
+        self.capacity = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 2
+        if self.capacity < UDP_RCVBUF and not self._warned:
+            self._warned = True  # once, not on every rebind
+            print(f"airplay-nowplaying: UDP receive buffer is {self.capacity} bytes, not"
+                  f" {UDP_RCVBUF}; raise net.core.rmem_max or large covers will be lost",
+                  file=sys.stderr)
+        return sock
+
+    def on_readable(self, _events) -> None:
+        """Take every queued datagram, up to DRAIN_MAX bytes per wakeup."""
+        view, items, drained, datagrams = memoryview(self._buf), [], 0, 0
+        while drained < DRAIN_MAX:
+            try:
+                n = self.pipe.recv_into(self._buf)
+            except BlockingIOError:
+                break
+            except OSError:
+                self.close_pipe()  # rebound on the next poll()
+                break
+            drained += n
+            datagrams += 1
+            item = self.parser.feed(view[:n])
+            if item is not None:
+                items.append(item)
+        view.release()
+        METRICS.inc("airplay_nowplaying_read_bytes_total", drained, **self._labels)
+        METRICS.inc("airplay_nowplaying_datagrams_total", datagrams, **self._labels)
+        self._apply_items(items)
+
+    def export_metrics(self) -> None:
+        METRICS.set("airplay_nowplaying_incomplete_items_total", self.parser.incomplete, **self._labels)
+        super().export_metrics()
+
+
+def zone_reader(sel, source: str, zone: str = "", disk: DiskWorker | None = None) -> ZoneReader:
+    """The reader for a zone's source: a FIFO path or udp://HOST:PORT."""
+    cls = UdpReader if source.startswith("udp://") else ZoneReader
+    return cls(sel, source, zone, disk)
+
+
+def pump(sel, readers, timeout=None) -> None:
+    """One pass of the reader loop: poll every zone, wait at most `timeout`
+    (or until a zone needs a poll) for input, dispatch what is ready."""
+    for reader in readers:
+        wait = reader.poll()
+        if wait is not None:
+            timeout = wait if timeout is None else min(timeout, wait)
+    for key, events in sel.select(timeout):
+        key.data(events)
+
+
+def run(zones=None) -> None:  # pragma: no cover - I/O loop
+    """Serve [(zone, source), ...] (default: the one PIPE as zone "") forever."""
+    os.makedirs(STATE_DIR, exist_ok=True)
+    sel = selectors.DefaultSelector()
+    disk = DiskWorker(sel)
+    readers = [zone_reader(sel, source, zone, disk) for zone, source in (zones or [("", PIPE)])]
+    next_dump = time.monotonic()
+    while True:
+        if time.monotonic() >= next_dump:
+            for reader in readers:
+                reader.export_metrics()
+            try:
+                METRICS.dump()
+            except OSError:
+                pass
+            next_dump = time.monotonic() + METRICS_INTERVAL
+        pump(sel, readers, max(0.0, next_dump - time.monotonic()))
+
+
+# --- capture / replay ------------------------------------------------------
+# Recordings are the raw pipe bytes, so a capture replays through the code
+# path the reader runs: a ZoneReader's ItemParser (with cover spooling) ->
+# item application -> StateWriter, with covers and state files written on a
+# DiskWorker. Only the FIFO is replaced by the recording. Capture with the
+# airplay-nowplaying service stopped: a FIFO hands each byte to only one reader.
+
+
+def use_state_dir(path: str) -> None:
+    """Point every state/cover/socket/metrics path at another directory."""
+    global STATE_DIR, STATE_FILE, COVER_DIR, STATE_SOCKET, METRICS_FILE
+    STATE_DIR = path
+    STATE_FILE = os.path.join(path, "nowplaying.json")
+    COVER_DIR = os.path.join(path, "covers")
+    STATE_SOCKET = os.path.join(path, "nowplaying.sock")
+    METRICS_FILE = os.path.join(path, "metrics.prom")
+
+
+def capture(out, pipe_path: str = PIPE, seconds: float | None = None) -> int:
+    """Copy raw bytes from the metadata FIFO to the binary file out, across
+    shairport restarts, for `seconds` (default: until interrupted). Returns
+    the number of bytes recorded."""
+    deadline = None if seconds is None else time.monotonic() + seconds
+    sel = selectors.DefaultSelector()
+    pipe, total = None, 0
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            if pipe is None:
+                pipe = open_fifo(pipe_path)
+                sel.register(pipe, selectors.EVENT_READ)
+            wait = 1.0 if deadline is None else max(0.0, min(1.0, deadline - time.monotonic()))
+            if not sel.select(wait):
+                continue
+            data = pipe.read(READ_SIZE)
+            if data is None:
+                continue
+            if not data:  # writer closed; reopen and wait for the next one
+                sel.unregister(pipe)
+                pipe.close()
+                pipe = None
+                continue
+            out.write(data)
+            out.flush()
+            total += len(data)
+    finally:
+        if pipe is not None:
+            pipe.close()
+        sel.close()
+    return total
+
+
+def _percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def _timed_items(items, t_read: float, latencies: list):
+    for item in items:
+        yield item  # applied by the consumer before the next one is asked for
+        latencies.append(time.perf_counter() - t_read)
+
+
+def _settle(sel, disk: DiskWorker) -> None:
+    while disk.pending:
+        for key, events in sel.select(1.0):
+            key.data(events)
+
+
+def replay(reader, size: int = READ_SIZE, trace_memory: bool = False) -> dict:
+    """Feed a recorded stream (a binary reader, e.g. an open capture or a
+    BytesIO of synthetic items) through a ZoneReader as fast as it will go,
+    writing state and covers under STATE_DIR. Returns {bytes, items,
+    seconds (until the disk work is done too), mb_per_s, latency_p50/p99/max
+    (seconds from the read that completed an item to that item being
+    applied; covers are stored after that, as in the service), writes,
+    dropped, peak_bytes (with trace_memory)}."""
+    os.makedirs(STATE_DIR, exist_ok=True)
+    sel = selectors.DefaultSelector()
+    latencies = []
+    if trace_memory:
+        tracemalloc.start()
+    total = 0
+    disk = DiskWorker(sel)
+    zone = ZoneReader(sel, "", disk=disk)  # fed from the recording, never opened
+    t_start = time.perf_counter()
+    try:
+        while True:
+            n = zone.parser.readinto(reader, size)
+            if n is None:
+                continue
+            if not n:
+                break
+            total += n
+            zone._apply_items(_timed_items(zone.parser.parse(), time.perf_counter(), latencies))
+            for key, events in sel.select(0):
+                key.data(events)
+            if zone.writer.timeout() == 0:
+                zone.writer.flush(zone.state)
+        _settle(sel, disk)  # the last covers may still be on their way
+        if zone.writer.timeout() is not None:
+            zone.writer.flush(zone.state)
+        _settle(sel, disk)
+        seconds = time.perf_counter() - t_start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        if zone.publisher is not None:
+            zone.publisher.close()
+        disk.close()
+        sel.close()
+    latencies.sort()
+    return {
+        "bytes": total,
+        "items": len(latencies),
+        "seconds": seconds,
+        "mb_per_s": total / 1e6 / seconds if seconds else 0.0,
+        "latency_p50": _percentile(latencies, 0.50),
+        "latency_p99": _percentile(latencies, 0.99),
+        "latency_max": latencies[-1] if latencies else 0.0,
+        "writes": zone.writer.writes,
+        "dropped": zone.parser.dropped,
+        "peak_bytes": peak,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="airplay-nowplaying")
+    parser.add_argument("--pipe", default=f"udp://{UDP}" if UDP else PIPE,
+                        help="metadata FIFO or udp://HOST:PORT (default %(default)s)")
+    parser.add_argument("--zone", action="append", metavar="NAME=PIPE",
+                        help="also serve another shairport instance's pipe (repeatable;"
+                             " default $AIRPLAY_ZONES)")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="record the raw pipe bytes to FILE (stop the service first)")
+    parser.add_argument("--seconds", type=float, help="stop capturing after this long")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="feed a capture through the parser into a temp state dir; print stats")
+    args = parser.parse_args(argv)
+    if args.capture:
+        if args.pipe.startswith("udp://"):
+            parser.error("--capture records a FIFO; give its path with --pipe")
+        with open(args.capture, "wb") as out:
+            try:
+                total = capture(out, args.pipe, args.seconds)
+            except KeyboardInterrupt:
+                total = out.tell()
+        print(f"airplay-nowplaying: {total} bytes in {args.capture}", file=sys.stderr)
+        return 0
+    if args.replay:
+        with tempfile.TemporaryDirectory(prefix="airplay-replay-") as tmp, \
+                open(args.replay, "rb", buffering=0) as reader:
+            use_state_dir(tmp)
+            stats = replay(reader, trace_memory=True)
+        print(json.dumps(stats))
+        return 0
+    try:
+        zones = parse_zones(",".join(args.zone) if args.zone else ZONES)
+        if args.pipe.startswith("udp://"):
+            parse_udp(args.pipe)
+    except ValueError as exc:
+        parser.error(str(exc))
+    run([("", args.pipe)] + zones)
+    return 0
 
 
 if __name__ == "__main__":  # pragma: no cover
-    run()
+    sys.exit(main())
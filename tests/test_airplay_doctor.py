@@ -1,5 +1,11 @@
 import importlib.util
+import io
+import json
 import pathlib
+import threading
+import time
+
+import pytest
 
 SRC = pathlib.Path(__file__).resolve().parents[1] / "roles/airplay/files/airplay_doctor.py"
 _spec = importlib.util.spec_from_file_location("airplay_doctor", SRC)
@@ -132,6 +138,268 @@ def test_report_ok_when_device_id_not_pinned():
 def test_main_json_exit_code(capsys):
     rc = ad.main(["--json"], runner=_fixture_runner())
     out = capsys.readouterr().out
-    import json
     assert json.loads(out)["ok"] is True
     assert rc == 0
+
+
+def _slow_runner(delays, overrides=None):
+    fixture = _fixture_runner(overrides)
+
+    def run(name):
+        time.sleep(delays.get(name, 0))
+        return fixture(name)
+    return run
+
+
+def test_probes_run_concurrently_and_are_timed():
+    t0 = time.monotonic()
+    r = ad.build_report(_slow_runner({name: 0.2 for name in ad.PROBES}))
+    assert time.monotonic() - t0 < 0.2 * 3  # the slowest probe, not the sum
+    assert r["ok"] is True
+    assert set(r["probes"]) == set(ad.PROBES)
+    assert all(p["seconds"] >= 0.2 and not p["timeout"] for p in r["probes"].values())
+
+
+def test_hung_probe_fails_its_checks_with_timeout():
+    t0 = time.monotonic()
+    r = ad.build_report(_slow_runner({"mdns": 5}), timeout=0.2)
+    assert time.monotonic() - t0 < 1
+    checks = {c["name"]: c for c in r["checks"]}
+    assert checks["mdns:airplay"] == {"name": "mdns:airplay", "ok": False, "detail": "timeout"}
+    assert checks["mdns:raop"]["detail"] == "timeout"
+    assert checks["service:nqptp"]["ok"] is True
+    assert r["ok"] is False and r["probes"]["mdns"]["timeout"] is True
+
+
+def test_run_deadline_bounds_the_whole_report():
+    t0 = time.monotonic()
+    r = ad.build_report(_slow_runner({"journal": 5, "aplay": 5}), timeout=10, total=0.3)
+    assert time.monotonic() - t0 < 1
+    assert {n for n, p in r["probes"].items() if p["timeout"]} == {"journal", "aplay"}
+
+
+def test_capture_timeout_kills_command():
+    with pytest.raises(TimeoutError):
+        ad._capture(["sleep", "5"], timeout=0.1)
+    assert ad._capture(["definitely-not-a-command-xyz"]) == ""
+
+
+class _Clock:
+    def __init__(self):
+        self.t = 1000.0
+
+    def __call__(self):
+        return self.t
+
+
+def test_doctor_runs_each_probe_on_its_schedule():
+    calls = []
+    fixture = _fixture_runner()
+    clock = _Clock()
+    doctor = ad.Doctor(lambda name: calls.append(name) or fixture(name), clock=clock)
+    assert doctor.report() is None
+    assert doctor.tick() == ad.SERVICE_INTERVAL
+    assert sorted(calls) == sorted(ad.PROBES)
+    calls.clear()
+    clock.t += ad.SERVICE_INTERVAL
+    doctor.tick()
+    assert sorted(calls) == sorted(f"is_active:{svc}" for svc in ad.SERVICES)
+    calls.clear()
+    clock.t += ad.PROBE_INTERVALS["ss"] - ad.SERVICE_INTERVAL
+    doctor.tick()
+    assert "ss" in calls and "mdns" not in calls
+    report = doctor.report()
+    assert report["ok"] is True and report["source"] == "daemon"
+    assert all(p["age"] >= 0 for p in report["probes"].values())
+
+
+def test_doctor_history_records_transitions():
+    state = {"is_active:nqptp": "active"}
+    fixture = _fixture_runner()
+    clock = _Clock()
+    doctor = ad.Doctor(lambda name: state.get(name, fixture(name)), clock=clock)
+    for nqptp in ("active", "active", "inactive", "inactive", "active"):
+        state["is_active:nqptp"] = nqptp
+        doctor.tick()
+        clock.t += ad.SERVICE_INTERVAL
+    assert [h["failed"] for h in doctor.history] == [[], ["service:nqptp"], []]
+
+
+def test_check_reads_from_daemon_and_falls_back(tmp_path, capsys, monkeypatch):
+    path = str(tmp_path / "doctor.sock")
+    assert ad.query_daemon("report", path) is None  # nothing listening
+    doctor = ad.Doctor(_fixture_runner({"is_active:nqptp": "inactive"}))
+    doctor.tick()
+    server = ad.serve(doctor, path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        monkeypatch.setattr(ad, "build_report", lambda *a, **kw: pytest.fail("probed directly"))
+        assert ad.main(["--check", "--json", "--socket", path]) == 1
+        report = json.loads(capsys.readouterr().out)
+        assert report["source"] == "daemon" and report["ok"] is False
+        assert ad.main(["--history", "--socket", path]) == 0
+        assert json.loads(capsys.readouterr().out)[0]["failed"] == ["service:nqptp"]
+    finally:
+        server.shutdown()
+        server.server_close()
+    monkeypatch.undo()
+    rc = ad.main(["--check", "--json", "--socket", path], runner=_fixture_runner())
+    assert rc == 0 and "source" not in json.loads(capsys.readouterr().out)
+
+
+def _entry(cursor, message, ts):
+    return json.dumps({"__CURSOR": cursor, "MESSAGE": message,
+                       "__REALTIME_TIMESTAMP": str(int(ts * 1e6))})
+
+
+def test_journal_scanner_reads_after_saved_cursor(tmp_path, monkeypatch):
+    now = 1_700_000_000.0
+    batches = [
+        "\n".join([_entry("c1", "ALSA underrun", now - 7200), _entry("c2", "hello", now - 60),
+                   _entry("c3", "lost sync with source", now - 30)]),
+        _entry("c4", "xrun (overrun) detected", now - 10),
+        "",
+    ]
+    seen = []
+
+    class Done:
+        def __init__(self, stdout):
+            self.stdout, self.returncode = stdout, 0
+
+    def fake_run(cmd, **kw):
+        seen.append(cmd)
+        return Done(batches.pop(0))
+    monkeypatch.setattr(ad.subprocess, "run", fake_run)
+    scanner = ad.JournalScanner(str(tmp_path), clock=lambda: now)
+    first = scanner.scan()
+    assert seen[0][-2:] == ["-n", str(ad.JOURNAL_BOOTSTRAP)]
+    assert first["new"] == {"xruns": 1, "sync": 1}
+    assert first["windows"]["5m"]["sync"] == 1 and first["windows"]["5m"]["xruns"] == 0
+    assert first["windows"]["24h"]["xruns"] == 1
+    second = ad.JournalScanner(str(tmp_path), clock=lambda: now).scan()
+    assert seen[1][-1] == "--after-cursor=c3"
+    assert second["new"] == {"xruns": 1, "sync": 0}  # old errors are not recounted
+    assert second["windows"]["1h"] == {"xruns": 1, "sync": 1, "xruns_per_hour": 1.0,
+                                       "sync_per_hour": 1.0}
+    third = scanner.scan()
+    assert seen[2][-1] == "--after-cursor=c4" and third["new"] == {"xruns": 0, "sync": 0}
+
+
+def test_journal_scanner_restarts_when_cursor_is_gone(tmp_path, monkeypatch):
+    scanner = ad.JournalScanner(str(tmp_path))
+    scanner.save({"cursor": "vacuumed", "minutes": {}})
+    seen = []
+
+    class Done:
+        def __init__(self, cmd):
+            self.returncode = 1 if "--after-cursor=vacuumed" in cmd else 0
+            self.stdout = "" if self.returncode else _entry("fresh", "ok", time.time())
+
+    monkeypatch.setattr(ad.subprocess, "run", lambda cmd, **kw: seen.append(cmd) or Done(cmd))
+    scanner.scan()
+    assert seen[1][-2:] == ["-n", str(ad.JOURNAL_BOOTSTRAP)]
+    assert scanner.load()["cursor"] == "fresh"
+
+
+def test_journal_check_reports_new_errors_and_rates():
+    summary = {"new": {"xruns": 2, "sync": 0},
+               "windows": {"1h": {"xruns": 5, "sync": 1, "xruns_per_hour": 5.0, "sync_per_hour": 1.0}}}
+    r = ad.build_report(_fixture_runner({"journal": json.dumps(summary)}))
+    check = next(c for c in r["checks"] if c["name"] == "journal:errors")
+    assert check["ok"] is False
+    assert check["detail"] == "2 new xruns, 0 new sync errors (last hour: 5 xruns, 1 sync)"
+    assert r["journal"] == summary
+
+
+# The pre-regex parsers, kept as the reference for the single-pass ones.
+def _legacy_parse_listening_ports(ss_output, ports=(319, 320)):
+    import re
+    result = {p: {"bound": False, "nqptp": False} for p in ports}
+    for line in ss_output.splitlines():
+        for p in ports:
+            if re.search(rf"[:.]{p}\b", line):
+                result[p]["bound"] = True
+                if "nqptp" in line:
+                    result[p]["nqptp"] = True
+    return result
+
+
+def _legacy_parse_journal_errors(journal_text):
+    counts = {"xruns": 0, "sync": 0}
+    for line in journal_text.splitlines():
+        low = line.lower()
+        if "underrun" in low or "overrun" in low or "xrun" in low:
+            counts["xruns"] += 1
+        if "lost sync" in low or "resync" in low or "out of sync" in low or "sync error" in low:
+            counts["sync"] += 1
+    return counts
+
+
+_JOURNAL_BITS = ["ALSA ", "UNDERRUN", "underrun", "Overrun", "xRun", "lost sync", "LOST SYNC",
+                 "resync", "Out Of Sync", "sync error", "sync", "lost  sync", "ſync", "loſt sync",
+                 "İ", "K", " ", "\n", "\r\n", "\r", "\x0b", "\x85", " ", "\x1e", "x", "run",
+                 "under", "re", "out of ", "error"]
+_SS_BITS = ["0.0.0.0", ":319", ":320", ".319", ":3190", ":0319", "319", "[::]", ":320a", ":320é",
+            ":٣١٩", "319٣", ":", ".", " ", "\n", "nqptp", "users:((", "*:320", "1319", "::320"]
+
+
+def test_single_pass_parsers_match_legacy_exactly():
+    import random
+    rng = random.Random(1234)
+    for _ in range(3000):
+        text = "".join(rng.choice(_JOURNAL_BITS) for _ in range(rng.randint(0, 40)))
+        assert ad.parse_journal_errors(text) == _legacy_parse_journal_errors(text), repr(text)
+        assert all(ad.classify_journal_line(line) == tuple(
+            v == 1 for v in _legacy_parse_journal_errors(line).values())
+            for line in text.splitlines())
+        ss = "".join(rng.choice(_SS_BITS) for _ in range(rng.randint(0, 30)))
+        for ports in ((319, 320), (5353,), (320, 3190)):
+            assert ad.parse_listening_ports(ss, ports) == _legacy_parse_listening_ports(ss, ports), repr(ss)
+
+
+def _host_report(host, overrides=None, device_id="5C:AA:FD:11:22:33"):
+    runner = _fixture_runner(dict(overrides or {}, config=f'airplay_device_id = "{device_id}";'))
+    return dict(ad.build_report(runner), host=host)
+
+
+def test_aggregate_groups_failures_and_duplicate_ids():
+    reports = [
+        _host_report("kitchen", device_id="5C:AA:FD:00:00:01"),
+        _host_report("den", {"is_active:nqptp": "inactive"}, device_id="5c:aa:fd:00:00:02"),
+        _host_report("attic", {"is_active:nqptp": "inactive"}, device_id="5C:AA:FD:00:00:02"),
+        _host_report("porch", {"mdns": ""}, device_id="5C:AA:FD:00:00:03"),
+    ]
+    reports[0]["probes"]["journal"] = {"seconds": 9.5, "timeout": True}
+    summary = ad.aggregate(reports)
+    assert summary["ok"] is False
+    assert summary["hosts"] == 4 and summary["failing"] == 3
+    assert summary["check_failures"]["service:nqptp"] == 2
+    assert summary["signatures"][0] == {"failed": ["service:nqptp"], "hosts": ["attic", "den"]}
+    assert summary["duplicate_device_ids"] == {"5c:aa:fd:00:00:02": ["attic", "den"]}
+    assert summary["slowest_probes"][0] == {"host": "kitchen", "probe": "journal",
+                                            "seconds": 9.5, "timeout": True}
+
+
+def test_aggregate_ignores_unpinned_device_ids():
+    reports = [_host_report(h, device_id="") for h in ("a", "b")]
+    for r in reports:
+        r["device_id"] = ""
+    assert ad.aggregate(reports)["duplicate_device_ids"] == {}
+
+
+def test_aggregate_reads_directory_and_stdin(tmp_path, capsys, monkeypatch):
+    good = _host_report("kitchen")
+    bad = _host_report("den", {"is_active:nqptp": "inactive"}, device_id="5C:AA:FD:00:00:09")
+    (tmp_path / "kitchen.json").write_text(json.dumps(good))
+    (tmp_path / "den.json").write_text(json.dumps(bad, indent=2))
+    (tmp_path / "notes.txt").write_text("ignored")
+    assert ad.main(["--aggregate", str(tmp_path), "--json"]) == 1
+    summary = json.loads(capsys.readouterr().out)
+    assert summary["hosts"] == 2 and summary["signatures"][0]["hosts"] == ["den"]
+
+    stream = json.dumps(good) + "\nssh: connect to host porch: timed out\n" + json.dumps(good)
+    monkeypatch.setattr(ad.sys, "stdin", io.StringIO(stream))
+    assert ad.main(["--aggregate"]) == 1
+    out = capsys.readouterr().out
+    assert "2 hosts, 0 failing, 1 unreadable" in out
+    assert "duplicate device-id 5c:aa:fd:11:22:33: kitchen, kitchen" in out
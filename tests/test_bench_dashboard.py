@@ -0,0 +1,142 @@
+"""Opt-in load test for the dashboard servers: AIRPLAY_BENCH=1 pytest -s tests/test_bench_dashboard.py"""
+import asyncio
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import time
+
+import pytest
+
+SRC = pathlib.Path(__file__).resolve().parents[1] / "roles/airplay/files/airplay_dashboard.py"
+
+pytestmark = pytest.mark.skipif(not os.environ.get("AIRPLAY_BENCH"), reason="set AIRPLAY_BENCH=1")
+
+DURATION = 2.0
+REQUEST = b"GET /api/status HTTP/1.1\r\nHost: bench\r\n\r\n"
+
+# Runs in a child process so the load generator does not share its GIL.
+_SERVER = r"""
+import asyncio, importlib.util, json, sys
+spec = importlib.util.spec_from_file_location("airplay_dashboard", sys.argv[1])
+db = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(db)
+health = db.HealthMonitor(probe=lambda units: {u: True for u in units})
+health.refresh()
+if sys.argv[3:] == ["uncached"]:
+    # the pre-cache /api/status: open + parse nowplaying.json, then dumps, per request
+    def status_entity(health=None):
+        with open(db.STATE_FILE, encoding="utf-8") as fh:
+            nowplaying = json.load(fh)
+        status = {"name": db.NAME, "nowplaying": nowplaying, "services": health.get()}
+        return db.Entity(json.dumps(status).encode(), "application/json")
+    db.status_entity = status_entity
+if sys.argv[2] == "async":
+    async def main():
+        server = db.AsyncServer("127.0.0.1", 0)
+        server.health = health
+        await server.start()
+        print(server.server_port, flush=True)
+        await server.serve_forever()
+    asyncio.run(main())
+else:
+    server = db.ThreadingHTTPServer(("127.0.0.1", 0), db.Handler)
+    server.health = health
+    print(server.server_port, flush=True)
+    server.serve_forever()
+"""
+
+
+async def _request(conn, port):
+    if conn is None:
+        conn = await asyncio.open_connection("127.0.0.1", port)
+    reader, writer = conn
+    writer.write(REQUEST)
+    head = await reader.readuntil(b"\r\n\r\n")
+    assert head.split(b" ", 2)[1] == b"200"
+    length = int(head.lower().split(b"content-length:", 1)[1].split(b"\r\n", 1)[0])
+    await reader.readexactly(length)
+    if head.startswith(b"HTTP/1.0") or b"connection: close" in head.lower():
+        writer.close()
+        return None
+    return conn
+
+
+async def _load(port, clients):
+    latencies, errors = [], 0
+    stop = time.perf_counter() + DURATION
+
+    async def client():
+        nonlocal errors
+        conn = None
+        while time.perf_counter() < stop:
+            t0 = time.perf_counter()
+            try:
+                conn = await _request(conn, port)
+            except (OSError, asyncio.IncompleteReadError):
+                errors += 1  # refused / reset under load: counted, then reconnect
+                conn = None
+                continue
+            latencies.append(time.perf_counter() - t0)
+        if conn:
+            conn[1].close()
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    elapsed = time.perf_counter() - t0
+    latencies.sort()
+    return len(latencies) / elapsed, latencies[int(len(latencies) * 0.99) - 1], errors
+
+
+def _serve(mode, state_dir, *extra):
+    env = dict(os.environ, AIRPLAY_STATE_DIR=str(state_dir))
+    proc = subprocess.Popen([sys.executable, "-c", _SERVER, str(SRC), mode, *extra],
+                            stdout=subprocess.PIPE, env=env, text=True)
+    return proc, int(proc.stdout.readline())
+
+
+def test_bench_threaded_vs_async_server(tmp_path):
+    (tmp_path / "nowplaying.json").write_text(json.dumps(
+        {"active": True, "title": "Song", "artist": "Artist", "album": "Album",
+         "volume_percent": 40, "muted": False, "cover": None}))
+    results = {}
+    for mode in ("threaded", "async"):
+        proc, port = _serve(mode, tmp_path)
+        try:
+            for clients in (1, 10, 100):
+                results[mode, clients] = asyncio.run(_load(port, clients))
+        finally:
+            proc.terminate()
+            proc.wait()
+    print()
+    for (mode, clients), (rps, p99, errors) in results.items():
+        print(f"{mode:8s} {clients:3d} clients  {rps:8.0f} req/s  p99 {p99 * 1000:7.2f} ms"
+              f"  errors {errors}")
+    # keep-alive and no thread per connection: it must hold up under many clients
+    assert results["async", 100][0] > 0.5 * results["threaded", 100][0]
+    assert results["async", 100][2] == 0
+
+
+def test_bench_status_cache(tmp_path):
+    """/api/status throughput with nowplaying.json read+parsed+dumped per
+    request vs. the stat-validated, pre-serialized cache."""
+    (tmp_path / "nowplaying.json").write_text(json.dumps(
+        {"active": True, "title": "Song " * 20, "artist": "Artist", "album": "Album",
+         "volume_percent": 40, "muted": False, "cover": "covers/" + "ab" * 32 + ".jpg",
+         "duration": 215.0, "position": 12.5, "position_at": 1.7e9, "paused": False,
+         "updated": 1.7e9}))
+    results = {}
+    for mode in ("threaded", "async"):
+        for cache in ("uncached", "cached"):
+            proc, port = _serve(mode, tmp_path, cache)
+            try:
+                for clients in (10, 100):
+                    results[mode, cache, clients] = asyncio.run(_load(port, clients))
+            finally:
+                proc.terminate()
+                proc.wait()
+    print()
+    for (mode, cache, clients), (rps, p99, errors) in results.items():
+        print(f"{mode:8s} {cache:8s} {clients:3d} clients  {rps:8.0f} req/s"
+              f"  p99 {p99 * 1000:7.2f} ms  errors {errors}")
+    assert results["async", "cached", 100][0] > results["async", "uncached", 100][0]
@@ -0,0 +1,87 @@
+"""Opt-in benchmarks for the doctor's parsers: AIRPLAY_BENCH=1 pytest -s tests/test_bench_doctor.py"""
+import importlib.util
+import os
+import pathlib
+import random
+import re
+import time
+
+import pytest
+
+SRC = pathlib.Path(__file__).resolve().parents[1] / "roles/airplay/files/airplay_doctor.py"
+_spec = importlib.util.spec_from_file_location("airplay_doctor", SRC)
+ad = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(ad)
+
+pytestmark = pytest.mark.skipif(not os.environ.get("AIRPLAY_BENCH"), reason="set AIRPLAY_BENCH=1")
+
+LINES = 100_000
+
+
+# The pre-regex parsers: lower() + seven substring scans per journal line, a
+# freshly formatted regex per port per ss line.
+def _legacy_journal(journal_text):
+    counts = {"xruns": 0, "sync": 0}
+    for line in journal_text.splitlines():
+        low = line.lower()
+        if "underrun" in low or "overrun" in low or "xrun" in low:
+            counts["xruns"] += 1
+        if "lost sync" in low or "resync" in low or "out of sync" in low or "sync error" in low:
+            counts["sync"] += 1
+    return counts
+
+
+def _legacy_ports(ss_output, ports=(319, 320)):
+    result = {p: {"bound": False, "nqptp": False} for p in ports}
+    for line in ss_output.splitlines():
+        for p in ports:
+            if re.search(rf"[:.]{p}\b", line):
+                result[p]["bound"] = True
+                if "nqptp" in line:
+                    result[p]["nqptp"] = True
+    return result
+
+
+def _journal(n):
+    rng = random.Random(7)
+    normal = ["Connection from 192.168.1.20 on port 7000", "Playback started",
+              "Volume set to -12.5 dB", "Buffer size 8820 frames", "Session ended"]
+    errors = ["ALSA: underrun occurred", "Lost sync with the source", "resync requested",
+              "XRUN detected on hw:0"]
+    return "\n".join(
+        f"Jan 01 00:00:{i % 60:02d} box shairport-sync[612]: "
+        + (rng.choice(errors) if rng.random() < 0.01 else rng.choice(normal))
+        for i in range(n))
+
+
+def _ss(n):
+    rng = random.Random(7)
+    return "\n".join(
+        f"UNCONN 0 0 10.0.{i % 250}.{i % 200}:{rng.randint(1024, 65000)} 0.0.0.0:* "
+        f'users:(("proc{i % 9}",pid={i},fd=4))' for i in range(n)
+    ) + '\nUNCONN 0 0 0.0.0.0:319 0.0.0.0:* users:(("nqptp",pid=1,fd=4))\n'
+
+
+def _best(fn, arg, rounds=3):
+    times = []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        result = fn(arg)
+        times.append(time.perf_counter() - t0)
+    return min(times), result
+
+
+def test_bench_single_pass_parsers():
+    journal, ss = _journal(LINES), _ss(LINES)
+    rows = []
+    for label, old, new, text in (("journal", _legacy_journal, ad.parse_journal_errors, journal),
+                                  ("ss", _legacy_ports, ad.parse_listening_ports, ss)):
+        t_old, r_old = _best(old, text)
+        t_new, r_new = _best(new, text)
+        assert r_new == r_old
+        rows.append((label, t_old, t_new))
+    print()
+    for label, t_old, t_new in rows:
+        print(f"{label:8s} {LINES} lines  legacy {t_old * 1000:7.1f} ms  single-pass {t_new * 1000:7.1f} ms"
+              f"  ({t_old / t_new:.1f}x)")
+    assert all(t_new < t_old for _, t_old, t_new in rows)
@@ -0,0 +1,385 @@
+"""Opt-in benchmarks for the metadata reader: AIRPLAY_BENCH=1 pytest -s tests/test_bench_nowplaying.py"""
+import base64
+import importlib.util
+import io
+import os
+import pathlib
+import re
+import selectors
+import socket
+import threading
+import time
+import tracemalloc
+
+import pytest
+
+SRC = pathlib.Path(__file__).resolve().parents[1] / "roles/airplay/files/airplay_nowplaying.py"
+_spec = importlib.util.spec_from_file_location("airplay_nowplaying", SRC)
+np = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(np)
+
+pytestmark = pytest.mark.skipif(not os.environ.get("AIRPLAY_BENCH"), reason="set AIRPLAY_BENCH=1")
+
+CHUNK = 4096
+
+# The pre-ItemParser reader: regex over the whole buffer after every read.
+_RESCAN_RE = re.compile(
+    rb"<item><type>([0-9a-fA-F]{8})</type><code>([0-9a-fA-F]{8})</code>"
+    rb"<length>(\d+)</length>"
+    rb"(?:\s*<data encoding=\"base64\">\s*([A-Za-z0-9+/=\s]*?)</data>)?\s*</item>",
+    re.S,
+)
+
+
+def _rescan_feed(stream: bytes) -> int:
+    buf, n = b"", 0
+    for i in range(0, len(stream), CHUNK):
+        buf += stream[i:i + CHUNK]
+        last = 0
+        for m in _RESCAN_RE.finditer(buf):
+            n += 1
+            last = m.end()
+        buf = buf[last:]
+    return n
+
+
+def _parser_feed(stream: bytes) -> int:
+    parser, n = np.ItemParser(), 0
+    for i in range(0, len(stream), CHUNK):
+        n += len(parser.feed(stream[i:i + CHUNK]))
+    return n
+
+
+def _cover_stream(size: int) -> bytes:
+    cover = b"\xff\xd8\xff" + os.urandom(size)
+    b64 = base64.b64encode(cover).decode()
+    return (f"<item><type>73736e63</type><code>50494354</code><length>{len(cover)}</length>"
+            f'\n<data encoding="base64">\n{b64}</data></item>\n').encode()
+
+
+def _timed(fn, stream) -> float:
+    t0 = time.perf_counter()
+    assert fn(stream) == 1
+    return time.perf_counter() - t0
+
+
+def test_bench_parser_cost_is_linear_in_cover_size():
+    sizes = [512 * 1024, 1024 * 1024, 2 * 1024 * 1024, 4 * 1024 * 1024]
+    rows = []
+    for size in sizes:
+        stream = _cover_stream(size)
+        # the rescan baseline is quadratic; only time it on the smaller covers
+        full = _timed(_rescan_feed, stream) if size <= 1024 * 1024 else float("nan")
+        rows.append((size, _timed(_parser_feed, stream), full))
+    print()
+    for size, inc, full in rows:
+        print(f"cover {size >> 10:6d} KiB  incremental {inc * 1000:8.1f} ms  rescan {full * 1000:8.1f} ms")
+    # 8x the bytes: linear stays well under 8x^2 growth (allow noise)
+    (s0, inc0, _), (s1, inc1, _) = rows[0], rows[-1]
+    assert inc1 / inc0 < 3 * (s1 / s0)
+
+
+def _concat_reader(stream: bytes) -> None:
+    # the pre-bytearray receive path: immutable concat + prefix slicing per read
+    buf = b""
+    for i in range(0, len(stream), CHUNK):
+        buf += stream[i:i + CHUNK]
+        cut = buf.rfind(b"</item>")
+        if cut != -1:
+            buf = buf[cut + 7:]
+
+
+def _readinto_reader(stream: bytes) -> None:
+    parser, reader = np.ItemParser(), io.BytesIO(stream)
+    while parser.readinto(reader):
+        parser.parse()
+
+
+def _spooling_reader(stream: bytes) -> None:
+    parser, reader = np.ItemParser(spool=np.cover_spool), io.BytesIO(stream)
+    while parser.readinto(reader):
+        for _typ, _code, payload in parser.parse():
+            if isinstance(payload, np.CoverSpool):
+                payload.discard()
+
+
+def _traced(fn, stream):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    fn(stream)
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def test_bench_receive_path_memory(monkeypatch, tmp_path):
+    monkeypatch.setattr(np, "STATE_DIR", str(tmp_path))
+    size = 4 * 1024 * 1024
+    stream = _cover_stream(size) + b"".join(
+        f"<item><type>636f7265</type><code>6d696e6d</code><length>4</length>"
+        f'<data encoding="base64">U29uZw==</data></item>'.encode() for _ in range(2000))
+    print()
+    peaks = {}
+    for label, fn in (("bytes concat", _concat_reader), ("readinto", _readinto_reader),
+                      ("spool to disk", _spooling_reader)):
+        elapsed, peaks[label] = _traced(fn, stream)
+        print(f"{label:13s} {elapsed * 1000:8.1f} ms  peak {peaks[label] / 2**20:6.1f} MiB"
+              f"  (stream {len(stream) / 2**20:.1f} MiB)")
+    # buffer sized once from <length> + the decoded cover, no per-read copies
+    assert peaks["readinto"] < 2 * len(stream)
+    # streamed covers: bounded by the receive buffer and the in-memory spool
+    # (covers up to SPOOL_MEM stay in memory), not the cover
+    assert peaks["spool to disk"] < np.SPOOL_MEM + 4 * np.READ_BUF
+
+
+def _item(tag_type: str, tag_code: str, payload: bytes = b"") -> bytes:
+    data = f'\n<data encoding="base64">\n{base64.b64encode(payload).decode()}</data>' if payload else ""
+    return (f"<item><type>{tag_type.encode().hex()}</type><code>{tag_code.encode().hex()}</code>"
+            f"<length>{len(payload)}</length>{data}</item>\n").encode()
+
+
+def synthetic_capture(tracks: int, cover_size: int) -> bytes:
+    """What shairport-sync writes for `tracks` track changes, each with a
+    distinct cover of cover_size bytes and a few volume changes."""
+    out = [_item("ssnc", "pbeg")]
+    for t in range(tracks):
+        out += [_item("ssnc", "mdst"), _item("core", "minm", f"Track {t}".encode()),
+                _item("core", "asar", b"Artist"), _item("core", "asal", f"Album {t // 10}".encode()),
+                _item("ssnc", "mden"), _item("ssnc", "pcst"),
+                _item("ssnc", "PICT", b"\xff\xd8\xff" + os.urandom(cover_size)),
+                _item("ssnc", "pcen")]
+        out += [_item("ssnc", "pvol", f"{-v:.2f},0.00,0.00,0.00".encode()) for v in range(5)]
+    out.append(_item("ssnc", "pend"))
+    return b"".join(out)
+
+
+def _replayed(stream: bytes, state_dir: pathlib.Path) -> dict:
+    # timed and memory-traced in separate runs: tracemalloc slows every allocation
+    np.use_state_dir(str(state_dir / "timed"))
+    stats = np.replay(io.BytesIO(stream))
+    np.use_state_dir(str(state_dir / "traced"))
+    stats["peak_bytes"] = np.replay(io.BytesIO(stream), trace_memory=True)["peak_bytes"]
+    return stats
+
+
+def test_bench_replay(monkeypatch, tmp_path):
+    """Replay synthetic captures (and AIRPLAY_CAPTURE=<file> if set, from
+    `airplay-nowplaying --capture`) through the full reader pipeline."""
+    for name in ("STATE_DIR", "STATE_FILE", "COVER_DIR", "STATE_SOCKET", "METRICS_FILE"):
+        monkeypatch.setattr(np, name, getattr(np, name))  # restored after use_state_dir
+    monkeypatch.setattr(np, "COVER_CACHE_BYTES", 8 * 1024 * 1024)
+    cases = [(f"{t} tracks x {size >> 10} KiB covers", synthetic_capture(t, size))
+             for t, size in ((200, 16 * 1024), (50, 512 * 1024), (10, 4 * 1024 * 1024))]
+    if os.environ.get("AIRPLAY_CAPTURE"):
+        cases.append(("capture " + os.environ["AIRPLAY_CAPTURE"],
+                      pathlib.Path(os.environ["AIRPLAY_CAPTURE"]).read_bytes()))
+    print()
+    for i, (label, stream) in enumerate(cases):
+        stats = _replayed(stream, tmp_path / str(i))
+        print(f"{label:34s} {stats['bytes'] / 2**20:7.1f} MiB  {stats['mb_per_s']:7.1f} MB/s"
+              f"  items {stats['items']:6d}  p50 {stats['latency_p50'] * 1e6:7.1f} us"
+              f"  p99 {stats['latency_p99'] * 1e6:8.1f} us  peak {stats['peak_bytes'] / 2**20:5.1f} MiB"
+              f"  writes {stats['writes']}")
+        assert stats["bytes"] == len(stream) and stats["items"] == stream.count(b"</item>")
+        # covers stream to disk: memory stays bounded by the buffers, not the cover
+        assert stats["peak_bytes"] < 4 * (np.READ_BUF + np.SPOOL_MEM)
+        # bursts coalesce: never more than one write per item
+        assert 1 <= stats["writes"] <= stats["items"]
+
+
+# The pre-table dispatcher: tag strings, a fresh field map and an if/elif
+# chain per item (no progress handling).
+def _legacy_apply_item(state, typ, code, payload):
+    changed = False
+    if typ == np.CORE:
+        tag = np.code_to_str(code)
+        field = {"minm": "title", "asar": "artist", "asal": "album"}.get(tag)
+        if field is not None:
+            value = payload.decode("utf-8", "replace")
+            if state.get(field) != value:
+                state[field] = value
+                changed = True
+    elif typ == np.SSNC:
+        tag = np.code_to_str(code)
+        if tag == "pbeg":
+            if not state["active"]:
+                state["active"] = True
+                changed = True
+        elif tag == "pend":
+            state.update(np.empty_state())
+            changed = True
+        elif tag == "pvol":
+            vol = np.parse_pvol(payload)
+            if (vol["percent"], vol["muted"]) != (state["volume_percent"], state["muted"]):
+                state["volume_percent"] = vol["percent"]
+                state["muted"] = vol["muted"]
+                changed = True
+    return changed
+
+
+# One track as shairport-sync sends it: most tags are ones the reader ignores.
+_TRACK_TAGS = [("ssnc", "mdst", b"1000")] + [
+    ("core", tag, b"x") for tag in ("mikd", "asal", "asar", "ascm", "asgn", "asdk", "ascp",
+                                    "asct", "ascr", "astn", "asyr", "aeNV", "mper", "asai",
+                                    "asbr", "asco", "minm", "caps")
+] + [("core", "astm", (215_000).to_bytes(4, "big")), ("ssnc", "mden", b"1000"),
+     ("ssnc", "pcst", b"1000"), ("ssnc", "pcen", b"1000"),
+     ("ssnc", "prgr", b"1000/45100/9000000"), ("ssnc", "pvol", b"-12.00,0.00,0.00,0.00"),
+     ("ssnc", "pvol", b"-10.00,0.00,0.00,0.00"), ("ssnc", "pbeg", b"")]
+
+
+def test_bench_item_dispatch():
+    items = [(int(t.encode().hex(), 16), int(c.encode().hex(), 16), p) for t, c, p in _TRACK_TAGS]
+    rounds = 20_000
+    rates = {}
+    for label, apply in (("if/elif", _legacy_apply_item), ("table", np.apply_item)):
+        best = float("inf")
+        for _ in range(3):
+            state = np.empty_state()
+            t0 = time.perf_counter()
+            for _ in range(rounds):
+                for typ, code, payload in items:
+                    apply(state, typ, code, payload)
+            best = min(best, time.perf_counter() - t0)
+        rates[label] = rounds * len(items) / best
+    print()
+    for label, rate in rates.items():
+        print(f"{label:8s} {rate / 1e6:6.2f} M items/s")
+    assert rates["table"] > rates["if/elif"]
+
+
+def _writer_stalls(monkeypatch, tmp_path, stream: bytes, before: bool) -> tuple[float, float]:
+    """Play shairport-sync: write stream into a FIFO in 16 KiB writes while the
+    reader loop runs against a disk that takes 20 ms per file. Returns (the
+    longest single write(), total seconds to get it all into the pipe)."""
+    tmp_path.mkdir()
+    np.use_state_dir(str(tmp_path))
+    monkeypatch.setattr(np, "DRAIN_MAX", np.READ_SIZE if before else 4 * 1024 * 1024)
+    if before:  # the default 64 KiB pipe
+        monkeypatch.setattr(np, "set_pipe_size", lambda fd, size=None: 0)
+    for name in ("replace_file", "store_cover"):
+        fn = getattr(np, name)
+        monkeypatch.setattr(np, name, lambda *a, _fn=fn: (time.sleep(0.02), _fn(*a))[1])
+    path = str(tmp_path / "pipe")
+    os.mkfifo(path)
+    sel = selectors.DefaultSelector()
+    reader = np.ZoneReader(sel, path, disk=None if before else np.DiskWorker(sel))
+    reader.writer.window = 0.0
+    np.pump(sel, [reader], 0)
+    stalls = []
+
+    def shairport():
+        with open(path, "wb", buffering=0) as w:
+            for i in range(0, len(stream), 16384):
+                t0 = time.perf_counter()
+                w.write(stream[i:i + 16384])
+                stalls.append(time.perf_counter() - t0)
+    t0 = time.perf_counter()
+    writer = threading.Thread(target=shairport)
+    writer.start()
+    while writer.is_alive():
+        np.pump(sel, [reader], 0.01)
+    total = time.perf_counter() - t0
+    reader.close_pipe()
+    reader.publisher.close()
+    if reader.disk is not None:
+        reader.disk.close()
+    sel.close()
+    return max(stalls), total
+
+
+def test_bench_writer_never_stalls_on_a_slow_disk(monkeypatch, tmp_path):
+    for name in ("STATE_DIR", "STATE_FILE", "COVER_DIR", "STATE_SOCKET", "METRICS_FILE"):
+        monkeypatch.setattr(np, name, getattr(np, name))  # restored after use_state_dir
+    stream = synthetic_capture(20, 512 * 1024)
+    print()
+    results = {}
+    for label, before in (("64 KiB pipe, one read, disk on loop", True),
+                          ("grown pipe, drain, disk thread", False)):
+        with monkeypatch.context() as m:
+            results[before] = _writer_stalls(m, tmp_path / str(before), stream, before)
+        stall, total = results[before]
+        print(f"{label:36s} worst write {stall * 1000:7.1f} ms  all written in {total * 1000:7.1f} ms"
+              f"  ({len(stream) / 2**20:.1f} MiB)")
+    assert results[False][0] < results[True][0]
+
+
+def _udp_replay(stream: bytes, msglength: int, gap: float = 0.0) -> dict:
+    """Replay stream as shairport's datagrams to a UdpReader on loopback and
+    count what made it through. Each item's datagrams go out at line rate;
+    with `gap`, the sender pauses that long after each cover, the way track
+    changes are spread out in real playback."""
+    bursts = [(code == np.PICT, np.encode_datagrams(typ, code, payload, msglength))
+              for typ, code, payload in np.ItemParser().feed(stream)]
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    sel = selectors.DefaultSelector()
+    disk = np.DiskWorker(sel)
+    reader = np.UdpReader(sel, f"udp://127.0.0.1:{port}", disk=disk)
+    np.pump(sel, [reader], 0)
+    counts = {"datagrams": 0, "items": 0}
+    feed, apply = reader.parser.feed, reader._apply_items
+
+    def counted_feed(datagram):
+        counts["datagrams"] += 1
+        return feed(datagram)
+
+    def counted_apply(items):
+        counts["items"] += len(items)
+        apply(items)
+    reader.parser.feed, reader._apply_items = counted_feed, counted_apply
+
+    def shairport():
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as out:
+            for cover, grams in bursts:
+                for g in grams:
+                    out.sendto(g, reader.address)
+                if cover and gap:
+                    time.sleep(gap)
+    t0 = time.perf_counter()
+    sender = threading.Thread(target=shairport)
+    sender.start()
+    while sender.is_alive():
+        np.pump(sel, [reader], 0.01)
+    while sel.select(0.2):
+        np.pump(sel, [reader], 0)
+    seconds = time.perf_counter() - t0
+    stats = dict(counts, sent=sum(len(g) for _, g in bursts), expected=len(bursts), seconds=seconds,
+                 mb_per_s=len(stream) / 1e6 / seconds, incomplete=reader.parser.incomplete,
+                 capacity=reader.capacity)
+    reader.close_pipe()
+    reader.publisher.close()
+    disk.close()
+    sel.close()
+    return stats
+
+
+def test_bench_udp_ingest_at_line_rate(monkeypatch, tmp_path):
+    """Replay synthetic captures (and AIRPLAY_CAPTURE=<file>) as UDP metadata.
+    Paced like playback (a cover's burst at line rate, then the next track),
+    nothing may be lost at the receive buffer the role provisions; sent
+    back to back with no pause at all, losses are only reported."""
+    for name in ("STATE_DIR", "STATE_FILE", "COVER_DIR", "STATE_SOCKET", "METRICS_FILE"):
+        monkeypatch.setattr(np, name, getattr(np, name))  # restored after use_state_dir
+    np.use_state_dir(str(tmp_path))
+    cases = [(f"{t} tracks x {size >> 10} KiB covers", synthetic_capture(t, size))
+             for t, size in ((200, 16 * 1024), (20, 512 * 1024), (5, 2 * 1024 * 1024))]
+    if os.environ.get("AIRPLAY_CAPTURE"):
+        cases.append(("capture " + os.environ["AIRPLAY_CAPTURE"],
+                      pathlib.Path(os.environ["AIRPLAY_CAPTURE"]).read_bytes()))
+    print()
+    for label, stream in cases:
+        for msglength in (1500, np.UDP_MSGLENGTH):
+            for gap in (0.0, 0.05):
+                st = _udp_replay(stream, msglength, gap)
+                print(f"{label:26s} msglength {msglength:5d} {'paced' if gap else 'flat '}"
+                      f"  {st['mb_per_s']:7.1f} MB/s  datagrams {st['datagrams']:6d}/{st['sent']:6d}"
+                      f"  items {st['items']:5d}/{st['expected']:5d}  incomplete {st['incomplete']:3d}"
+                      f"  rcvbuf {st['capacity'] >> 10} KiB")
+                # UDP may lose datagrams under a line-rate burst, never invent them
+                assert 0 < st["datagrams"] <= st["sent"] and 0 < st["items"] <= st["expected"]
+                if gap:
+                    assert st["capacity"] >= np.UDP_RCVBUF, "raise net.core.rmem_max to run this"
+                    assert (st["items"], st["incomplete"]) == (st["expected"], 0)
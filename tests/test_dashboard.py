@@ -1,5 +1,14 @@
+import asyncio
+import http.client
 import importlib.util
+import json
+import os
 import pathlib
+import socket
+import struct
+import threading
+
+import pytest
 
 SRC = pathlib.Path(__file__).resolve().parents[1] / "roles/airplay/files/airplay_dashboard.py"
 _spec = importlib.util.spec_from_file_location("airplay_dashboard", SRC)
@@ -37,3 +46,736 @@ def test_disconnect_cmd_uses_main_iface():
     i = cmd.index("/org/gnome/ShairportSync")
     assert cmd[i + 1] == "org.gnome.ShairportSync"
     assert cmd[i + 2] == "DropSession"
+
+
+def test_cover_path_only_serves_content_addressed_names(monkeypatch, tmp_path):
+    monkeypatch.setattr(db, "COVER_DIR", str(tmp_path))
+    name = "a" * 64 + ".jpg"
+    (tmp_path / name).write_bytes(b"\xff\xd8\xff")
+    assert db.cover_path(name) == str(tmp_path / name)
+    assert db.cover_path("b" * 64 + ".jpg") is None  # evicted / never cached
+    assert db.cover_path("../nowplaying.json") is None
+    assert db.cover_path("A" * 64 + ".jpg") is None
+
+
+def _hub(**kw):
+    return db.StatusHub(sock_path="/nonexistent", **kw)
+
+
+def test_status_hub_follows_nowplaying_socket():
+    hub = _hub()
+    hub.update(services={"nqptp": True})
+    ours, theirs = socket.socketpair()
+    theirs.sendall(b'{"type":"snapshot","state":{"title":"A","volume_percent":10}}\n'
+                   b'{"type":"delta","changes":{"volume_')
+    theirs.sendall(b'percent":40}}\n')
+    theirs.close()
+    hub._follow(ours)  # returns at EOF
+    version, event = hub.wait(0, 0)
+    status = json.loads(event[len(b"data: "):])
+    assert status["nowplaying"] == {"title": "A", "volume_percent": 40}
+    assert status["services"] == {"nqptp": True}
+    assert version == 3  # health, snapshot, delta
+
+
+def test_status_hub_only_bumps_version_on_change():
+    hub = _hub()
+    assert hub.update(services={"nqptp": True}) is True
+    v = hub.version
+    assert hub.update(services={"nqptp": True}) is False
+    assert hub.wait(v, 0.01) == (v, hub._event)  # timed out, unchanged
+
+
+def test_status_hub_caps_streams():
+    hub = _hub(max_clients=1)
+    assert hub.join() is True
+    assert hub.join() is False
+    hub.leave()
+    assert hub.join() is True
+
+
+def test_events_endpoint_streams_changes():
+    server = db.ThreadingHTTPServer(("127.0.0.1", 0), db.Handler)
+    server.hub = _hub()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+        conn.request("GET", "/api/events")
+        resp = conn.getresponse()
+        assert resp.status == 200
+        assert resp.getheader("Content-Type") == "text/event-stream"
+        first = resp.fp.readline()
+        assert json.loads(first[len(b"data: "):])["name"] == db.NAME
+        resp.fp.readline()  # blank line ends the event
+        server.hub.update(nowplaying={"title": "Live"})
+        second = resp.fp.readline()
+        assert json.loads(second[len(b"data: "):])["nowplaying"] == {"title": "Live"}
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_units_active_batches_one_systemctl_call(monkeypatch):
+    calls = []
+
+    class Done:
+        stdout = "active\ninactive\n"
+
+    def fake_run(cmd, **kw):
+        calls.append(cmd)
+        return Done()
+    monkeypatch.setattr(db.subprocess, "run", fake_run)
+    assert db.units_active(["a", "b", "c"]) == {"a": True, "b": False, "c": False}
+    assert calls == [["systemctl", "is-active", "a", "b", "c"]]
+
+
+def test_health_monitor_serves_from_memory_and_notifies_changes():
+    probes = []
+    answers = iter([{"a": True}, {"a": True}, {"a": False}])
+
+    def probe(units):
+        probes.append(units)
+        return next(answers)
+    mon = db.HealthMonitor(units=["a"], probe=probe)
+    seen = []
+    mon.subscribe(seen.append)
+    assert mon.get() == {"a": False} and probes == []  # reads never probe
+    assert mon.refresh() is True
+    assert mon.refresh() is False
+    assert mon.refresh() is True
+    assert seen == [{"a": True}, {"a": False}]
+    assert mon.get() == {"a": False}
+
+
+def test_health_monitor_probes_only_on_demand(monkeypatch):
+    probes, watched = [], []
+    mon = db.HealthMonitor(units=["a"], ttl=10.0, probe=lambda units: probes.append(1) or {"a": True},
+                           watched=lambda: bool(watched))
+    assert mon.step(0) is False and probes == []  # idle: nobody asked, nobody watching
+    assert mon.get() == {"a": False}  # stale: served as-is, re-probe scheduled
+    assert mon.step(0) is True and len(probes) == 1
+    assert mon.get() == {"a": True}  # fresh: no new request
+    assert mon.step(0) is False and len(probes) == 1
+    watched.append("stream")  # an open /api/events stream keeps it probing
+    assert mon.step(0) is True and len(probes) == 2
+    watched.clear()
+    now = db.time.monotonic()
+    monkeypatch.setattr(db.time, "monotonic", lambda: now + 11)
+    mon.get()
+    assert mon.step(0) is True and len(probes) == 3
+
+
+def test_build_status_uses_cached_health(monkeypatch):
+    def boom(name):
+        raise AssertionError("forked on the request path")
+    monkeypatch.setattr(db, "service_active", boom)
+    mon = db.HealthMonitor(units=["nqptp"], probe=lambda units: {"nqptp": True})
+    mon.refresh()
+    assert db.build_status(mon)["services"] == {"nqptp": True}
+
+
+def test_state_cache_reloads_only_new_versions(tmp_path):
+    path = tmp_path / "nowplaying.json"
+    cache = db.StateCache(str(path))
+    assert cache.get()["active"] is False and cache.loads == 1  # missing: idle
+    path.write_text(json.dumps({"title": "A"}))
+    first = cache.get()
+    assert first == {"title": "A"} and cache.loads == 2
+    assert cache.get() is first and cache.loads == 2  # unchanged: one stat, no read
+    # the reader's atomic replace: same size, maybe the same mtime, new inode
+    st = path.stat()
+    tmp = tmp_path / "nowplaying.json.tmp"
+    tmp.write_text(json.dumps({"title": "B"}))
+    os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp, path)
+    assert cache.get() == {"title": "B"} and cache.loads == 3
+
+
+def test_status_entity_serializes_once_per_change(tmp_path, monkeypatch):
+    path = tmp_path / "nowplaying.json"
+    path.write_text(json.dumps({"title": "A"}))
+    monkeypatch.setattr(db, "STATE", db.StateCache(str(path)))
+    monkeypatch.setattr(db, "_status", None)
+    mon = db.HealthMonitor(units=["nqptp"], probe=lambda units: {"nqptp": True})
+    mon.refresh()
+    dumps = []
+    real_dumps = json.dumps
+    monkeypatch.setattr(db.json, "dumps", lambda *a, **kw: dumps.append(1) or real_dumps(*a, **kw))
+    first = db.status_entity(mon)
+    assert db.status_entity(mon) is first and len(dumps) == 1
+    mon._probe = lambda units: {"nqptp": False}
+    mon.refresh()
+    assert db.status_entity(mon) is not first and len(dumps) == 2
+    os.replace(_written(tmp_path, {"title": "B"}), path)
+    assert json.loads(db.status_entity(mon).body)["nowplaying"] == {"title": "B"}
+
+
+def _written(directory, state):
+    tmp = directory / "next.json"
+    tmp.write_text(json.dumps(state))
+    return tmp
+
+
+class FakeBus:
+    """Just enough of a D-Bus daemon: EXTERNAL auth, Hello, and a canned
+    reply (or error) per member. Records every call it sees."""
+
+    def __init__(self, path, errors=None, hangup_after=None):
+        self.path = str(path)
+        self.errors = errors or {}
+        self.hangup_after = hangup_after  # close the connection after N calls
+        self.calls = []
+        self.connections = 0
+        self._srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._srv.bind(self.path)
+        self._srv.listen(4)
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._srv.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self._session, args=(conn,), daemon=True).start()
+
+    def _session(self, conn):
+        f = conn.makefile("rb")
+        assert f.read(1) == b"\0"
+        assert f.readline().startswith(b"AUTH EXTERNAL ")
+        conn.sendall(b"OK 0123456789abcdef0123456789abcdef\r\n")
+        assert f.readline() == b"BEGIN\r\n"
+        handled = 0
+        while True:
+            head = f.read(16)
+            if len(head) < 16:
+                return
+            data = head + f.read(db._message_length(head) - 16)
+            _t, serial, fields, body, _e = db._parse(data)
+            member = fields[db.F_MEMBER]
+            if member != "Hello":
+                self.calls.append((fields, data[body:]))
+            reply = [(db.F_REPLY_SERIAL, "u", serial), (db.F_DESTINATION, "s", ":1.7")]
+            if member == "Hello":
+                # a signal first: the client must skip it
+                conn.sendall(db._marshal(db.DBUS_SIGNAL, 1, [
+                    (db.F_PATH, "o", "/org/freedesktop/DBus"), (db.F_MEMBER, "s", "NameAcquired")],
+                    "s", (":1.7",)))
+                conn.sendall(db._marshal(db.DBUS_RETURN, 2, reply, "s", (":1.7",)))
+            elif member in self.errors:
+                conn.sendall(db._marshal(db.DBUS_ERROR, 3, reply + [
+                    (db.F_ERROR_NAME, "s", self.errors[member])], "s", ("nope",)))
+            else:
+                conn.sendall(db._marshal(db.DBUS_RETURN, 3, reply))
+            handled += member != "Hello"
+            if self.hangup_after and handled >= self.hangup_after:
+                conn.close()
+                return
+
+    def close(self):
+        self._srv.close()
+
+
+def test_set_volume_over_persistent_bus_connection(monkeypatch, tmp_path):
+    bus = FakeBus(tmp_path / "bus")
+    monkeypatch.setattr(db, "BUS", db.DBusClient(f"unix:path={bus.path}"))
+    monkeypatch.setattr(db, "_run", lambda cmd: pytest.fail("spawned busctl"))
+    assert db.set_volume(50) is True
+    assert db.disconnect() is True
+    assert bus.connections == 1  # both calls on one connection
+    fields, body = bus.calls[0]
+    assert fields[db.F_DESTINATION] == "org.gnome.ShairportSync"
+    assert fields[db.F_PATH] == "/org/gnome/ShairportSync"
+    assert fields[db.F_INTERFACE] == "org.gnome.ShairportSync.RemoteControl"
+    assert fields[db.F_MEMBER] == "SetAirplayVolume"
+    assert fields[db.F_SIGNATURE] == "d"
+    assert struct.unpack("<d", body) == (-15.0,)
+    assert bus.calls[1][0][db.F_MEMBER] == "DropSession"
+    bus.close()
+
+
+def test_bus_client_reconnects_after_hangup(tmp_path):
+    bus = FakeBus(tmp_path / "bus", hangup_after=1)
+    client = db.DBusClient(f"unix:path={bus.path}")
+    for _ in range(3):
+        client.call(db.SVC_IFACE, db.SVC_PATH, db.SVC_IFACE, "DropSession")
+    assert len(bus.calls) == 3
+    assert client.connects == 3
+    bus.close()
+
+
+def test_bus_error_reply_is_not_retried(monkeypatch, tmp_path):
+    bus = FakeBus(tmp_path / "bus", errors={"DropSession": "org.freedesktop.DBus.Error.ServiceUnknown"})
+    client = db.DBusClient(f"unix:path={bus.path}")
+    with pytest.raises(db.DBusError) as exc:
+        client.call(db.SVC_IFACE, db.SVC_PATH, db.SVC_IFACE, "DropSession")
+    assert exc.value.name == "org.freedesktop.DBus.Error.ServiceUnknown"
+    monkeypatch.setattr(db, "BUS", client)
+    assert db.disconnect() is False
+    assert bus.connections == 1
+    bus.close()
+
+
+def test_unreachable_bus_falls_back_to_busctl(monkeypatch, tmp_path):
+    ran = []
+    monkeypatch.setattr(db, "BUS", db.DBusClient(f"unix:path={tmp_path}/missing"))
+    monkeypatch.setattr(db, "_run", lambda cmd: ran.append(cmd) or True)
+    assert db.set_volume(50) is True
+    assert ran == [db.volume_cmd(50)]
+
+
+def _actuator(state=None, interval=0.0):
+    applied = []
+    act = db.VolumeActuator(apply=lambda pct: applied.append(pct) or True,
+                            current=lambda: state or {"volume_percent": 30, "muted": False},
+                            interval=interval)
+    return act, applied
+
+
+def test_volume_actuator_applies_only_latest_target():
+    act, applied = _actuator()
+    for pct in (10, 20, 55, 130):
+        act.request(pct)
+    assert applied == []  # request() never calls the bus
+    assert act.step() is True
+    assert applied == [100]  # clamped latest wins
+    assert act.step() is False
+
+
+def test_volume_actuator_skips_noop_against_reported_volume():
+    act, applied = _actuator({"volume_percent": 40, "muted": False})
+    act.request(40)
+    assert act.step() is False and act.skipped == 1
+    # 0% means mute; an unmuted 0% (-30 dB) still needs the call
+    act, applied = _actuator({"volume_percent": 0, "muted": False})
+    act.request(0)
+    assert act.step() is True and applied == [0]
+
+
+def test_volume_actuator_returns_to_a_value_the_state_still_reports():
+    # nowplaying has not echoed the 60 yet: the state still says 50
+    act, applied = _actuator({"volume_percent": 50, "muted": False})
+    act.request(60)
+    assert act.step() is True
+    act.request(50)
+    assert act.step() is True
+    assert applied == [60, 50]
+    act.request(50)
+    assert act.step() is False and act.skipped == 1
+
+
+def test_volume_actuator_trusts_the_state_again_once_it_changes():
+    state = {"volume_percent": 30, "muted": False}
+    applied = []
+    act = db.VolumeActuator(apply=lambda pct: applied.append(pct) or True,
+                            current=lambda: state, interval=0.0)
+    act.request(50)
+    assert act.step() is True
+    state["volume_percent"] = 50  # shairport echoes the change...
+    state["volume_percent"] = 80  # ...then the phone turns it up
+    act.request(50)
+    assert act.step() is True and applied == [50, 50]
+
+
+def test_volume_actuator_retries_after_a_failed_call():
+    results = iter([False, True])
+    applied = []
+    act = db.VolumeActuator(apply=lambda pct: applied.append(pct) or next(results),
+                            current=lambda: {"volume_percent": 30, "muted": False}, interval=0.0)
+    act.request(50)
+    assert act.step() is True and act.failed == 1 and act.applied == 0
+    act.request(50)
+    assert act.step() is True and act.applied == 1
+    assert applied == [50, 50]
+
+
+def test_volume_actuator_survives_an_apply_that_raises(capsys):
+    def apply(pct):
+        if pct == 40:
+            raise db.struct.error("unexpected bus reply")
+        return True
+    act = db.VolumeActuator(apply=apply, current=lambda: {"volume_percent": 30, "muted": False},
+                            interval=0.0)
+    act.request(40)
+    assert act.safe_step() is False and act.failed == 1
+    assert "volume change failed" in capsys.readouterr().err
+    act.request(60)
+    assert act.safe_step() is True and act.applied == 1
+
+
+def test_volume_actuator_rate_limits_a_drag():
+    act, applied = _actuator(interval=0.05)
+    act.start()
+    deadline = db.time.monotonic() + 0.3
+    pct = 0
+    while db.time.monotonic() < deadline:
+        pct = pct % 99 + 1
+        act.request(pct)
+        db.time.sleep(0.001)
+    db.time.sleep(0.15)
+    assert 1 <= len(applied) <= 10
+    assert applied[-1] == pct
+
+
+def test_volume_endpoint_returns_target_immediately():
+    server = db.ThreadingHTTPServer(("127.0.0.1", 0), db.Handler)
+    server.volume, applied = _actuator()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+        conn.request("POST", "/api/volume", body=json.dumps({"percent": 70}),
+                     headers={"Content-Type": "application/json"})
+        assert json.loads(conn.getresponse().read()) == {"ok": True, "target": 70}
+        assert applied == []
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _get(server, path, **headers):
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+    conn.request("GET", path, headers=headers)
+    resp = conn.getresponse()
+    body = resp.read()
+    conn.close()
+    return resp, body
+
+
+@pytest.fixture
+def served(monkeypatch, tmp_path):
+    monkeypatch.setattr(db, "STATE_DIR", str(tmp_path))
+    monkeypatch.setattr(db, "COVER_DIR", str(tmp_path / "covers"))
+    monkeypatch.setattr(db, "FILES", db.FileCache())
+    server = db.ThreadingHTTPServer(("127.0.0.1", 0), db.Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_accepts_gzip():
+    assert db.accepts_gzip("gzip, deflate, br")
+    assert db.accepts_gzip("br;q=1.0, gzip;q=0.8")
+    assert db.accepts_gzip("*")
+    assert not db.accepts_gzip("gzip;q=0")
+    assert not db.accepts_gzip("identity")
+    assert not db.accepts_gzip("")
+
+
+def test_page_is_gzipped_and_revalidates(served):
+    resp, body = _get(served, "/", **{"Accept-Encoding": "gzip"})
+    assert resp.status == 200 and resp.getheader("Content-Encoding") == "gzip"
+    assert db.NAME.encode() in db.gzip.decompress(body)
+    etag = resp.getheader("ETag")
+    resp, body = _get(served, "/", **{"If-None-Match": etag})
+    assert resp.status == 304 and body == b""
+    resp, body = _get(served, "/")
+    assert resp.getheader("Content-Encoding") is None and body.startswith(b"<!doctype")
+    resp, _ = _get(served, "/", **{"If-Modified-Since": resp.getheader("Last-Modified")})
+    assert resp.status == 304
+
+
+def test_status_etag_follows_content(served, monkeypatch):
+    state = {"title": "A"}
+    monkeypatch.setattr(db, "read_state", lambda: dict(state))
+    first, _ = _get(served, "/api/status")
+    again, _ = _get(served, "/api/status", **{"If-None-Match": first.getheader("ETag")})
+    assert again.status == 304
+    state["title"] = "B"
+    changed, body = _get(served, "/api/status", **{"If-None-Match": first.getheader("ETag")})
+    assert changed.status == 200 and json.loads(body)["nowplaying"]["title"] == "B"
+
+
+def test_cover_read_once_and_served_304_by_name(served, tmp_path):
+    name = "c" * 64 + ".jpg"
+    (tmp_path / "covers").mkdir()
+    (tmp_path / "covers" / name).write_bytes(b"\xff\xd8" + b"x" * 1000)
+    resp, body = _get(served, "/cover/" + name)
+    assert resp.status == 200 and len(body) == 1002
+    assert resp.getheader("ETag") == '"%s"' % ("c" * 40)
+    assert resp.getheader("Content-Encoding") is None  # images are not re-gzipped
+    resp, body = _get(served, "/cover/" + name, **{"If-None-Match": resp.getheader("ETag")})
+    assert resp.status == 304 and body == b""
+    _get(served, "/cover/" + name)
+    assert db.FILES.reads == 1
+
+
+def test_file_cache_revalidates_and_evicts(tmp_path):
+    cache = db.FileCache(budget=100)
+    a, b = tmp_path / "a", tmp_path / "b"
+    a.write_bytes(b"1" * 60)
+    b.write_bytes(b"2" * 60)
+    assert cache.get(str(a), "image/jpeg").body == b"1" * 60
+    assert cache.get(str(a), "image/jpeg") is cache.get(str(a), "image/jpeg")
+    assert cache.reads == 1
+    a.write_bytes(b"3" * 61)  # size (and mtime) changed
+    assert cache.get(str(a), "image/jpeg").body == b"3" * 61
+    cache.get(str(b), "image/jpeg")  # over budget: a goes
+    assert cache.reads == 3 and str(a) not in cache._items
+    assert cache.get(str(tmp_path / "gone"), "image/jpeg") is None
+
+
+def _fake_resize(src, dest, width):
+    with open(src, "rb") as fh:
+        original = fh.read()
+    if width >= len(original):  # "image" width == its byte count
+        return False
+    with open(dest, "wb") as fh:
+        fh.write(original[:width])
+    return True
+
+
+def test_thumb_bucket_and_names():
+    assert [db.thumb_bucket(n) for n in (1, 160, 161, 700, 5000)] == [160, 160, 320, 1024, 1024]
+    assert db.thumb_name("ab" * 32 + ".png", 320) == "ab" * 32 + ".w320.jpg"
+    assert db.cover_etag("ab" * 32 + ".w320.jpg") == '"%s-w320"' % ("ab" * 20)
+
+
+def test_thumbnailer_makes_buckets_once_up_to_original(tmp_path):
+    name = "d" * 64 + ".jpg"
+    (tmp_path / name).write_bytes(b"x" * 500)
+    thumbs = db.Thumbnailer(resize=_fake_resize, directory=str(tmp_path), covers=str(tmp_path))
+    assert thumbs.path(name, 300) is None  # queued, caller serves the original
+    assert thumbs.schedule(name) is False  # only once per cover
+    assert thumbs.make(thumbs._queue.get_nowait()) == 2  # 160, 320; 640 > original
+    assert (tmp_path / db.thumb_name(name, 320)).read_bytes() == b"x" * 320
+    assert thumbs.path(name, 300) == str(tmp_path / db.thumb_name(name, 320))
+    # 640+ would be upscales: the original is the answer, nothing is queued
+    assert thumbs.path(name, 900) == str(tmp_path / name) and thumbs._queue.empty()
+    assert thumbs.make(name) == 0
+
+
+def test_thumbnailer_writes_its_own_directory_and_prunes_evicted(tmp_path):
+    covers, thumbs_dir = tmp_path / "covers", tmp_path / "thumbs"
+    covers.mkdir()
+    thumbs_dir.mkdir()
+    old, new = "a" * 64 + ".jpg", "b" * 64 + ".png"
+    (covers / old).write_bytes(b"x" * 500)
+    thumbs = db.Thumbnailer(resize=_fake_resize, directory=str(thumbs_dir), covers=str(covers))
+    assert thumbs.make(old) == 2
+    assert sorted(p.name for p in thumbs_dir.iterdir()) == [db.thumb_name(old, 160), db.thumb_name(old, 320)]
+    assert not any(p.name.startswith("a" * 64 + ".w") for p in covers.iterdir())
+    thumbs.schedule(old)
+    (covers / old).unlink()  # evicted by airplay-nowplaying
+    (covers / new).write_bytes(b"y" * 200)
+    assert thumbs.make(new) == 1
+    assert [p.name for p in thumbs_dir.iterdir()] == [db.thumb_name(new, 160)]
+    assert thumbs.schedule(old) is True  # may be queued again if it comes back
+
+
+def test_thumbnailer_disabled_without_imaging(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "Image", None)
+    thumbs = db.Thumbnailer(directory=str(tmp_path))
+    assert not thumbs.enabled
+    assert thumbs.path("e" * 64 + ".jpg", 320) is None and thumbs._queue.empty()
+
+
+def test_cover_size_serves_original_then_derivative(served, tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "THUMBS", db.Thumbnailer(resize=_fake_resize))
+    name = "f" * 64 + ".jpg"
+    (tmp_path / "covers").mkdir()
+    (tmp_path / "covers" / name).write_bytes(b"y" * 900)
+    resp, body = _get(served, f"/cover/{name}?size=300")
+    assert len(body) == 900 and resp.getheader("Cache-Control") == "no-cache"
+    db.THUMBS.make(db.THUMBS._queue.get_nowait())
+    resp, body = _get(served, f"/cover/{name}?size=300", **{"If-None-Match": resp.getheader("ETag")})
+    assert resp.status == 200 and body == b"y" * 320
+    assert "immutable" in resp.getheader("Cache-Control")
+
+
+def test_cover_size_past_the_original_is_final_not_no_cache(served, tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "THUMBS", db.Thumbnailer(resize=_fake_resize))
+    name = "c" * 64 + ".jpg"
+    (tmp_path / "covers").mkdir()
+    (tmp_path / "covers" / name).write_bytes(b"y" * 600)
+    resp, _ = _get(served, f"/cover/{name}?size=1260")
+    assert resp.getheader("Cache-Control") == "no-cache"  # derivatives still pending
+    assert db.THUMBS.make(db.THUMBS._queue.get_nowait()) == 2  # w160, w320
+    resp, body = _get(served, f"/cover/{name}?size=1260")
+    assert body == b"y" * 600 and "immutable" in resp.getheader("Cache-Control")
+    resp, body = _get(served, f"/cover/{name}?size=300")
+    assert body == b"y" * 320
+
+
+def test_cover_size_of_an_undecodable_cover_is_final(served, tmp_path, monkeypatch):
+    def broken(src, dest, width):
+        raise OSError("cannot identify image file")
+    monkeypatch.setattr(db, "THUMBS", db.Thumbnailer(resize=broken))
+    name = "d" * 64 + ".jpg"
+    (tmp_path / "covers").mkdir()
+    (tmp_path / "covers" / name).write_bytes(b"not a jpeg")
+    _get(served, f"/cover/{name}?size=160")
+    assert db.THUMBS.make(db.THUMBS._queue.get_nowait()) == 0
+    resp, body = _get(served, f"/cover/{name}?size=160")
+    assert body == b"not a jpeg" and "immutable" in resp.getheader("Cache-Control")
+
+
+def test_cover_size_without_imaging_serves_original(served, tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "Image", None)
+    monkeypatch.setattr(db, "THUMBS", db.Thumbnailer())
+    name = "a" * 64 + ".jpg"
+    (tmp_path / "covers").mkdir()
+    (tmp_path / "covers" / name).write_bytes(b"z" * 50)
+    resp, body = _get(served, f"/cover/{name}?size=160")
+    assert body == b"z" * 50 and "immutable" in resp.getheader("Cache-Control")
+
+
+def test_pil_resize_scales_jpeg(tmp_path):
+    pil = pytest.importorskip("PIL.Image")
+    src, dest = tmp_path / "src.jpg", tmp_path / "dest.jpg"
+    pil.new("RGB", (1200, 1200), (200, 30, 30)).save(src, "JPEG")
+    assert db.pil_resize(str(src), str(dest), 320) is True
+    with pil.open(dest) as im:
+        assert im.size == (320, 320)
+    assert db.pil_resize(str(dest), str(tmp_path / "x.jpg"), 640) is False
+
+
+@pytest.fixture
+def async_served(monkeypatch, tmp_path):
+    monkeypatch.setattr(db, "STATE_DIR", str(tmp_path))
+    monkeypatch.setattr(db, "COVER_DIR", str(tmp_path / "covers"))
+    monkeypatch.setattr(db, "FILES", db.FileCache())
+    loop = asyncio.new_event_loop()
+    servers = []
+    runner = threading.Thread(target=loop.run_forever, daemon=True)
+
+    def serve(**attrs):
+        server = db.AsyncServer("127.0.0.1", 0, **{k: attrs.pop(k) for k in
+                                                   ("max_connections", "max_inflight") if k in attrs})
+        for k, v in attrs.items():
+            setattr(server, k, v)
+        loop.run_until_complete(server.start())
+        runner.start()
+        servers.append(server)
+        return server
+
+    async def shutdown():
+        for server in servers:
+            server.close()
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    yield serve
+    asyncio.run_coroutine_threadsafe(shutdown(), loop).result(5)
+    loop.call_soon_threadsafe(loop.stop)
+    runner.join(5)
+    loop.close()
+
+
+def test_async_server_keeps_connections_alive(async_served):
+    server = async_served()
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+    socks = set()
+    for _ in range(3):
+        conn.request("GET", "/api/status")
+        resp = conn.getresponse()
+        assert resp.status == 200 and json.loads(resp.read())["name"] == db.NAME
+        assert resp.getheader("Connection") == "keep-alive"
+        socks.add(id(conn.sock))
+    assert len(socks) == 1 and server.connections == 1
+    conn.close()
+
+
+def test_async_server_routes_match_threaded(async_served):
+    server = async_served(volume=_actuator()[0])
+    resp, body = _get(server, "/", **{"Accept-Encoding": "gzip"})
+    assert resp.status == 200 and db.NAME.encode() in db.gzip.decompress(body)
+    resp, body = _get(server, "/", **{"If-None-Match": resp.getheader("ETag")})
+    assert resp.status == 304 and body == b""
+    assert _get(server, "/nope")[0].status == 404
+    assert _get(server, "/cover")[0].status == 404
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+    conn.request("POST", "/api/volume", body=json.dumps({"percent": 33}))
+    assert json.loads(conn.getresponse().read()) == {"ok": True, "target": 33}
+    conn.request("POST", "/api/volume", body=b"[]")
+    assert conn.getresponse().status == 400
+    conn.close()
+
+
+def test_async_server_runs_blocking_routes_on_executor(async_served, monkeypatch):
+    threads = []
+    monkeypatch.setattr(db, "disconnect", lambda: threads.append(threading.current_thread().name) or True)
+    server = async_served()
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+    conn.request("POST", "/api/disconnect")
+    assert json.loads(conn.getresponse().read()) == {"ok": True}
+    assert threads[0].startswith("dashboard")
+    conn.close()
+
+
+def test_async_server_caps_connections(async_served):
+    server = async_served(max_connections=1)
+    first = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+    first.request("GET", "/api/status")
+    first.getresponse().read()
+    assert _get(server, "/api/status")[0].status == 503
+    first.close()
+
+
+def test_async_server_http10_and_bad_requests_close(async_served):
+    server = async_served()
+    with socket.create_connection(("127.0.0.1", server.server_port), timeout=5) as s:
+        s.sendall(b"GET /api/status HTTP/1.0\r\n\r\n")
+        data = b"".join(iter(lambda: s.recv(65536), b""))  # server closes
+    assert data.startswith(b"HTTP/1.1 200") and b"Connection: close" in data
+    with socket.create_connection(("127.0.0.1", server.server_port), timeout=5) as s:
+        s.sendall(b"garbage\r\n\r\n")
+        assert s.recv(65536).startswith(b"HTTP/1.1 400")
+
+
+def test_async_server_streams_events(async_served):
+    server = async_served(hub=_hub())
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+    conn.request("GET", "/api/events")
+    resp = conn.getresponse()
+    assert resp.getheader("Content-Type") == "text/event-stream"
+    assert json.loads(resp.fp.readline()[len(b"data: "):])["name"] == db.NAME
+    resp.fp.readline()
+    server.hub.update(nowplaying={"title": "Async"})
+    event = json.loads(resp.fp.readline()[len(b"data: "):])
+    assert event["nowplaying"] == {"title": "Async"}
+    conn.close()
+
+
+def _fresh_metrics(monkeypatch):
+    fresh = db.Metrics()
+    fresh._types, fresh._buckets = dict(db.METRICS._types), dict(db.METRICS._buckets)
+    monkeypatch.setattr(db, "METRICS", fresh)
+    return fresh
+
+
+def test_route_label_is_bounded():
+    assert db.route_label("/api/status") == "/api/status"
+    assert db.route_label("/cover/" + "a" * 64 + ".jpg") == "/cover/*"
+    assert db.route_label("/wp-login.php") == "other"
+
+
+def test_metrics_endpoint_merges_nowplaying_file(served, tmp_path, monkeypatch):
+    _fresh_metrics(monkeypatch)
+    monkeypatch.setattr(db, "NOWPLAYING_METRICS", str(tmp_path / "metrics.prom"))
+    (tmp_path / "metrics.prom").write_text("airplay_nowplaying_state_writes_total 7\n")
+    _get(served, "/api/status")
+    _get(served, "/nope")
+    resp, body = _get(served, "/metrics")
+    text = body.decode()
+    assert resp.getheader("Content-Type").startswith("text/plain; version=0.0.4")
+    assert 'airplay_dashboard_requests_total{code="200",route="/api/status"} 1' in text
+    assert 'airplay_dashboard_requests_total{code="404",route="other"} 1' in text
+    assert 'airplay_dashboard_request_seconds_count{route="/api/status"} 1' in text
+    assert "airplay_dashboard_event_streams 0" in text
+    assert text.endswith("airplay_nowplaying_state_writes_total 7\n")
+
+
+def test_bus_calls_are_timed_by_transport(monkeypatch, tmp_path):
+    metrics = _fresh_metrics(monkeypatch)
+    monkeypatch.setattr(db, "BUS", db.DBusClient(f"unix:path={tmp_path}/missing"))
+    monkeypatch.setattr(db.subprocess, "run", lambda cmd, **kw: type("R", (), {"returncode": 0})())
+    assert db.set_volume(50) is True
+    text = metrics.render()
+    assert ('airplay_dashboard_bus_call_seconds_count{member="SetAirplayVolume",transport="busctl"} 1'
+            in text)
+    assert 'airplay_dashboard_subprocess_seconds_count{command="busctl"} 1' in text
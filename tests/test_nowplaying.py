@@ -1,5 +1,13 @@
 import base64
+import hashlib
 import importlib.util
+import io
+import json
+import os
+import selectors
+import socket
+import threading
+import time
 import pathlib
 
 SRC = pathlib.Path(__file__).resolve().parents[1] / "roles/airplay/files/airplay_nowplaying.py"
@@ -32,6 +40,169 @@ def test_parse_items_splits_stream_and_keeps_leftover():
     assert leftover == b"<item><typ"  # partial item retained
 
 
+def _stream():
+    return (b"garbage" + _item("ssnc", "pbeg") + _item("core", "minm", b"Song A")
+            + b"\n" + _item("ssnc", "PICT", b"\xff\xd8\xff" + bytes(range(256)) * 40)
+            + _item("ssnc", "pvol", b"-15.00,-20.00,-30.00,0.00") + b"<item><type>7373")
+
+
+def test_item_parser_is_split_invariant():
+    stream = _stream()
+    whole, leftover = np.parse_items(stream)
+    assert [c for _, c, _ in whole] == [0x70626567, 0x6D696E6D, 0x50494354, 0x70766F6C]
+    for size in (1, 7, 4096):
+        parser = np.ItemParser()
+        got = []
+        for i in range(0, len(stream), size):
+            got += parser.feed(stream[i:i + size])
+        assert got == whole
+        assert parser.pending() == leftover == b"<item><type>7373"
+
+
+def test_item_parser_resumes_scan_instead_of_rescanning():
+    cover = b"\xff\xd8\xff" + b"\x00" * 300_000
+    stream = _item("ssnc", "PICT", cover)
+    parser = np.ItemParser()
+    for i in range(0, len(stream) - 4096, 4096):
+        assert parser.feed(stream[i:i + 4096]) == []
+        # the </item> search picks up where it stopped, not at the item start
+        assert parser._scan - parser._start >= len(parser.pending()) - len(b"</item>")
+    items = parser.feed(stream[i + 4096:])
+    assert items == [(np.SSNC, 0x50494354, cover)]
+    assert parser.pending() == b""
+
+
+def test_item_parser_drops_garbage_and_resyncs_corrupt_items():
+    parser = np.ItemParser()
+    bad_header = b"<item><type>zzzz</type></item>"
+    truncated = b"<item><type>636f7265</type><code>6d696e6d</code><length>3</length><data encoding"
+    items = parser.feed(b"\x00" * 100 + bad_header + truncated + _item("core", "asar", b"X"))
+    assert items == [(np.CORE, 0x61736172, b"X")]
+    assert parser.dropped > 100
+    assert parser.pending() == b""
+
+
+def test_item_parser_runaway_guard_keeps_newest_item():
+    parser = np.ItemParser(max_bytes=1_000)
+    head = b"<item><type>73736e63</type><code>50494354</code><length>9999</length>"
+    assert parser.feed(head + b"A" * 2_000) == []
+    assert parser.pending().startswith(head)  # large partial item survives
+    items = parser.feed(b"<item" + _item("core", "minm", b"Next")[5:])
+    assert items == [(np.CORE, 0x6D696E6D, b"Next")]
+
+
+def test_item_parser_readinto_reuses_one_buffer():
+    stream = (_item("core", "minm", b"Song") + _item("ssnc", "pvol", b"-1.0,0,0,0")) * 200
+    reader = io.BytesIO(stream)
+    parser = np.ItemParser(capacity=8192)
+    buf = parser._buf
+    got = []
+    while parser.readinto(reader, 1000):
+        got += parser.parse()
+        assert parser._buf is buf  # small items never reallocate
+    assert got == np.parse_items(stream)[0]
+
+
+def test_item_parser_grows_for_large_item_then_shrinks_back():
+    cover = b"\xff\xd8\xff" + bytes(100_000)
+    reader = io.BytesIO(_item("ssnc", "PICT", cover))
+    parser = np.ItemParser(capacity=4096)
+    got = []
+    while parser.readinto(reader, 4096):
+        got += parser.parse()
+    assert got == [(np.SSNC, 0x50494354, cover)]
+    assert len(parser._buf) == 4096
+
+
+def test_item_parser_drops_item_with_bad_base64():
+    bad = b'<item><type>636f7265</type><code>6d696e6d</code><length>1</length><data encoding="base64">QQ</data></item>'
+    parser = np.ItemParser()
+    assert parser.feed(bad + _item("core", "asar", b"X")) == [(np.CORE, 0x61736172, b"X")]
+    assert parser.dropped == len(bad)
+
+
+def _spool_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(np, "STATE_DIR", str(tmp_path))
+    monkeypatch.setattr(np, "COVER_DIR", str(tmp_path / "covers"))
+
+
+def test_item_parser_streams_cover_to_disk(monkeypatch, tmp_path):
+    _spool_dir(monkeypatch, tmp_path)
+    cover = b"\xff\xd8\xff" + bytes(range(256)) * 4000
+    stream = _item("core", "minm", b"Song") + _item("ssnc", "PICT", cover) + _item("ssnc", "pbeg")
+    parser = np.ItemParser(capacity=4096, spool=np.cover_spool)
+    reader = io.BytesIO(stream)
+    got = []
+    while parser.readinto(reader, 1000):
+        got += parser.parse()
+        assert len(parser._buf) == 4096  # the cover never accumulates in memory
+    assert [c for _, c, _ in got] == [0x6D696E6D, np.PICT, 0x70626567]
+    spool = got[1][2]
+    assert isinstance(spool, np.CoverSpool) and len(spool) == len(cover)
+    state = np.empty_state()
+    assert np.apply_item(state, np.SSNC, np.PICT, spool) is True
+    name = hashlib.sha256(cover).hexdigest() + ".jpg"
+    assert state["cover"] == "covers/" + name
+    assert (tmp_path / "covers" / name).read_bytes() == cover
+    assert [p.name for p in tmp_path.iterdir()] == ["covers"]  # no .part left
+
+
+def test_item_parser_discards_corrupt_streamed_cover(monkeypatch, tmp_path):
+    _spool_dir(monkeypatch, tmp_path)
+    head = b"<item><type>73736e63</type><code>50494354</code><length>999</length>"
+    truncated = head + b'<data encoding="base64">/9j/AAAA'
+    parser = np.ItemParser(spool=np.cover_spool)
+    items = parser.feed(truncated + _item("core", "minm", b"Next"))
+    assert items == [(np.CORE, 0x6D696E6D, b"Next")]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_cover_spool_spills_to_disk_past_memory_limit(monkeypatch, tmp_path):
+    _spool_dir(monkeypatch, tmp_path)
+    monkeypatch.setattr(np, "SPOOL_MEM", 1000)
+    cover = b"\xff\xd8\xff" + bytes(5000)
+    spool = np.CoverSpool()
+    spool.write(base64.b64encode(cover))
+    assert spool.close() and spool.path is not None and len(spool._mem) == 0
+    assert np.store_cover(spool) == "covers/" + hashlib.sha256(cover).hexdigest() + ".jpg"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["covers"]
+
+
+def test_apply_item_writes_in_memory_cover(monkeypatch, tmp_path):
+    _spool_dir(monkeypatch, tmp_path)
+    png = b"\x89PNG\r\n\x1a\nrest"
+    state = np.empty_state()
+    assert np.apply_item(state, np.SSNC, np.PICT, png) is True
+    assert state["cover"] == "covers/" + hashlib.sha256(png).hexdigest() + ".png"
+    assert (tmp_path / state["cover"]).read_bytes() == png
+
+
+def test_resent_cover_is_deduplicated(monkeypatch, tmp_path):
+    _spool_dir(monkeypatch, tmp_path)
+    art = b"\xff\xd8\xff" + b"album" * 100
+    state = np.empty_state()
+    assert np.apply_item(state, np.SSNC, np.PICT, art) is True
+    path = tmp_path / state["cover"]
+    ino = path.stat().st_ino
+    os.utime(path, ns=(0, 0))
+    spool = np.CoverSpool()
+    spool.write(base64.b64encode(art))
+    spool.close()
+    assert np.apply_item(state, np.SSNC, np.PICT, spool) is False  # same art: no state change
+    assert path.stat().st_ino == ino  # not rewritten
+    assert path.stat().st_mtime_ns > 0  # LRU time bumped
+
+
+def test_evict_covers_drops_least_recently_used(monkeypatch, tmp_path):
+    _spool_dir(monkeypatch, tmp_path)
+    names = [np.store_cover(b"\xff\xd8\xff" + bytes([i]) * 1000).split("/")[1] for i in range(4)]
+    for age, name in enumerate(names):
+        os.utime(tmp_path / "covers" / name, ns=(age * 10**9, age * 10**9))
+    os.utime(tmp_path / "covers" / names[0])  # recently re-used
+    assert np.evict_covers(budget=2100, keep=names[1]) == 2
+    assert sorted(p.name for p in (tmp_path / "covers").iterdir()) == sorted([names[0], names[1]])
+
+
 def test_parse_pvol_percent_and_mute():
     assert np.parse_pvol(b"0.00,-0.00,-30.00,0.00")["percent"] == 100
     assert np.parse_pvol(b"-30.00,-30.00,-30.00,0.00")["percent"] == 0
@@ -66,6 +237,35 @@ def test_apply_item_volume():
     assert state["volume_percent"] == 50
 
 
+def test_apply_item_ignores_unhandled_items():
+    state = np.empty_state()
+    assert np.apply_item(state, np.SSNC, 0x6D647374, b"12345") is False  # mdst
+    assert np.apply_item(state, 0x12345678, 0x6D696E6D, b"x") is False
+    assert state == np.empty_state()
+
+
+def test_apply_item_progress_and_pause(monkeypatch):
+    now = [1_700_000_000.0]
+    monkeypatch.setattr(np.time, "time", lambda: now[0])
+    state = np.empty_state()
+    assert np.apply_item(state, np.CORE, 0x6173746D, (215_000).to_bytes(4, "big")) is True  # astm
+    assert state["duration"] == 215.0
+    # start/current/end RTP frames; the sequence wraps past 2**32
+    start = 2**32 - 44100 * 10
+    prgr = f"{start}/{(start + 44100 * 30) % 2**32}/{(start + 44100 * 200) % 2**32}".encode()
+    assert np.apply_item(state, np.SSNC, 0x70726772, prgr) is True
+    assert (state["position"], state["duration"], state["position_at"]) == (30.0, 200.0, now[0])
+    assert state["paused"] is False
+    now[0] += 12.5
+    assert np.apply_item(state, np.SSNC, 0x70666C73, b"") is True  # pfls
+    assert (state["position"], state["position_at"], state["paused"]) == (42.5, now[0], True)
+    assert np.apply_item(state, np.SSNC, 0x70666C73, b"") is False
+    now[0] += 60
+    assert np.apply_item(state, np.SSNC, 0x7072736D, b"") is True  # prsm
+    assert (state["position"], state["position_at"], state["paused"]) == (42.5, now[0], False)
+    assert np.apply_item(state, np.SSNC, 0x70726772, b"garbage") is False
+
+
 def test_trim_buffer_under_cap_unchanged():
     buf = b"<item><type>" + b"x" * 100
     assert np.trim_buffer(buf, max_bytes=10_000) is buf
@@ -88,3 +288,448 @@ def test_trim_buffer_trims_to_last_item_start():
 def test_trim_buffer_drops_oversized_garbage_without_item():
     garbage = b"\x00" * 5_000  # no <item> marker at all
     assert np.trim_buffer(garbage, max_bytes=4_000) == b""
+
+
+class _Clock:
+    def __init__(self):
+        self.t = 100.0
+
+    def __call__(self):
+        return self.t
+
+
+def _writer(monkeypatch, tmp_path):
+    monkeypatch.setattr(np, "STATE_FILE", str(tmp_path / "nowplaying.json"))
+    clock = _Clock()
+    return np.StateWriter(window=0.075, max_delay=0.25, clock=clock), clock
+
+
+def test_state_writer_coalesces_a_burst(monkeypatch, tmp_path):
+    writer, clock = _writer(monkeypatch, tmp_path)
+    state = np.empty_state()
+    assert writer.timeout() is None
+    for tag, payload in (("minm", b"T"), ("asar", b"A"), ("asal", b"L")):
+        assert np.apply_item(state, np.CORE, int(tag.encode().hex(), 16), payload)
+        writer.mark()
+        clock.t += 0.02
+        assert writer.timeout() > 0  # still inside the window
+    clock.t += 0.075
+    assert writer.timeout() == 0
+    assert writer.flush(state) is True
+    assert writer.writes == 1 and writer.timeout() is None
+    assert json.loads((tmp_path / "nowplaying.json").read_text())["album"] == "L"
+
+
+def test_state_writer_max_delay_bounds_a_steady_stream(monkeypatch, tmp_path):
+    writer, clock = _writer(monkeypatch, tmp_path)
+    writer.mark()
+    for _ in range(4):
+        clock.t += 0.05
+        writer.mark()  # never quiet for a full window
+        assert writer.timeout() > 0
+    clock.t += 0.06
+    writer.mark()
+    assert writer.timeout() == 0  # 260 ms since the first change
+
+
+def test_state_writer_skips_identical_content(monkeypatch, tmp_path):
+    writer, clock = _writer(monkeypatch, tmp_path)
+    state = np.empty_state()
+    assert writer.flush(state) is True
+    state["updated"] = 123.0  # only the timestamp differs
+    writer.mark()
+    assert writer.flush(state) is False
+    assert writer.writes == 1
+
+
+def _pump(sel, rounds=3):
+    for _ in range(rounds):
+        for key, events in sel.select(0.05):
+            key.data(events)
+
+
+def _lines(conn):
+    buf = b""
+    while not buf.endswith(b"\n"):
+        buf += conn.recv(65536)
+    return [json.loads(line) for line in buf.splitlines()]
+
+
+def test_state_publisher_sends_snapshot_then_deltas(tmp_path):
+    sel = selectors.DefaultSelector()
+    state = np.empty_state()
+    pub = np.StatePublisher(sel, state, path=str(tmp_path / "np.sock"))
+    sub = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sub.connect(str(tmp_path / "np.sock"))
+    _pump(sel)
+    assert _lines(sub) == [{"type": "snapshot", "state": state}]
+    np.apply_item(state, np.CORE, 0x6D696E6D, b"Song")
+    np.apply_item(state, np.SSNC, 0x70766F6C, b"-15.00,-20.00,-30.00,0.00")
+    pub.publish()
+    pub.publish()  # nothing new: no line
+    assert _lines(sub) == [{"type": "delta", "changes": {"title": "Song", "volume_percent": 50}}]
+    sub.close()
+    _pump(sel)
+    assert pub._clients == {}
+    pub.close()
+    assert not (tmp_path / "np.sock").exists()
+
+
+def test_state_publisher_drops_stalled_subscriber(monkeypatch, tmp_path):
+    monkeypatch.setattr(np, "MAX_BACKLOG", 64 * 1024)
+    sel = selectors.DefaultSelector()
+    state = np.empty_state()
+    pub = np.StatePublisher(sel, state, path=str(tmp_path / "np.sock"))
+    sub = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sub.connect(str(tmp_path / "np.sock"))
+    _pump(sel)
+    for i in range(2000):  # never read by the subscriber
+        state["title"] = f"{i}" * 200
+        pub.publish()
+    assert pub._clients == {}
+    pub.close()
+
+
+def test_metrics_render_prometheus_text(tmp_path):
+    m = np.Metrics()
+    m.describe("x_total", "counter", "Things.")
+    m.describe("x_seconds", "histogram", "Time.", buckets=(0.1, 1))
+    m.inc("x_total", tag='ssnc/"q"')
+    m.inc("x_total", 2**40, tag="big")
+    for value in (0.05, 0.5, 3):
+        m.observe("x_seconds", value)
+    text = m.render()
+    assert '# TYPE x_total counter\nx_total{tag="ssnc/\\"q\\""} 1\n' in text
+    assert 'x_total{tag="big"} 1099511627776' in text  # no float rounding
+    assert 'x_seconds_bucket{le="0.1"} 1\nx_seconds_bucket{le="1"} 2\n' in text
+    assert 'x_seconds_bucket{le="+Inf"} 3\nx_seconds_sum 3.55\nx_seconds_count 3\n' in text
+    m.dump(str(tmp_path / "metrics.prom"))
+    assert (tmp_path / "metrics.prom").read_text() == text
+
+
+def test_metrics_render_while_another_thread_adds_keys():
+    # the DiskWorker thread records cover/disk metrics while the loop renders
+    m = np.Metrics()
+    m.describe("c_total", "counter", "C.")
+    m.describe("h_seconds", "histogram", "H.")
+
+    def worker():
+        for i in range(3000):
+            m.inc("c_total", tag=str(i))
+            m.observe("h_seconds", 0.001, tag=str(i))
+    t = threading.Thread(target=worker)
+    t.start()
+    while t.is_alive():
+        m.render()
+    t.join()
+    assert m.render().count("c_total{") == 3000
+
+
+def test_hot_paths_feed_metrics(monkeypatch, tmp_path):
+    _spool_dir(monkeypatch, tmp_path)
+    fresh = np.Metrics()
+    fresh._types, fresh._buckets = dict(np.METRICS._types), dict(np.METRICS._buckets)
+    monkeypatch.setattr(np, "METRICS", fresh)
+    writer, _ = _writer(monkeypatch, tmp_path)
+    art = b"\xff\xd8\xff" + b"art" * 50
+    state = np.empty_state()
+    np.apply_item(state, np.SSNC, np.PICT, art)
+    np.apply_item(np.empty_state(), np.SSNC, np.PICT, art)
+    writer.flush(state)
+    parser = np.ItemParser(capacity=4096)
+    parser.feed(b"junk" + _item("ssnc", "PICT", bytes(10_000)))
+    monkeypatch.setattr(np, "METRICS_FILE", str(tmp_path / "metrics.prom"))
+    np.export_metrics(parser)
+    text = (tmp_path / "metrics.prom").read_text()
+    assert "airplay_nowplaying_cover_writes_total 1\n" in text
+    assert "airplay_nowplaying_cover_hits_total 1\n" in text
+    assert "airplay_nowplaying_state_writes_total 1\n" in text
+    assert "airplay_nowplaying_dropped_bytes_total 4\n" in text
+    assert parser.high_water > 4096
+    assert f"airplay_nowplaying_buffer_high_water_bytes {parser.high_water}\n" in text
+
+
+def test_replay_drives_the_reader_pipeline(monkeypatch, tmp_path):
+    monkeypatch.setattr(np, "STATE_FILE", str(tmp_path / "nowplaying.json"))
+    monkeypatch.setattr(np, "COVER_DIR", str(tmp_path / "covers"))
+    monkeypatch.setattr(np, "STATE_DIR", str(tmp_path))
+    monkeypatch.setattr(np, "STATE_SOCKET", str(tmp_path / "nowplaying.sock"))
+    cover = b"\xff\xd8\xff" + os.urandom(300_000)
+    stream = b"".join([
+        _item("ssnc", "pbeg"), _item("core", "minm", b"Song"), _item("core", "asar", b"Artist"),
+        _item("ssnc", "PICT", cover), b"junk-between-items", _item("core", "asal", b"Album"),
+    ])
+    stats = np.replay(io.BytesIO(stream), size=4096, trace_memory=True)
+    assert stats["bytes"] == len(stream) and stats["items"] == 5
+    assert stats["dropped"] == len(b"junk-between-items")
+    assert stats["writes"] >= 1 and stats["mb_per_s"] > 0
+    assert 0 <= stats["latency_p50"] <= stats["latency_p99"] <= stats["latency_max"]
+    assert stats["peak_bytes"] > 0
+    state = json.loads((tmp_path / "nowplaying.json").read_text())
+    assert (state["title"], state["album"]) == ("Song", "Album")
+    assert (tmp_path / state["cover"]).read_bytes() == cover
+
+
+def test_capture_records_raw_pipe_bytes_across_writers(tmp_path):
+    fifo = str(tmp_path / "metadata-pipe")
+    os.mkfifo(fifo)
+    chunks = [_item("core", "minm", b"One"), _item("core", "minm", b"Two")]
+
+    def shairport():
+        for chunk in chunks:  # two writer sessions, like a restart
+            with open(fifo, "wb") as w:
+                w.write(chunk)
+
+    out = io.BytesIO()
+    writer = threading.Thread(target=shairport)
+    writer.start()
+    assert np.capture(out, fifo, seconds=0.5) == sum(map(len, chunks))
+    writer.join()
+    assert out.getvalue() == b"".join(chunks)
+    items, _ = np.parse_items(out.getvalue())
+    assert [payload for _, _, payload in items] == [b"One", b"Two"]
+
+
+def test_parse_zones():
+    assert np.parse_zones(" living=/run/a/pipe, office=/run/b/pipe,") == [
+        ("living", "/run/a/pipe"), ("office", "/run/b/pipe")]
+    assert np.parse_zones("") == []
+    for bad in ("living", "=/run/a", "a b=/run/a", "x=/a,x=/b"):
+        try:
+            np.parse_zones(bad)
+        except ValueError:
+            continue
+        raise AssertionError(bad)
+
+
+def test_one_loop_reads_several_zones_at_once(monkeypatch, tmp_path):
+    for name in ("STATE_DIR", "STATE_FILE", "COVER_DIR", "STATE_SOCKET", "METRICS_FILE"):
+        monkeypatch.setattr(np, name, getattr(np, name))  # restored after use_state_dir
+    np.use_state_dir(str(tmp_path))
+    zones = {"": "Main", "kitchen": "Kitchen", "office": "Office"}
+    pipes = {z: str(tmp_path / f"pipe-{z or 'main'}") for z in zones}
+    for path in pipes.values():
+        os.mkfifo(path)
+    sel = selectors.DefaultSelector()
+    readers = [np.ZoneReader(sel, pipes[z], z) for z in zones]
+    for r in readers:
+        r.writer.window = 0.0
+
+    def shairport(zone, title):
+        # each zone's items arrive in small interleaved writes
+        data = (_item("ssnc", "pbeg") + _item("core", "minm", title.encode())
+                + _item("ssnc", "PICT", b"\xff\xd8\xff" + title.encode() * 5000)
+                + _item("ssnc", "pvol", b"-15.00,0,0,0"))
+        with open(pipes[zone], "wb", buffering=0) as w:
+            for i in range(0, len(data), 1000):
+                w.write(data[i:i + 1000])
+
+    np.pump(sel, readers, 0)  # opens every FIFO before the writers start
+    writers = [threading.Thread(target=shairport, args=item) for item in zones.items()]
+    for t in writers:
+        t.start()
+
+    def done():
+        return all(pathlib.Path(np.zone_paths(z)[0]).exists()
+                   and json.loads(pathlib.Path(np.zone_paths(z)[0]).read_text())["volume_percent"] == 50
+                   for z in zones)
+    deadline = time.monotonic() + 10
+    while not done() and time.monotonic() < deadline:
+        np.pump(sel, readers, 0.05)
+    for t in writers:
+        t.join()
+    assert done()
+    for zone, title in zones.items():
+        state = json.loads(pathlib.Path(np.zone_paths(zone)[0]).read_text())
+        assert (state["title"], state["active"]) == (title, True)
+        assert (tmp_path / state["cover"]).read_bytes().endswith(title.encode())
+    assert np.zone_paths("")[0] == str(tmp_path / "nowplaying.json")
+    assert (tmp_path / "nowplaying-kitchen.sock").exists()
+    for r in readers:
+        r.close_pipe()
+        r.publisher.close()
+    sel.close()
+
+
+def test_open_fifo_grows_the_pipe(tmp_path):
+    fcntl = __import__("fcntl")
+    path = str(tmp_path / "pipe")
+    os.mkfifo(path)
+    with np.open_fifo(path) as pipe:
+        default = fcntl.fcntl(pipe.fileno(), getattr(fcntl, "F_GETPIPE_SZ", 1032))
+        capacity = np.set_pipe_size(pipe.fileno(), 1024 * 1024)
+        assert capacity == fcntl.fcntl(pipe.fileno(), getattr(fcntl, "F_GETPIPE_SZ", 1032))
+        assert capacity > default
+
+
+def _zone(monkeypatch, tmp_path, disk=False):
+    for name in ("STATE_DIR", "STATE_FILE", "COVER_DIR", "STATE_SOCKET", "METRICS_FILE"):
+        monkeypatch.setattr(np, name, getattr(np, name))
+    np.use_state_dir(str(tmp_path))
+    path = str(tmp_path / "pipe")
+    os.mkfifo(path)
+    sel = selectors.DefaultSelector()
+    reader = np.ZoneReader(sel, path, disk=np.DiskWorker(sel) if disk else None)
+    reader.writer.window = 0.0
+    reader.poll()
+    return sel, reader, os.open(path, os.O_WRONLY)
+
+
+def _close(sel, reader, wfd):
+    os.close(wfd)
+    reader.close_pipe()
+    reader.publisher.close()
+    if reader.disk is not None:
+        reader.disk.close()
+    sel.close()
+
+
+def test_one_wakeup_drains_everything_buffered(monkeypatch, tmp_path):
+    sel, reader, wfd = _zone(monkeypatch, tmp_path)
+    data = b"".join(_item("core", "minm", f"Track {i}".encode()) + b"\n" for i in range(2000))
+    assert len(data) > 3 * np.READ_SIZE
+    os.write(wfd, data)
+    (key, events), = sel.select(0)
+    key.data(events)
+    assert reader.state["title"] == "Track 1999"
+    assert reader.parser.dropped == 0  # separators are not garbage
+    assert sel.select(0) == []  # nothing left behind for the next wakeup
+    _close(sel, reader, wfd)
+
+
+def test_covers_and_state_are_written_off_the_loop(monkeypatch, tmp_path):
+    sel, reader, wfd = _zone(monkeypatch, tmp_path, disk=True)
+    started, release = threading.Event(), threading.Event()
+    store_cover = np.store_cover
+
+    def slow_store(payload):
+        started.set()
+        release.wait(5)
+        return store_cover(payload)
+    monkeypatch.setattr(np, "store_cover", slow_store)
+    cover = b"\xff\xd8\xff" + b"art" * 1000
+    os.write(wfd, _item("ssnc", "pbeg") + _item("ssnc", "PICT", cover) + _item("core", "minm", b"Song"))
+    _pump(sel, 1)
+    assert started.wait(5)
+    # the loop is not blocked on the cover: later items are already applied
+    assert (reader.state["title"], reader.state["cover"]) == ("Song", None)
+    assert reader.disk.pending >= 1
+    release.set()
+    deadline = time.monotonic() + 5
+    while not reader.state["cover"] and time.monotonic() < deadline:
+        np.pump(sel, [reader], 0.05)
+    assert (tmp_path / reader.state["cover"]).read_bytes() == cover
+
+    def written():
+        return json.loads((tmp_path / "nowplaying.json").read_text())["cover"]
+    while written() != reader.state["cover"] and time.monotonic() < deadline:
+        np.pump(sel, [reader], 0.05)
+    assert written() == reader.state["cover"]
+    _close(sel, reader, wfd)
+
+
+def test_cover_stored_after_the_session_ended_is_ignored():
+    reader = np.ZoneReader.__new__(np.ZoneReader)
+    reader.state = np.empty_state()
+    reader._cover_stored("covers/late.jpg")
+    reader._cover_stored(OSError("disk full"))
+    assert reader.state["cover"] is None
+
+
+def _datagrams(stream: bytes, msglength: int) -> list:
+    return [d for typ, code, payload in np.ItemParser().feed(stream)
+            for d in np.encode_datagrams(typ, code, payload, msglength)]
+
+
+def test_parse_udp_and_udp_zones():
+    assert np.parse_udp("udp://127.0.0.1:5555") == ("127.0.0.1", 5555)
+    assert np.parse_udp("udp://[::1]:5556") == ("::1", 5556)
+    assert np.parse_zones("k=udp://127.0.0.1:5556") == [("k", "udp://127.0.0.1:5556")]
+    for bad in ("udp://127.0.0.1", "udp://:5555", "udp://host:port"):
+        try:
+            np.parse_zones(f"k={bad}")
+        except ValueError:
+            continue
+        raise AssertionError(bad)
+
+
+def test_datagram_parser_reassembles_chunked_items():
+    cover = b"\xff\xd8\xff" + os.urandom(5000)
+    grams = np.encode_datagrams(np.SSNC, np.PICT, cover, 1000)
+    assert len(grams) == 6 and all(len(g) <= 1000 for g in grams)
+    assert all(g.startswith(b"ssncchnk") for g in grams)
+    parser = np.DatagramParser()
+    out = [parser.feed(g) for g in grams]
+    assert out[:-1] == [None] * 5 and out[-1] == (np.SSNC, np.PICT, cover)
+    assert parser.feed(b"coreminmSong") == (np.CORE, 0x6D696E6D, b"Song")
+    assert (parser.dropped, parser.incomplete, parser.high_water) == (0, 0, len(cover))
+
+
+def test_datagram_parser_abandons_a_run_with_lost_chunks():
+    cover = b"\xff\xd8\xff" + os.urandom(5000)
+    grams = np.encode_datagrams(np.SSNC, np.PICT, cover, 1000)
+    parser = np.DatagramParser()
+    for g in grams[:3] + grams[4:]:  # chunk 3 lost
+        assert parser.feed(g) is None
+    # the resent cover starts a fresh run
+    assert [parser.feed(g) for g in grams][-1] == (np.SSNC, np.PICT, cover)
+    assert parser.incomplete == 1
+    assert parser.dropped == sum(len(g) - 24 for g in grams[:3] + grams[4:])
+    dropped = parser.dropped
+    assert parser.feed(b"ssnc") is None and parser.dropped == dropped + 4
+    small = np.DatagramParser(max_item=2000)
+    assert [small.feed(g) for g in grams] == [None] * 6
+
+
+def _free_udp_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_udp_reader_warns_once_when_the_buffer_is_capped(monkeypatch, capsys, tmp_path):
+    for name in ("STATE_DIR", "STATE_FILE", "COVER_DIR", "STATE_SOCKET", "METRICS_FILE"):
+        monkeypatch.setattr(np, name, getattr(np, name))
+    np.use_state_dir(str(tmp_path))
+    monkeypatch.setattr(np, "UDP_RCVBUF", 1 << 30)  # more than any rmem_max
+    sel = selectors.DefaultSelector()
+    reader = np.UdpReader(sel, f"udp://127.0.0.1:{_free_udp_port()}")
+    np.pump(sel, [reader], 0)
+    assert 0 < reader.capacity < np.UDP_RCVBUF
+    reader.close_pipe()
+    reader._open()  # a rebind does not repeat it
+    assert capsys.readouterr().err.count("raise net.core.rmem_max") == 1
+    reader.close_pipe()
+    reader.publisher.close()
+    sel.close()
+
+
+def test_udp_reader_applies_a_replayed_stream(monkeypatch, tmp_path):
+    for name in ("STATE_DIR", "STATE_FILE", "COVER_DIR", "STATE_SOCKET", "METRICS_FILE"):
+        monkeypatch.setattr(np, name, getattr(np, name))
+    np.use_state_dir(str(tmp_path))
+    cover = b"\xff\xd8\xff" + os.urandom(20000)
+    stream = (_item("ssnc", "pbeg") + _item("core", "minm", b"Song") + _item("ssnc", "PICT", cover)
+              + _item("ssnc", "pvol", b"-15.00,0,0,0"))
+    source = f"udp://127.0.0.1:{_free_udp_port()}"
+    sel = selectors.DefaultSelector()
+    reader = np.zone_reader(sel, source)
+    assert isinstance(reader, np.UdpReader)
+    reader.writer.window = 0.0
+    np.pump(sel, [reader], 0)
+    assert reader.capacity > 0
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    grams = _datagrams(stream, 1500)
+    for i in range(0, len(grams), 4):  # in bursts the socket buffer holds
+        for g in grams[i:i + 4]:
+            sender.sendto(g, reader.address)
+        _pump(sel, 1)
+    np.pump(sel, [reader], 0)
+    state = json.loads((tmp_path / "nowplaying.json").read_text())
+    assert (state["title"], state["active"], state["volume_percent"]) == ("Song", True, 50)
+    assert (tmp_path / state["cover"]).read_bytes() == cover
+    assert reader.parser.dropped == 0
+    sender.close()
+    reader.close_pipe()
+    reader.publisher.close()
+    sel.close()
@@ -115,6 +115,18 @@ def test_dashboard_unit_has_bind_env_and_hardening():
     assert "RestrictAddressFamilies=AF_UNIX AF_INET AF_INET6" in out
     assert "SystemCallFilter=@system-service" in out
     assert "User=shairport-sync" in out
+    assert "Environment=AIRPLAY_DASHBOARD_SERVER=threaded" in out
+    # thumbnails go to a directory the unit owns, not nowplaying's covers/
+    assert "RuntimeDirectory=airplay-dashboard" in out
+    assert "Environment=AIRPLAY_THUMB_DIR=/run/airplay-dashboard" in out
+    assert "ReadWritePaths" not in out
+
+
+def test_dashboard_unit_selects_async_server():
+    out = render("airplay-dashboard.service.j2", airplay_name="X",
+                 airplay_service_user="shairport-sync", airplay_dashboard_bind="0.0.0.0",
+                 airplay_dashboard_port=8080, airplay_dashboard_server="async")
+    assert "Environment=AIRPLAY_DASHBOARD_SERVER=async" in out
 
 
 def test_nowplaying_unit_is_hardened_and_networkless():
@@ -128,6 +140,44 @@ def test_nowplaying_unit_is_hardened_and_networkless():
     assert "RuntimeDirectory=airplay" in out
 
 
+def test_nowplaying_unit_lists_zones():
+    base = dict(airplay_name="X", airplay_service_user="shairport-sync",
+                airplay_metadata_pipe="/run/shairport-sync/metadata-pipe")
+    assert "AIRPLAY_ZONES" not in render("airplay-nowplaying.service.j2", **base)
+    out = render("airplay-nowplaying.service.j2", airplay_metadata_zones=[
+        {"name": "kitchen", "pipe": "/run/ss-kitchen/metadata-pipe"},
+        {"name": "office", "pipe": "/run/ss-office/metadata-pipe"}], **base)
+    assert ("Environment=AIRPLAY_ZONES=kitchen=/run/ss-kitchen/metadata-pipe,"
+            "office=/run/ss-office/metadata-pipe\n") in out
+
+
+def test_config_metadata_udp_socket_when_port_set():
+    base = dict(airplay_name="X", airplay_alsa_card="AUDIO", airplay_alsa_device=0,
+                airplay_metadata_enabled=True)
+    assert "socket_port" not in render("shairport-sync.conf.j2", **base)
+    out = render("shairport-sync.conf.j2", airplay_metadata_udp_port=5555, **base)
+    assert 'socket_address = "127.0.0.1";' in out
+    assert "socket_port = 5555;" in out
+    assert "socket_msglength = 65000;" in out
+
+
+def test_nowplaying_unit_opens_inet_only_for_udp_ingest():
+    base = dict(airplay_name="X", airplay_service_user="shairport-sync",
+                airplay_metadata_pipe="/run/shairport-sync/metadata-pipe")
+    out = render("airplay-nowplaying.service.j2", airplay_metadata_udp_port=5555, **base)
+    assert "Environment=AIRPLAY_METADATA_UDP=127.0.0.1:5555\n" in out
+    assert "Environment=AIRPLAY_UDP_RCVBUF=4194304\n" in out
+    assert "RestrictAddressFamilies=AF_UNIX AF_INET\n" in out
+    assert "IPAddressAllow=localhost" in out and "IPAddressDeny=any" in out
+    out = render("airplay-nowplaying.service.j2", airplay_metadata_zones=[
+        {"name": "kitchen", "pipe": "udp://[::1]:5556"}], **base)
+    assert "AIRPLAY_METADATA_UDP" not in out and "AIRPLAY_UDP_RCVBUF" not in out
+    assert "RestrictAddressFamilies=AF_UNIX AF_INET AF_INET6\n" in out
+    out = render("airplay-nowplaying.service.j2", airplay_metadata_udp_port=5555,
+                 airplay_metadata_udp_address="192.168.1.20", **base)
+    assert "IPAddressDeny" not in out  # a remote sender must get through
+
+
 def test_nqptp_override_grants_bind_capability():
     out = render("nqptp-override.conf.j2")
     assert "AmbientCapabilities=CAP_NET_BIND_SERVICE" in out
@@ -142,3 +192,16 @@ def test_unit_no_output_detect_runs_as_user():
     assert "ExecStart=/usr/local/bin/shairport-sync -c /etc/shairport-sync.conf" in out
     assert "living room" in out
     assert "Restart=on-failure" in out
+
+
+def test_doctor_daemon_unit_serves_from_runtime_dir():
+    out = render("airplay-doctor.service.j2")
+    assert "ExecStart=/usr/local/bin/airplay-doctor --serve" in out
+    assert "RuntimeDirectory=airplay-doctor" in out
+    assert "StateDirectory=airplay-doctor" in out
+    assert "ProtectSystem=strict" in out
+
+
+def test_health_service_keeps_journal_cursor_state():
+    out = render("airplay-health.service.j2")
+    assert "StateDirectory=airplay-doctor" in out